@@ -23,6 +23,9 @@
 #define MAX_CHANNELS 6
 #elif defined(TARGET_ATMEGA3208)
 #define MAX_CHANNELS 3
+#elif defined(TARGET_HOST)
+// host build for testing, supporting music data for any target.
+#define MAX_CHANNELS 6
 #else
 #error "Unsupported target"
 #endif
@@ -21,6 +21,18 @@
 #include <stdbool.h>
 #include <defs.h>
 
+#ifndef MUSIC_BACKREF
+// Whether to support back-references in track data (see format below).
+// Can be disabled to reduce code size and RAM usage if music data doesn't use them.
+#define MUSIC_BACKREF 1
+#endif
+
+#ifndef MUSIC_TEMPO_CHANGES
+// Whether to support tempo changes in music data (see format below).
+// Can be disabled to reduce code size and RAM usage if music data doesn't use them.
+#define MUSIC_TEMPO_CHANGES 1
+#endif
+
 #define TRACK_POS_END ((_FLASH uint8_t*) 0)
 
 #define NO_NOTE 0x54
@@ -43,6 +55,15 @@ typedef struct {
     uint16_t duration_total;
     // Number of times that the current note duration is to be repeated yet.
     uint8_t duration_repeat;
+#if MUSIC_BACKREF
+    // Whether track data uses back-references.
+    bool backref;
+    // Number of note bytes left to read in back-reference, plus one. 0 if not in back-reference.
+    uint8_t backref_left;
+    // Position in note and duration data arrays to return to after back-reference.
+    _FLASH uint8_t* backref_note_data;
+    _FLASH uint8_t* backref_duration_data;
+#endif
 } track_t;
 
 typedef struct {
@@ -55,7 +76,20 @@ typedef struct {
     //       Higher values result in slower tempo, lower values in faster tempo.
     //       tempo = 0 is 14648 BPM and tempo = 255 is 57 BPM.
     //       There's at most 1% error in the 60-300 BPM range.
-    // - 0x01-end:
+    //       More generally, the tempo is the number of 256 us slices in a tick, minus one.
+    //       Durations are given in ticks, which are usually 1/16th of a beat, but music
+    //       can be encoded with a coarser resolution (e.g. 1/8th of a beat, tempo doubled).
+    // - 0x01-0x02+(3*<number of tempo changes>): (optional, requires MUSIC_TEMPO_CHANGES)
+    //       Tempo changes, present if first byte is 0xfe:
+    //       - 0x00: 0xfe
+    //       - 0x01: number of tempo changes (1-255).
+    //       - 3 bytes per tempo change, in order:
+    //           - 0x00-0x01: number of ticks since the previous tempo change or since the start
+    //             of music for the first one (1-65535, little endian).
+    //           - 0x02: new tempo, used for the tick at which the change occurs onwards.
+    //       Since durations in track data are given in ticks, each part of the music can be
+    //       encoded with its own tempo.
+    // - next byte-end:
     //       Track data. Tracks with no data can be omitted.
     // - end: last byte is 0xff
     //
@@ -63,6 +97,7 @@ typedef struct {
     // - 0x00:
     //       Channel number, 0 to (MAX_CHANNELS-1).
     //       Must be greater than the channel number of previous tracks in music data.
+    //       Bit 7 is set if track data uses back-references (requires MUSIC_BACKREF).
     // - 0x01-0x02:
     //       Track length, in bytes, including header (little endian).
     // - 0x03-0x04: (<duration_offset>)
@@ -75,7 +110,17 @@ typedef struct {
     //       - 0x54:      pause (*)
     //       - 0x55-0xa8: notes from C2 to B8, followed by the immediate pause (*)
     //       - 0xa9:      pause, followed by the immediate pause (*)
-    //       - 0xaa-0xfe: pause of duration (byte - 0xaa)
+    //       - 0xaa-0xfe: pause of duration (byte - 0xaa), up to 0xfd if track uses back-references.
+    //       - 0xfe:      back-reference, if track uses back-references, followed by:
+    //                    - 2 bytes: distance from the byte after 0xfe back to the first note byte.
+    //                    - 2 bytes: distance from the current position in duration array back
+    //                      to the first duration byte read by the referenced notes.
+    //                    - 1 byte: number of note bytes to replay (1-255).
+    //                    The referenced notes are decoded as if they were at the current position,
+    //                    then decoding continues after the back-reference. The duration array is
+    //                    also resumed at the current position, with no duration being repeated.
+    //                    The first duration of the referenced notes must not be a repeated duration,
+    //                    and referenced notes cannot contain back-references.
     //       - 0xff:      last byte of note array
     //       (*): note byte has an associated duration in duration array.
     // - <duration_offset>-end:
@@ -128,6 +173,15 @@ typedef struct {
 
     // Music tempo (see calculation above).
     uint8_t tempo;
+
+#if MUSIC_TEMPO_CHANGES
+    // Position of next tempo change in music data.
+    _FLASH uint8_t* tempo_data;
+    // Number of tempo changes left, 0 if there are none.
+    uint8_t tempo_changes_left;
+    // Number of ticks left before next tempo change.
+    uint16_t tempo_ticks_left;
+#endif
 } music_t;
 
 /**
@@ -136,6 +190,31 @@ typedef struct {
  */
 void music_init(_FLASH uint8_t* music_data, music_t* state);
 
+/**
+ * Initialize music state from a song in a music bank.
+ * Music bank data:
+ * - 0x00:
+ *       Number of songs in bank.
+ * - 0x01-(3*<number of songs>):
+ *       Index of songs, 3 bytes per song:
+ *       - 0x00: tempo (same as in music data).
+ *       - 0x01-0x02: position of song tracks table from first byte of bank (little endian).
+ * - Song tracks tables, 3 bytes per track used by a song, ending with 0xff:
+ *       - 0x00: channel number.
+ *       - 0x01-0x02: position of track data from first byte of bank (little endian).
+ *       The table starts with an additional entry if the song has tempo changes:
+ *       - 0x00: 0xfe
+ *       - 0x01-0x02: position of tempo changes from first byte of bank (little endian), starting
+ *         with the number of tempo changes (same as in music data, without the 0xfe byte).
+ * - Track data (same as in music data), shared between songs and channels:
+ *       - the channel number in track data is 0, bit 7 is still used for back-references.
+ *       - the track length doesn't include duration array.
+ *       - duration arrays are placed after all tracks and can also be shared between tracks.
+ *
+ * @param song Song index in bank, 0 to (<number of songs>-1).
+ */
+void music_init_bank(_FLASH uint8_t* bank_data, uint8_t song, music_t* state);
+
 /**
  * Must be called periodically to update notes currently being played.
  * @return Returns true when music is playing, false when done.
@@ -0,0 +1,129 @@
+/*
+ * Copyright 2021 Nicolas Maltais
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+// ==== Host implementation for testing and benchmarking ====
+//
+// Instead of playing notes, note changes are recorded as (tick, channel, note) events.
+// Tempo changes are recorded as events on channel HOST_TEMPO_CHANNEL, with the new tempo as note.
+// This allows the music decoder to be built as a shared library for the host with
+// `make host`, to compare its output with the Python model and to measure its speed.
+// See utils/host_music.py for the Python binding.
+
+#ifdef TARGET_HOST
+
+#include <stddef.h>
+#include <time.h>
+#include <music.h>
+#include <impl.h>
+
+#define HOST_TEMPO_CHANNEL 0xff
+
+typedef struct {
+    uint32_t tick;
+    uint8_t channel;
+    uint8_t note;
+} host_event_t;
+
+static host_event_t* events;
+static size_t events_size;
+static size_t events_count;
+static uint32_t current_tick;
+
+void impl_setup(void) {
+}
+
+void impl_reset(void) {
+    events_count = 0;
+    current_tick = 0;
+}
+
+static void host_record_event(uint8_t channel, uint8_t note) {
+    if (events_count < events_size) {
+        host_event_t* event = &events[events_count];
+        event->tick = current_tick;
+        event->channel = channel;
+        event->note = note;
+    }
+    ++events_count;
+}
+
+void impl_play_note(const track_t* track, uint8_t channel) {
+    if (track->note_data == TRACK_POS_END) {
+        // track has ended, no note is played.
+        return;
+    }
+    host_record_event(channel, track->note);
+}
+
+static void host_init(_FLASH uint8_t* music_data, int16_t song, music_t* state) {
+    if (song < 0) {
+        music_init(music_data, state);
+    } else {
+        music_init_bank(music_data, song, state);
+    }
+}
+
+/**
+ * Play music until all tracks have ended, recording the note events in a buffer.
+ * If song is negative, music data is a single song, otherwise it's the index of a song in a bank.
+ * Returns the number of events, which may be greater than the buffer size, in which case only
+ * the first events were recorded. The number of ticks played is also returned.
+ */
+size_t host_play(_FLASH uint8_t* music_data, int16_t song, host_event_t* buffer, size_t size,
+                 uint32_t* ticks) {
+    music_t state;
+    events = buffer;
+    events_size = size;
+    impl_reset();
+    host_init(music_data, song, &state);
+    uint8_t tempo = state.tempo;
+    while (music_loop(&state)) {
+        if (state.tempo != tempo) {
+            // tempo changed on this tick.
+            tempo = state.tempo;
+            host_record_event(HOST_TEMPO_CHANNEL, tempo);
+        }
+        ++current_tick;
+    }
+    *ticks = current_tick;
+    events = 0;
+    events_size = 0;
+    return events_count;
+}
+
+/**
+ * Play music a number of times without recording events, returning the time taken in
+ * nanoseconds. The number of ticks played each time is also returned.
+ */
+uint64_t host_benchmark(_FLASH uint8_t* music_data, int16_t song, uint32_t repeat,
+                        uint32_t* ticks) {
+    struct timespec start, end;
+    music_t state;
+    events_size = 0;
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    for (uint32_t i = 0; i < repeat; ++i) {
+        impl_reset();
+        host_init(music_data, song, &state);
+        while (music_loop(&state)) {
+            ++current_tick;
+        }
+    }
+    clock_gettime(CLOCK_MONOTONIC, &end);
+    *ticks = current_tick;
+    return (uint64_t) (end.tv_sec - start.tv_sec) * 1000000000u + (end.tv_nsec - start.tv_nsec);
+}
+
+#endif // TARGET_HOST
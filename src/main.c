@@ -20,6 +20,20 @@
 #include <impl.h>
 #include <util/delay.h>
 
+static void play_music(music_t* music_state) {
+    impl_reset();
+
+    // play all notes
+    while (music_loop(music_state)) {
+        // wait for roughly 1/16th of a beat, with adjustment
+        uint8_t delay = music_state->tempo + TEMPO_ADJUST;
+        while (delay > 0) {
+            _delay_us(256);
+            --delay;
+        }
+    }
+}
+
 int main(void) {
     // setup registers for implementation
     impl_setup();
@@ -28,18 +42,22 @@ int main(void) {
     do {
         // initialize music state
         static music_t music_state;
-        music_init(music_data, &music_state);
-        impl_reset();
-
-        // play all notes
-        while (music_loop(&music_state)) {
-            // wait for roughly 1/16th of a beat, with adjustment
-            uint8_t delay = music_state.tempo + TEMPO_ADJUST;
-            while (delay > 0) {
-                _delay_us(256);
-                --delay;
-            }
+#ifdef MUSIC_DATA_SONG_COUNT
+        // music data is a music bank, play all songs in order.
+        for (uint8_t song = 0; song < MUSIC_DATA_SONG_COUNT; ++song) {
+            music_init_bank(music_data, song, &music_state);
+            play_music(&music_state);
         }
+#elif defined(MUSIC_DATA_SONG_TABLE_SIZE)
+        // music data has an array for each song (multi_header format), play all songs in order.
+        for (uint8_t song = 0; song < MUSIC_DATA_SONG_TABLE_SIZE; ++song) {
+            music_init(music_data_song_table[song], &music_state);
+            play_music(&music_state);
+        }
+#else
+        music_init(music_data, &music_state);
+        play_music(&music_state);
+#endif
     } while (LOOP);
 }
 
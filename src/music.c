@@ -22,6 +22,10 @@
 #define IMMEDIATE_PAUSE_MASK 0x8000
 
 #define TRACK_END 0xff
+#define TRACK_BACKREF 0xfe
+#define TRACK_BACKREF_FLAG 0x80
+
+#define TEMPO_CHANGES 0xfe
 
 /**
  * Read the next note in track data and set it as current note with its duration.
@@ -36,7 +40,28 @@ static inline void track_seek_note(track_t *track) {
         return;
     }
 
+#if MUSIC_BACKREF
+    if (track->backref_left && --track->backref_left == 0) {
+        // end of back-reference, continue after it.
+        track->note_data = track->backref_note_data;
+        track->duration_data = track->backref_duration_data;
+        track->duration_repeat = 0;
+    }
+#endif
+
     uint8_t note = *track->note_data++;
+#if MUSIC_BACKREF
+    if (note == TRACK_BACKREF && track->backref) {
+        // back-reference, replay notes from earlier in track data.
+        _FLASH uint8_t* ref = track->note_data;
+        track->backref_left = ref[4];
+        track->backref_note_data = ref + 5;
+        track->backref_duration_data = track->duration_data;
+        track->duration_data -= ref[2] | ref[3] << 8;
+        track->note_data = ref - (ref[0] | ref[1] << 8);
+        note = *track->note_data++;
+    }
+#endif
     if (note == TRACK_END) {
         // no more notes in track
         track->note_data = TRACK_POS_END;
@@ -78,30 +103,87 @@ static inline void track_seek_note(track_t *track) {
     track->note = note;
 }
 
+static void track_init(track_t* track, _FLASH uint8_t* track_pos) {
+#if MUSIC_BACKREF
+    track->backref = track_pos[0] & TRACK_BACKREF_FLAG;
+    track->backref_left = 0;
+#endif
+    uint16_t duration_offset = track_pos[3] | track_pos[4] << 8;
+    track->note_data = track_pos + 6;
+    track->duration_data = track_pos + duration_offset;
+    track->immediate_pause = track_pos[5];
+    track->duration_left = 0;
+    track->duration_total = 0;
+    track->duration_repeat = 0;
+}
+
+#if MUSIC_TEMPO_CHANGES
+static void tempo_changes_init(music_t* state, _FLASH uint8_t* tempo_pos) {
+    state->tempo_changes_left = tempo_pos[0];
+    state->tempo_data = tempo_pos + 1;
+    state->tempo_ticks_left = tempo_pos[1] | tempo_pos[2] << 8;
+}
+#endif
+
 void music_init(_FLASH uint8_t* music_data, music_t* state) {
     state->music_data = music_data;
     state->tempo = *music_data++;
+#if MUSIC_TEMPO_CHANGES
+    state->tempo_changes_left = 0;
+    if (*music_data == TEMPO_CHANGES) {
+        tempo_changes_init(state, music_data + 1);
+        music_data += 2 + music_data[1] * 3;
+    }
+#endif
     _FLASH uint8_t* track_pos = music_data;
     for (int i = 0; i < MAX_CHANNELS; ++i) {
         track_t *track = &state->tracks[i];
-        if (track_pos[0] != i) {
+        if ((track_pos[0] & ~TRACK_BACKREF_FLAG) != i) {
             // track doesn't exist
             track->note_data = TRACK_POS_END;
             continue;
         }
         uint16_t track_length = track_pos[1] | track_pos[2] << 8;
-        uint16_t duration_offset = track_pos[3] | track_pos[4] << 8;
-        track->note_data = track_pos + 6;
-        track->duration_data = track_pos + duration_offset;
-        track->immediate_pause = track_pos[5];
-        track->duration_left = 0;
-        track->duration_total = 0;
-        track->duration_repeat = 0;
+        track_init(track, track_pos);
         track_pos += track_length;
     }
 }
 
+void music_init_bank(_FLASH uint8_t* bank_data, uint8_t song, music_t* state) {
+    _FLASH uint8_t* song_pos = bank_data + 1 + song * 3;
+    state->music_data = bank_data;
+    state->tempo = song_pos[0];
+    _FLASH uint8_t* table_pos = bank_data + (song_pos[1] | song_pos[2] << 8);
+#if MUSIC_TEMPO_CHANGES
+    state->tempo_changes_left = 0;
+    if (table_pos[0] == TEMPO_CHANGES) {
+        tempo_changes_init(state, bank_data + (table_pos[1] | table_pos[2] << 8));
+        table_pos += 3;
+    }
+#endif
+    for (int i = 0; i < MAX_CHANNELS; ++i) {
+        track_t *track = &state->tracks[i];
+        if (table_pos[0] != i) {
+            // track doesn't exist
+            track->note_data = TRACK_POS_END;
+            continue;
+        }
+        track_init(track, bank_data + (table_pos[1] | table_pos[2] << 8));
+        table_pos += 3;
+    }
+}
+
 bool music_loop(music_t *state) {
+#if MUSIC_TEMPO_CHANGES
+    if (state->tempo_changes_left && state->tempo_ticks_left-- == 0) {
+        // tempo changes on this tick, go to next tempo change.
+        state->tempo = state->tempo_data[2];
+        state->tempo_data += 3;
+        if (--state->tempo_changes_left) {
+            state->tempo_ticks_left = (state->tempo_data[0] | state->tempo_data[1] << 8) - 1;
+        }
+    }
+#endif
     bool track_playing = false;
     for (int channel = 0; channel < MAX_CHANNELS; ++channel) {
         track_t *track = &state->tracks[channel];
@@ -0,0 +1,204 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import random
+import sys
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+from host_music import HostMusic, get_model_events, get_events_diff
+from midi_convert import PREDEFINED_CHANNEL_SPECS, parse_channels_spec
+from music_data import BuzzerMusic, BuzzerMusicBank, BuzzerNote, BuzzerTrack, ChannelSpec
+
+# round-trip check of the music encoder: random music is encoded with each encoding mode, then
+# played with the music decoder built for the host and with the Python decoder. both must give
+# the same note events, and the decoded music must be the music that was encoded.
+
+# encoding modes checked, as (name, optimal, backref).
+ENCODING_MODES = [
+    ("greedy", False, False),
+    ("greedy -b", False, True),
+    ("-z", True, False),
+    ("-z -b", True, True),
+]
+
+# maximum number of songs in a random music bank.
+MAX_BANK_SONGS = 4
+
+parser = argparse.ArgumentParser(description="Check that random music decodes as encoded",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("-n", "--count", type=int,
+                    help="Number of random songs and music banks checked (default 50)",
+                    dest="count", default=50)
+parser.add_argument("-s", "--seed", type=int,
+                    help="Seed of the first random case, each case uses the next seed (default 0)",
+                    dest="seed", default=0)
+parser.add_argument("-l", "--length", type=int,
+                    help="Maximum number of note runs in a random track (default 200)",
+                    dest="length", default=200)
+
+
+def create_random_track(rng: random.Random, channel: int, spec: ChannelSpec,
+                        length: int) -> BuzzerTrack:
+    """Create a random track with short and long notes and pauses, and repeated sequences
+    so that back-references are used."""
+    track = BuzzerTrack(channel, spec)
+    runs: List[Tuple[int, int]] = []
+    while len(runs) < length:
+        kind = rng.random()
+        if kind < 0.5:
+            # short notes, often with the same duration
+            duration = rng.choice([1, 2, 4, 8, rng.randint(1, 300)])
+            for _ in range(rng.randint(1, 16)):
+                runs.append((rng.choice(spec.note_range), duration))
+        elif kind < 0.7:
+            # pause, possibly longer than a single byte pause or the maximum duration
+            duration = rng.choice([rng.randint(1, 300),
+                                   rng.randint(300, 3 * BuzzerNote.MAX_DURATION)])
+            runs.append((BuzzerNote.NONE, duration))
+        elif runs:
+            # repeat a previous sequence
+            start = rng.randrange(len(runs))
+            runs += runs[start:start + rng.randint(1, 40)]
+    for note, duration in runs[:length]:
+        track.add_run(note, duration)
+    track.finalize()
+    return track
+
+
+def create_random_music(rng: random.Random, channels_spec: List[ChannelSpec],
+                        length: int) -> BuzzerMusic:
+    """Create random music on a random subset of channels, with random tempo changes."""
+    music = BuzzerMusic(rng.randint(0, 255))
+    channels = sorted(rng.sample(range(len(channels_spec)), rng.randint(1, len(channels_spec))))
+    for channel in channels:
+        music.tracks.append(create_random_track(rng, channel, channels_spec[channel],
+                                                rng.randint(0, length)))
+    if rng.random() < 0.5:
+        ticks = max(sum(track.durations) + len(track.durations) for track in music.tracks)
+        # changes further apart than the maximum ticks between changes are split when encoded.
+        change_ticks = rng.sample(range(1, max(2, ticks + 0x20000)), rng.randint(1, 20))
+        music.tempo_changes = [(tick, rng.randint(0, 255)) for tick in sorted(change_ticks)]
+    return music
+
+
+def create_random_bank(rng: random.Random, channels_spec: List[ChannelSpec],
+                       length: int) -> BuzzerMusicBank:
+    """Create a random music bank, in which songs share some tracks."""
+    bank = BuzzerMusicBank()
+    for _ in range(rng.randint(1, MAX_BANK_SONGS)):
+        music = create_random_music(rng, channels_spec, length)
+        if bank.songs:
+            # reuse tracks of a previous song on the same channel
+            other = rng.choice(bank.songs)
+            for i, track in enumerate(music.tracks):
+                shared = [t for t in other.tracks if t.channel == track.channel]
+                if shared and rng.random() < 0.5:
+                    music.tracks[i] = shared[0]
+        bank.songs.append(music)
+    return bank
+
+
+def get_music_diff(expected: BuzzerMusic, actual: BuzzerMusic) -> List[str]:
+    """Get lines describing how decoded music differs from encoded music."""
+    lines = []
+    expected_tracks = {track.channel: track for track in expected.tracks if len(track) > 0}
+    actual_tracks = {track.channel: track for track in actual.tracks}
+    if expected_tracks.keys() != actual_tracks.keys():
+        lines.append(f"  tracks on channels {sorted(actual_tracks.keys())}, "
+                     f"expected {sorted(expected_tracks.keys())}")
+    for channel in sorted(expected_tracks.keys() & actual_tracks.keys()):
+        expected_track = expected_tracks[channel]
+        actual_track = actual_tracks[channel]
+        if (expected_track.notes != actual_track.notes or
+                expected_track.durations != actual_track.durations):
+            lines.append(f"  track on channel {channel} differs")
+    # tempo changes split when encoded give the same tempo on each tick.
+    ticks = max((sum(track.durations) + len(track.durations) for track in expected.tracks),
+                default=0)
+    if expected.tempo != actual.tempo or \
+            not np.array_equal(expected.get_tempos(ticks), actual.get_tempos(ticks)):
+        lines.append("  tempo differs")
+    return lines
+
+
+def check_data(host: HostMusic, data: bytes, music: BuzzerMusic,
+               song: Optional[int] = None) -> List[str]:
+    """Check encoded music data or a song in a music bank, returning lines describing
+    differences."""
+    if song is None:
+        decoded = BuzzerMusic.decode(data)
+    else:
+        decoded = BuzzerMusicBank.decode(data).songs[song]
+    lines = get_music_diff(music, decoded)
+    events, _ = host.play(data, song)
+    diff = get_events_diff(get_model_events(data, song), events)
+    if diff:
+        lines.append(f"  {len(diff)} events differ between host decoder and Python decoder")
+        lines += diff[:10]
+    return lines
+
+
+def check_case(host: HostMusic, seed: int, length: int) -> List[str]:
+    """Check a random song and a random music bank in all encoding modes, returning lines
+    describing failures."""
+    rng = random.Random(seed)
+    target = rng.choice(list(PREDEFINED_CHANNEL_SPECS.keys()))
+    channels_spec = list(parse_channels_spec(PREDEFINED_CHANNEL_SPECS[target]))
+    music = create_random_music(rng, channels_spec, length)
+    bank = create_random_bank(rng, channels_spec, length)
+
+    lines = []
+    for name, optimal, backref in ENCODING_MODES:
+        try:
+            diff = check_data(host, bytes(music.encode(optimal, backref)), music)
+            if diff:
+                lines.append(f"seed {seed}, {target}, song [{name}]:")
+                lines += diff
+            data = bytes(bank.encode(optimal, backref))
+            for i, song in enumerate(bank.songs):
+                diff = check_data(host, data, song, i)
+                if diff:
+                    lines.append(f"seed {seed}, {target}, bank song {i} [{name}]:")
+                    lines += diff
+        except (RuntimeError, ValueError) as e:
+            lines.append(f"seed {seed}, {target} [{name}]: error: {e}")
+    return lines
+
+
+def main() -> None:
+    args = parser.parse_args()
+    try:
+        host = HostMusic()
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    failed = 0
+    for seed in range(args.seed, args.seed + args.count):
+        lines = check_case(host, seed, args.length)
+        if lines:
+            failed += 1
+            for line in lines:
+                print(line)
+
+    print(f"{args.count} random songs and music banks checked in {len(ENCODING_MODES)} "
+          f"encoding modes, {failed} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from collections import Counter
+from contextlib import nullcontext
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+from midi_convert import MidiConverter, create_config, parse_channels_spec, format_midi_note, \
+    get_frame_time, parser as convert_parser
+from music_data import CompiledChannelSpecs, FramesNotes
+from octave_fit import get_note_histograms, fit_octaves, split_octaves
+
+# check whether MIDI files can be converted for channel specifications, without creating tracks.
+# for each file, the peak number of notes played at once, the notes out of range of each
+# specification, and the octave adjustments needed to fit the range (the same as found by the
+# converter with automatic octave) are reported, as one JSON object per line.
+
+parser = argparse.ArgumentParser(description="Check if MIDI files can be converted to buzzer music",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("input_files", type=str, nargs="+",
+                    help="Input MIDI files, or directories searched for MIDI files")
+parser.add_argument("-c", "--channels", type=str, action="append",
+                    help="Channel specification to check, can be repeated (default is atmega3208)",
+                    dest="channels", metavar="SPEC", default=[])
+parser.add_argument("-o", "--output", type=str,
+                    help="Output file for report (default is standard output)",
+                    dest="output_file", default=None)
+parser.add_argument("-j", "--jobs", type=int,
+                    help="Number of processes used to check files (default is 1).",
+                    dest="jobs", default=1)
+
+
+def find_midi_files(paths: List[str]) -> List[str]:
+    """Get input files, replacing directories with the MIDI files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(str(p) for p in Path(path).rglob("*")
+                            if p.suffix.lower() in (".mid", ".midi") and p.is_file())
+        else:
+            files.append(path)
+    return files
+
+
+def get_started_notes(frames_notes: FramesNotes) -> Counter:
+    """Count the number of times each note starts being played, in all MIDI tracks."""
+    counts = Counter()
+    for track_notes in frames_notes:
+        last_notes = []
+        for notes in track_notes:
+            counts.update(note for note in notes if note not in last_notes)
+            last_notes = notes
+    return counts
+
+
+def check_channels_spec(max_notes: int, note_counts: Counter, histograms: np.ndarray,
+                        tracks_max_notes: List[int],
+                        channels_spec: CompiledChannelSpecs) -> Dict[str, Any]:
+    # the same checks as done by the converter before creating tracks.
+    playable = channels_spec.playable
+    out_of_range = {format_midi_note(note): count for note, count in sorted(note_counts.items())
+                    if not playable[note]}
+    # octave adjustment of the whole file and of each MIDI track relative to it.
+    octave_adjust = None
+    track_octave_adjust = {}
+    octaves = fit_octaves(histograms, tracks_max_notes, channels_spec)
+    if octaves is not None:
+        octave_adjust, track_octaves = split_octaves(histograms, octaves)
+        track_octave_adjust = {str(i): octave for i, octave in enumerate(track_octaves)
+                               if octave}
+    enough_channels = max_notes <= len(channels_spec)
+    return {
+        "channels": len(channels_spec),
+        "out_of_range": out_of_range,
+        "octave_adjust": octave_adjust,
+        "track_octave_adjust": track_octave_adjust,
+        "feasible": enough_channels and not out_of_range,
+        "feasible_with_octave_adjust": enough_channels and octaves is not None,
+    }
+
+
+def check_file(task: Tuple[str, List[Tuple[str, CompiledChannelSpecs]]]) -> Dict[str, Any]:
+    """Check a MIDI file for all channel specifications."""
+    input_file, channels_specs = task
+    report: Dict[str, Any] = {"file": input_file}
+    try:
+        config = create_config(convert_parser.parse_args([input_file, "-", "-l", "off"]))
+        converter = MidiConverter(config)
+        midi_data = converter.parse_midi_file(input_file)
+        tempo_changes, frames_notes = converter.get_frames_notes(midi_data)
+    except Exception as e:
+        # any file in a library may be invalid, only report it.
+        report["error"] = str(e) or type(e).__name__
+        return report
+
+    frames_count = len(frames_notes[0])
+    notes_per_frame = [sum(len(notes[i]) for notes in frames_notes) for i in range(frames_count)]
+    max_notes = max(notes_per_frame, default=0)
+    note_counts = get_started_notes(frames_notes)
+    histograms, tracks_max_notes = get_note_histograms(midi_data.event_map, midi_data.track_count)
+    report.update({
+        "duration": round(get_frame_time(tempo_changes, frames_count), 3),
+        "max_notes": max_notes,
+        "max_notes_time": round(get_frame_time(tempo_changes, notes_per_frame.index(max_notes)), 3)
+        if max_notes else 0,
+        "lowest_note": format_midi_note(min(note_counts)) if note_counts else None,
+        "highest_note": format_midi_note(max(note_counts)) if note_counts else None,
+        "specs": {name: check_channels_spec(max_notes, note_counts, histograms,
+                                            tracks_max_notes, channels_spec)
+                  for name, channels_spec in channels_specs},
+    })
+    return report
+
+
+def main() -> None:
+    args = parser.parse_args()
+    try:
+        channels_specs = [(spec, parse_channels_spec(spec))
+                          for spec in args.channels or ["atmega3208"]]
+        if args.jobs < 1:
+            raise ValueError("number of jobs must be at least 1")
+        output = open(args.output_file, "w") if args.output_file else sys.stdout
+    except (ValueError, IOError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    files = find_midi_files(args.input_files)
+    tasks = [(file, channels_specs) for file in files]
+    feasible = Counter()
+    errors = 0
+    parallel = args.jobs > 1 and len(tasks) > 1
+    with multiprocessing.Pool(args.jobs) if parallel else nullcontext() as pool:
+        reports = pool.imap(check_file, tasks, chunksize=4) if pool else map(check_file, tasks)
+        for report in reports:
+            output.write(json.dumps(report) + "\n")
+            if "error" in report:
+                errors += 1
+                continue
+            for name, result in report["specs"].items():
+                feasible[name] += result["feasible"]
+    if output is not sys.stdout:
+        output.close()
+
+    print(f"{len(files)} files checked, {errors} couldn't be read", file=sys.stderr)
+    for name, _ in channels_specs:
+        print(f"{feasible[name]} files can be converted for '{name}'", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,7 @@ import math
 import sys
 
 from midi_convert import parse_channels_spec, NOTE_NAMES
-from tracks_to_wav import get_note_freq
+from music_data import get_note_freq
 
 # from an input channels specification string (same as taken by midi_convert),
 # print a few stats showing the actual frequency of the note produced by the buzzer,
@@ -49,8 +49,8 @@ def main(spec_str: str) -> None:
             for bnote in spec.note_range:
                 name = format_note(bnote)
                 target_freq = get_note_freq(bnote)
-                timer_cnt = round(spec.timer_period / target_freq / 2) - 1
-                actual_freq = spec.timer_period / (timer_cnt + 1) / 2
+                timer_cnt = channels_spec.timer_counts[i, bnote]
+                actual_freq = channels_spec.freqs[i, bnote]
                 error_freq = actual_freq - target_freq
                 error_tone = 12 * math.log2(actual_freq / target_freq) * 100
                 print(f"{bnote:^6}   {name:<4}   {target_freq:^16.1f}   {actual_freq:^16.1f}   "
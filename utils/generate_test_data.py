@@ -20,8 +20,9 @@
 import random
 from typing import List, Iterable
 
-from midi_convert import write_c_header, parse_channels_spec
+from midi_convert import parse_channels_spec
 from music_data import BuzzerTrack, BuzzerMusic, BuzzerNote, ChannelSpec
+from output_formats import write_c_header
 
 # test data file name
 filename = "../include/music_data.h"
@@ -30,17 +31,15 @@ channels_spec = parse_channels_spec("atmega328p_split")
 
 
 def add_pause(tracks: List[BuzzerTrack], duration: int) -> None:
-    for i in range(duration):
-        for track in tracks:
-            track.add_note(BuzzerNote.NONE)
+    for track in tracks:
+        track.add_run(BuzzerNote.NONE, duration)
 
 
 def play_note_on_tracks(tracks: List[BuzzerTrack], nums: Iterable[int],
                         note: int = 24, duration: int = 64) -> None:
     """play a note on tracks by number, for a duration, while other tracks are silent."""
     for track in tracks:
-        for j in range(duration):
-            track.add_note(note if track.channel in nums else BuzzerNote.NONE)
+        track.add_run(note if track.channel in nums else BuzzerNote.NONE, duration)
 
 
 def main() -> None:
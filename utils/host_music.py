@@ -0,0 +1,187 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import ctypes
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Tuple, Optional
+
+from music_data import BuzzerMusic, BuzzerMusicBank, load_music_data
+
+# play encoded music data with the music decoder from src/music.c built for the host, and compare
+# the notes played with the Python decoder. the decoder speed on the host can also be measured.
+
+# (tick, channel, note) for each note played, including pauses.
+# tempo changes are events on TEMPO_CHANNEL, with the new tempo as note.
+NoteEvent = Tuple[int, int, int]
+
+TEMPO_CHANNEL = 0xff
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+HOST_LIBRARY = ROOT_DIR / "build" / "host" / "libmusic.so"
+
+parser = argparse.ArgumentParser(description="Compare music decoder in firmware with Python model",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("input_files", type=str, nargs="+",
+                    help="Input buzzer music data (binary, or C header if .h extension)")
+parser.add_argument("-k", "--bank", action="store_true",
+                    help="Input files are music banks, all songs are compared", dest="bank")
+parser.add_argument("-b", "--bench", type=int,
+                    help="Measure decoder time per tick on host, playing each song N times",
+                    dest="bench", default=0, metavar="N")
+
+
+class _HostEvent(ctypes.Structure):
+    _fields_ = [("tick", ctypes.c_uint32), ("channel", ctypes.c_uint8), ("note", ctypes.c_uint8)]
+
+
+class HostMusic:
+    """Binding to the music decoder built for the host (see src/host.c)."""
+
+    def __init__(self, library: Path = HOST_LIBRARY) -> None:
+        if not library.exists():
+            # build library with Makefile
+            result = subprocess.run(["make", "-C", str(ROOT_DIR), "host"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if result.returncode != 0 or not library.exists():
+                raise RuntimeError(f"could not build host library: "
+                                   f"{result.stdout.decode(errors='replace')}")
+        self._lib = ctypes.CDLL(str(library))
+        self._lib.host_play.restype = ctypes.c_size_t
+        self._lib.host_play.argtypes = [ctypes.c_char_p, ctypes.c_int16,
+                                        ctypes.POINTER(_HostEvent), ctypes.c_size_t,
+                                        ctypes.POINTER(ctypes.c_uint32)]
+        self._lib.host_benchmark.restype = ctypes.c_uint64
+        self._lib.host_benchmark.argtypes = [ctypes.c_char_p, ctypes.c_int16, ctypes.c_uint32,
+                                             ctypes.POINTER(ctypes.c_uint32)]
+
+    def play(self, data: bytes, song: Optional[int] = None) -> Tuple[List[NoteEvent], int]:
+        """Play music data or a song in a music bank, returning note events and tick count."""
+        ticks = ctypes.c_uint32()
+        size = 0
+        while True:
+            buffer = (_HostEvent * size)()
+            count = self._lib.host_play(data, -1 if song is None else song,
+                                        buffer, size, ctypes.byref(ticks))
+            if count <= size:
+                break
+            size = count
+        return [(e.tick, e.channel, e.note) for e in buffer[:count]], ticks.value
+
+    def benchmark(self, data: bytes, song: Optional[int] = None,
+                  repeat: int = 1) -> Tuple[float, int]:
+        """Play music data a number of times, returning time in seconds and tick count."""
+        ticks = ctypes.c_uint32()
+        ns = self._lib.host_benchmark(data, -1 if song is None else song,
+                                      repeat, ctypes.byref(ticks))
+        return ns * 1e-9, ticks.value
+
+
+def get_model_events(data: bytes, song: Optional[int] = None) -> List[NoteEvent]:
+    """Get note events for music data or a song in a music bank, using the Python decoder."""
+    events = []
+    end_tick = 0
+    try:
+        if song is None:
+            tracks = BuzzerMusic.iter_tracks(data)
+            tempo, tempo_changes = BuzzerMusic.decode_tempo(data)
+        else:
+            tracks = BuzzerMusicBank.iter_tracks(data, song)
+            tempo, tempo_changes = BuzzerMusicBank.decode_tempo(data, song)
+        for channel, notes in tracks:
+            tick = 0
+            for note, duration in notes:
+                events.append((tick, channel, note))
+                tick += duration + 1
+            end_tick = max(end_tick, tick)
+    except IndexError as e:
+        raise ValueError("music data is truncated") from e
+
+    # tempo changes are only seen if tempo is different, while tracks are playing.
+    for tick, change_tempo in tempo_changes:
+        if tick <= end_tick and change_tempo != tempo:
+            events.append((tick, TEMPO_CHANNEL, change_tempo))
+        tempo = change_tempo
+    events.sort()
+    return events
+
+
+def get_events_diff(expected: List[NoteEvent], actual: List[NoteEvent]) -> List[str]:
+    """Get lines describing events which differ between two event lists."""
+    lines = []
+    expected_set = set(expected)
+    actual_set = set(actual)
+    for event in expected:
+        if event not in actual_set:
+            lines.append(f"  missing {event}")
+    for event in actual:
+        if event not in expected_set:
+            lines.append(f"  unexpected {event}")
+    if not lines and expected != actual:
+        lines.append("  events are in different order")
+    return lines
+
+
+def main() -> None:
+    args = parser.parse_args()
+    try:
+        host = HostMusic()
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    failed = False
+    for filename in args.input_files:
+        try:
+            data = load_music_data(filename)
+            songs = list(range(data[0])) if args.bank else [None]
+        except (IOError, ValueError) as e:
+            print(f"{filename}: error: {e}", file=sys.stderr)
+            failed = True
+            continue
+
+        for song in songs:
+            name = filename if song is None else f"{filename} [song {song}]"
+            try:
+                expected = get_model_events(data, song)
+            except ValueError as e:
+                print(f"{name}: error: {e}", file=sys.stderr)
+                failed = True
+                continue
+            events, ticks = host.play(data, song)
+            diff = get_events_diff(expected, events)
+            if diff:
+                failed = True
+                print(f"{name}: {len(diff)} events differ")
+                for line in diff[:20]:
+                    print(line)
+                if len(diff) > 20:
+                    print("  ...")
+                continue
+
+            line = f"{name}: {len(events)} events in {ticks} ticks, OK"
+            if args.bench > 0:
+                duration, ticks = host.benchmark(data, song, args.bench)
+                ticks *= args.bench
+                line += f", {duration / ticks * 1e9:.1f} ns per tick, " \
+                        f"{duration / (len(events) * args.bench) * 1e9:.1f} ns per note"
+            print(line)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import sys
+from dataclasses import dataclass, replace
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+from music_data import BuzzerMusic, BuzzerMusicBank, ChannelSpec, CompiledChannelSpecs, \
+    load_music_data
+from midi_convert import PREDEFINED_CHANNEL_SPECS, parse_channels_spec
+
+# from encoded music data and a firmware target, estimate the CPU time used by the channel
+# timer interrupts and by music_loop over time, from the timer counts of the notes played.
+
+
+@dataclass
+class TargetLoadModel:
+    # CPU frequency in Hz for which the predefined channels spec is given.
+    cpu_freq: float
+    # cycles for a channel timer interrupt, including entry and exit.
+    # an interrupt occurs on each level change, i.e. twice per note period. on targets where
+    # two channels share a timer, an interrupt is counted for each channel, which is an upper
+    # bound since simultaneous level changes are handled by the same interrupt.
+    isr_cycles: int
+    # cycles spent in music_loop on each tick, for each track, and for each new note
+    # (track_seek_note and impl_play_note).
+    loop_tick_cycles: int
+    loop_track_cycles: int
+    loop_note_cycles: int
+    # where the cycle counts come from, None if they weren't measured.
+    source: Optional[str] = None
+
+    @property
+    def measured(self) -> bool:
+        return self.source is not None
+
+
+# rough estimates, not measured: the interrupt cycle counts are taken from the estimates in
+# the implementation source file of each target, the music_loop cycle counts are guesses.
+# once measured (e.g. by counting instructions in the output of 'make disasm' or in a
+# simulator), cycle counts should be updated here along with their source.
+# until then, use --isr-cycles and --loop-cycles to give measured values.
+TARGET_LOAD_MODELS = {
+    "atmega328p": TargetLoadModel(16e6, 60, 20, 30, 150),
+    "atmega3208": TargetLoadModel(10e6, 50, 20, 30, 120),
+    "atmega328p_split": TargetLoadModel(16e6, 70, 20, 30, 180),
+}
+
+# duration of a music_loop tick for each tempo unit, in seconds (see main.h).
+TICK_DURATION = 256e-6
+
+parser = argparse.ArgumentParser(description="Estimate CPU load of buzzer music playback",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("input_file", type=str,
+                    help="Input buzzer music data (binary, or C header if .h extension)")
+parser.add_argument("-t", "--target", type=str, choices=TARGET_LOAD_MODELS.keys(),
+                    help="Firmware target (default is atmega3208)",
+                    dest="target", default="atmega3208")
+parser.add_argument("-f", "--cpu-freq", type=float,
+                    help="CPU frequency in Hz, default is target frequency. Timer counts are\n"
+                         "assumed to be computed for this frequency.",
+                    dest="cpu_freq", default=None)
+parser.add_argument("-w", "--window", type=float,
+                    help="Duration of windows in which load is averaged, in ms (default 100 ms)",
+                    dest="window", default=100)
+parser.add_argument("-b", "--budget", type=float,
+                    help="Maximum CPU load allowed in a window, in percent (default 5%%).\n"
+                         "Exit code is 1 if exceeded by the load computed from the cycle counts,\n"
+                         "which is only an estimate unless measured counts are given.",
+                    dest="budget", default=5)
+parser.add_argument("-s", "--song", type=int,
+                    help="Song index if input is a music bank",
+                    dest="song", default=None)
+parser.add_argument("-i", "--isr-cycles", type=int,
+                    help="Measured cycles per channel timer interrupt, default is the target\n"
+                         "estimate. Target estimates are rough, see TARGET_LOAD_MODELS.",
+                    dest="isr_cycles", default=None)
+parser.add_argument("-l", "--loop-cycles", type=str,
+                    help="Measured cycles spent in music_loop per tick, per track and per new\n"
+                         "note, as 'TICK,TRACK,NOTE'. Default is the target estimate, which is\n"
+                         "a rough guess.",
+                    dest="loop_cycles", default=None)
+
+
+@dataclass
+class MusicLoad:
+    # duration of each tick in seconds, which changes with tempo.
+    tick_durations: np.ndarray
+    # CPU load for each tick, from timer interrupts and from music_loop (0 to 1).
+    isr_load: np.ndarray
+    loop_load: np.ndarray
+
+    @property
+    def total_load(self) -> np.ndarray:
+        return self.isr_load + self.loop_load
+
+    @property
+    def tick_times(self) -> np.ndarray:
+        # time at the start of each tick in seconds, and at the end of the last tick.
+        return np.concatenate(([0], np.cumsum(self.tick_durations)))
+
+
+def get_music_load(music: BuzzerMusic, channels_spec: List[ChannelSpec],
+                   model: TargetLoadModel, cpu_freq: float) -> MusicLoad:
+    """Compute CPU load for each music tick."""
+    ticks = max(sum(track.durations) + len(track.durations) for track in music.tracks)
+    tick_durations = music.get_tempos(ticks) * TICK_DURATION
+    isr_rate = np.zeros(ticks)
+    loop_cycles = np.full(ticks, model.loop_tick_cycles, dtype=np.float64)
+    for track in music.tracks:
+        if track.channel >= len(channels_spec):
+            raise ValueError(f"track uses channel {track.channel} not supported by target")
+        spec = channels_spec[track.channel]
+
+        # interrupts per second for each note (twice per period), with timer counts computed
+        # for CPU frequency.
+        timer_spec = ChannelSpec(spec.note_range, spec.timer_period * cpu_freq / model.cpu_freq)
+        note_rates = 2 * CompiledChannelSpecs([timer_spec]).freqs[0]
+
+        durations = np.frombuffer(track.durations, dtype=np.uint16).astype(np.int64) + 1
+        notes = np.repeat(np.frombuffer(track.notes, dtype=np.uint8), durations)
+        isr_rate[:len(notes)] += note_rates[notes]
+        loop_cycles[:len(notes)] += model.loop_track_cycles
+        loop_cycles[np.cumsum(durations) - durations] += model.loop_note_cycles
+
+    return MusicLoad(tick_durations, isr_rate * model.isr_cycles / cpu_freq,
+                     loop_cycles / (tick_durations * cpu_freq))
+
+
+def get_window_loads(load: np.ndarray, tick_durations: np.ndarray,
+                     window_ticks: int) -> np.ndarray:
+    """Get average load in each window of ticks (one window starting on each tick),
+    weighted by the duration of ticks."""
+    window_ticks = min(window_ticks, len(load))
+    cumsum = np.concatenate(([0], np.cumsum(load * tick_durations)))
+    times = np.concatenate(([0], np.cumsum(tick_durations)))
+    return ((cumsum[window_ticks:] - cumsum[:-window_ticks]) /
+            (times[window_ticks:] - times[:-window_ticks]))
+
+
+def get_exceeding_ranges(window_loads: np.ndarray, window_ticks: int,
+                         budget: float) -> List[Tuple[int, int]]:
+    """Get tick ranges covered by windows in which load exceeds a budget."""
+    exceeding = np.flatnonzero(window_loads > budget)
+    ranges = []
+    for start in exceeding:
+        end = start + window_ticks
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def format_time(seconds: float) -> str:
+    return f"{int(seconds // 60)}:{seconds % 60:06.3f}"
+
+
+def get_load_model(args: argparse.Namespace) -> TargetLoadModel:
+    """Get target load model with cycle counts overridden by command line options.
+    The model is only considered measured if all cycle counts are measured."""
+    model = TARGET_LOAD_MODELS[args.target]
+    if not model.measured and args.isr_cycles is not None and args.loop_cycles is not None:
+        model = replace(model, source="command line")
+    if args.isr_cycles is not None:
+        if args.isr_cycles <= 0:
+            raise ValueError("interrupt cycles must be positive")
+        model = replace(model, isr_cycles=args.isr_cycles)
+    if args.loop_cycles is not None:
+        try:
+            tick, track, note = (int(c) for c in args.loop_cycles.split(","))
+        except ValueError:
+            raise ValueError("invalid music loop cycles, expected 'TICK,TRACK,NOTE'")
+        if min(tick, track, note) < 0:
+            raise ValueError("music loop cycles must not be negative")
+        model = replace(model, loop_tick_cycles=tick, loop_track_cycles=track,
+                        loop_note_cycles=note)
+    return model
+
+
+def main() -> None:
+    args = parser.parse_args()
+    channels_spec = parse_channels_spec(PREDEFINED_CHANNEL_SPECS[args.target])
+    try:
+        model = get_load_model(args)
+        cpu_freq = args.cpu_freq if args.cpu_freq else model.cpu_freq
+        data = load_music_data(args.input_file)
+        if args.song is None:
+            music = BuzzerMusic.decode(data, channels_spec)
+        else:
+            songs = BuzzerMusicBank.decode(data, channels_spec).songs
+            if not (0 <= args.song < len(songs)):
+                raise ValueError("song index out of bounds")
+            music = songs[args.song]
+        load = get_music_load(music, channels_spec, model, cpu_freq)
+    except (IOError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # with tempo changes, windows have a fixed number of ticks of the average duration.
+    durations = load.tick_durations
+    times = load.tick_times
+    tick_duration = times[-1] / len(durations)
+    window_ticks = max(1, round(args.window * 1e-3 / tick_duration))
+    window_loads = get_window_loads(load.total_load, durations, window_ticks)
+    peak = int(np.argmax(window_loads))
+    ticks_info = f"{tick_duration * 1e3:.2f} ms"
+    if np.min(durations) != np.max(durations):
+        ticks_info = f"{np.min(durations) * 1e3:.2f} to {np.max(durations) * 1e3:.2f} ms"
+    print(f"Target {args.target} at {cpu_freq / 1e6:g} MHz, "
+          f"{len(load.isr_load)} ticks of {ticks_info}")
+    if model.measured:
+        print(f"Cycle counts measured ({model.source})")
+    else:
+        print("Cycle counts are rough estimates, not measured (see --isr-cycles and "
+              "--loop-cycles)")
+    print(f"Average load: {np.average(load.total_load, weights=durations):.2%} "
+          f"(interrupts {np.average(load.isr_load, weights=durations):.2%}, "
+          f"music loop {np.average(load.loop_load, weights=durations):.2%})")
+    print(f"Peak load in {window_ticks * tick_duration * 1e3:.0f} ms window: "
+          f"{window_loads[peak]:.2%} at {format_time(times[peak])}")
+    print(f"Peak load in a single tick: {np.max(load.total_load):.2%} "
+          f"at {format_time(times[int(np.argmax(load.total_load))])}")
+
+    ranges = get_exceeding_ranges(window_loads, window_ticks, args.budget / 100)
+    if ranges:
+        print(f"Load exceeds {args.budget:g}% budget in:")
+        for start, end in ranges:
+            print(f"  {format_time(times[start])} to "
+                  f"{format_time(times[min(end, len(durations))])}")
+        sys.exit(1)
+    if model.measured:
+        print(f"Load is within {args.budget:g}% budget")
+    else:
+        print(f"Estimated load is within {args.budget:g}% budget, this isn't a guarantee "
+              f"since cycle counts aren't measured")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,8 +12,9 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import json
 from enum import Enum
-from typing import IO
+from typing import IO, Any, Dict, Optional, Tuple
 from functools import total_ordering
 
 
@@ -29,22 +30,70 @@ class LogLevel(Enum):
 
 
 class Logger:
+    """
+    Logger printing messages to a file, and optionally as JSON lines to another file.
+    The level and the repeat limit only apply to the printed messages, all messages are
+    written to the JSON file. Messages are only formatted with their arguments (% style)
+    if they are printed or written. Printed messages given a category are only printed a
+    limited number of times, others are counted and reported by the summary.
+    """
     file: IO
     level: LogLevel
+    json_file: Optional[IO]
+    # number of messages printed for a category before the others are only counted.
+    repeat_limit: int
+    # level and number of printable messages for each category since last summary.
+    _counts: Dict[str, Tuple[LogLevel, int]]
 
-    def __init__(self, file: IO, level: LogLevel):
+    REPEAT_LIMIT = 5
+
+    def __init__(self, file: IO, level: LogLevel, json_file: Optional[IO] = None,
+                 repeat_limit: int = REPEAT_LIMIT):
         self.file = file
         self.level = level
+        self.json_file = json_file
+        self.repeat_limit = repeat_limit
+        self._counts = {}
+
+    def info(self, message: str, *args: Any, category: Optional[str] = None) -> None:
+        self.log(LogLevel.INFO, message, *args, category=category)
+
+    def warn(self, message: str, *args: Any, category: Optional[str] = None) -> None:
+        self.log(LogLevel.WARNING, message, *args, category=category)
+
+    def error(self, message: str, *args: Any, category: Optional[str] = None) -> None:
+        self.log(LogLevel.ERROR, message, *args, category=category)
 
-    def info(self, message: str) -> None:
-        self.log(LogLevel.INFO, message)
+    def log(self, level: LogLevel, message: str, *args: Any,
+            category: Optional[str] = None) -> None:
+        printed = level <= self.level
+        if printed and category is not None:
+            count = self._counts.get(category, (level, 0))[1] + 1
+            self._counts[category] = (level, count)
+            printed = count <= self.repeat_limit
+        if not printed and not self.json_file:
+            return
+        if args:
+            message = message % args
+        if printed:
+            self._print(level, message)
+        self._write_json(level, message, category=category)
 
-    def warn(self, message: str) -> None:
-        self.log(LogLevel.WARNING, message)
+    def summary(self) -> None:
+        """Print the number of messages omitted for each category and reset counts.
+        Omitted messages were still written to the JSON file."""
+        for category, (level, count) in self._counts.items():
+            if count > self.repeat_limit:
+                self._print(level, f"{count - self.repeat_limit} more '{category}' messages "
+                                   f"omitted ({count} in total)")
+        self._counts.clear()
 
-    def error(self, message: str) -> None:
-        self.log(LogLevel.ERROR, message)
+    def _print(self, level: LogLevel, message: str) -> None:
+        print(f"{level.name.upper()}: {message}", file=self.file)
 
-    def log(self, level: LogLevel, message: str) -> None:
-        if level <= self.level:
-            print(f"{level.name.upper()}: {message}", file=self.file)
+    def _write_json(self, level: LogLevel, message: str, **fields: Any) -> None:
+        if self.json_file:
+            record = {"level": level.name.lower(), "message": message}
+            record.update((k, v) for k, v in fields.items() if v is not None)
+            self.json_file.write(json.dumps(record) + "\n")
+            self.json_file.flush()
@@ -23,22 +23,34 @@
 # $ ./midi_convert.py --help
 
 import argparse
+import contextlib
+import io
 import math
 import os
+import shlex
 import sys
+import time
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import List, Dict, Tuple, TextIO, Optional, NoReturn
+from typing import List, Dict, Tuple, Optional, NoReturn, Union, Any, Callable, IO, \
+    ContextManager
 
 from mido import MidiFile
 
 from logger import LogLevel, Logger
-from music_data import BuzzerMusic, BuzzerNote, ChannelSpec
+from midi_notes import MidiEventMap, iter_note_changes
+from music_data import BuzzerMusic, BuzzerNote, BuzzerTrack, ChannelSpec, BuzzerMusicBank, \
+    CompiledChannelSpecs
+from octave_fit import MAX_OCTAVE_ADJUST, get_note_histograms, fit_octaves, split_octaves
+from output_formats import write_c_header, write_multi_c_header, write_asm_include, \
+    write_asm_header, write_intel_hex
+from tempo_search import get_note_spans, get_midi_seconds, get_candidate_tempos, \
+    score_tempos, find_tempo
 from track_strategy import AutoTrackStrategy, OptimizeSizeTrackStrategy, \
     OptimizeChannelsTrackStrategy, ClosestTrackStrategy, ClosestAverageTrackStrategy, \
     FirstFitTrackStrategy, RandomTrackStrategy, FramesNotes, TrackStrategy, TrackStrategyFailError
-from tracks_to_wav import create_wav_file
+from tracks_to_wav import create_wav_file, write_raw_samples, get_wav_frame_rate, SeekIndex
 
 # Additional configuration parameters
 # =============================
@@ -68,17 +80,35 @@ PREDEFINED_CHANNEL_SPECS = {
     "atmega328p_split": "11,61,62500;-;0,72,250e3;-;23,72,125e3;-",
 }
 
-MidiEventMap = Dict[int, List[Tuple[int, any]]]
+# time resolutions that can be used for buzzer music, in ticks per beat.
+RESOLUTIONS = [16, 8, 4, 2, 1]
+
 MidiTempoMap = Dict[int, int]
+# tempo in us/beat by frame at which it starts, the first being at frame 0.
+TempoChanges = List[Tuple[int, float]]
+
+
+@dataclass
+class MidiData:
+    """MIDI file data used for conversion."""
+    ticks_per_beat: int
+    track_count: int
+    event_map: MidiEventMap
+    tempo_map: MidiTempoMap
+
 
 parser = argparse.ArgumentParser(description="Convert MIDI file to buzzer music format",
                                  formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument("input_file", type=str, help="Input MIDI file")
+parser.add_argument("input_file", type=str, help="Input MIDI file (- for stdin)")
 parser.add_argument("output_file", type=str, default="-", nargs="?",
-                    help="Output buzzer music data (- for stdout)")
+                    help="Output buzzer music data (- for stdout, &N for file descriptor N)")
 parser.add_argument("-l", "--log", type=str, help="Log level (off | error | warning | info)",
                     choices=[v.name.lower() for v in LogLevel],
                     default=LogLevel.INFO.name.lower(), dest="log_level")
+parser.add_argument("-L", "--log-json", type=str,
+                    help="Also write all log messages to a file as JSON lines, regardless of\n"
+                         "the log level and including repeated messages",
+                    dest="log_json_file", default=None)
 parser.add_argument("-s", "--strategy", type=str,
                     help=
                     "Track note assignment strategy:\n"
@@ -96,6 +126,30 @@ parser.add_argument("-t", "--tempo", type=int,
                     help="Tempo override in BPM.\n"
                          "Note that this only affects the encoded tempo, not the actual tempo "
                          "of the music.", dest="tempo")
+parser.add_argument("-v", "--variable-tempo", action="store_true",
+                    help="Encode tempo changes instead of using the highest tempo for the whole\n"
+                         "file, with each part quantized at its own tempo. Can't be used with a\n"
+                         "tempo override. Requires an implementation built with\n"
+                         "MUSIC_TEMPO_CHANGES enabled.",
+                    dest="variable_tempo")
+parser.add_argument("-T", "--tempo-search", type=float,
+                    help="Search for the tempo giving the smallest data size for which note\n"
+                         "boundaries are moved by at most MAX_ERROR ms when quantized to ticks.\n"
+                         "Notes shorter than a tick are dropped and count as moved by their\n"
+                         "duration. Can't be used with a tempo override or variable tempo.",
+                    dest="tempo_search", metavar="MAX_ERROR", default=None)
+parser.add_argument("-R", "--resolution", type=str,
+                    help="Time resolution in ticks per beat (16, 8, 4, 2 or 1, default is 16).\n"
+                         "Coarser resolutions make durations shorter to encode and the music\n"
+                         "loop run less often. Note boundaries not falling on a tick are moved\n"
+                         "to the nearest one. Use 'auto' for the coarsest resolution at which\n"
+                         "note boundaries fall on ticks and tempo can be encoded.",
+                    choices=["auto"] + [str(r) for r in RESOLUTIONS],
+                    dest="resolution", default=str(RESOLUTIONS[0]))
+parser.add_argument("-E", "--resolution-tolerance", type=float,
+                    help="Percentage of note boundaries allowed not to fall on a tick with\n"
+                         "automatic resolution (default 0%%).",
+                    dest="resolution_tolerance", default=0)
 parser.add_argument("-r", "--range", action="store", type=str,
                     help="Time range to use from MIDI file, in seconds. Default is whole file.\n"
                          "- ':10': first 10 seconds\n"
@@ -124,12 +178,75 @@ parser.add_argument("-m", "--merge-tracks", action="store_true",
 parser.add_argument("-x", "--header", type=str,
                     help="Name of array to output in xxd style C header (otherwise binary)",
                     dest="header_name", default=None)
+parser.add_argument("-f", "--format", type=str,
+                    help="Output format (default is header if array name is given, otherwise\n"
+                         "binary):\n"
+                         "- binary: raw music data\n"
+                         "- header: xxd style C header with one array\n"
+                         "- multi_header: C header with one array per song of music bank,\n"
+                         "  and a table of the song arrays\n"
+                         "- asm: assembler source (.S) with arrays in flash, one per song of\n"
+                         "  music bank, and a table of the song arrays. A C header with the\n"
+                         "  declarations is written next to it, with a .h extension.\n"
+                         "- hex: Intel HEX file, to flash music data directly\n"
+                         "Array name is required for header, multi_header and asm formats.",
+                    choices=["binary", "header", "multi_header", "asm", "hex"],
+                    dest="output_format", default=None)
+parser.add_argument("-X", "--hex-address", type=lambda x: int(x, 0),
+                    help="Base address of music data in Intel HEX file (default is 0)",
+                    dest="hex_address", default=0)
 parser.add_argument("-o", "--octave", type=int, help="Octave adjustment for whole file",
                     dest="octave_adjust", default=0)
+parser.add_argument("-A", "--auto-octave", action="store_true",
+                    help="Adjust the octave of the whole file and of each MIDI track so that all\n"
+                         "notes can be played, staying closest to the original pitch. Tracks are\n"
+                         "preferably moved to notes playable by as many channels as the notes\n"
+                         "they play at once. Can't be used with an octave adjustment.",
+                    dest="auto_octave")
+parser.add_argument("-z", "--optimize-size", action="store_true",
+                    help="Search for the smallest encoding of tracks instead of using\n"
+                         "greedy choices (slower). Output is compatible with all implementations.",
+                    dest="optimal_encoding")
+parser.add_argument("-b", "--backref", action="store_true",
+                    help="Encode repeated sequences of notes as back-references to save space.\n"
+                         "Requires an implementation built with MUSIC_BACKREF enabled.",
+                    dest="backref_encoding")
+parser.add_argument("-a", "--add", type=str, action="append",
+                    help="Additional MIDI file to convert with the same options, can be repeated.\n"
+                         "Output is then a music bank containing all songs, in which identical\n"
+                         "tracks are only stored once. With a C header, song indices are defined\n"
+                         "as <HEADER_NAME>_<FILE NAME>.",
+                    dest="bank_input_files", metavar="FILE", default=[])
 parser.add_argument("-w", "--wav", type=str,
                     help="Output WAV file with simulated result.\n"
-                         "To specify sample width append a ':n' parameter (default is 8-bit)",
+                         "To specify sample width append a ':n' parameter (default is 8-bit).\n"
+                         "A 1-bit sample width gives PWM output, 16-bit gives signed 16-bit samples.\n"
+                         "Use - to write raw mono samples to stdout instead\n"
+                         "(unsigned 8-bit, or signed 16-bit), or &N to write\n"
+                         "the WAV file to file descriptor N (&1 for stdout).",
                     dest="wav_file", default=None)
+parser.add_argument("-B", "--band-limited", action="store_true",
+                    help="Use band-limited synthesis for WAV file, square waves are generated\n"
+                         "without aliasing. Can't be used with PWM output.",
+                    dest="wav_band_limited")
+parser.add_argument("-p", "--wav-range", action="store", type=str,
+                    help="Time range of music to output in WAV file, in seconds, using the same\n"
+                         "format as --range. Music before the range isn't rendered.",
+                    dest="wav_time_range")
+parser.add_argument("-j", "--jobs", type=int,
+                    help="Number of processes used to render WAV file (default is 1).",
+                    dest="jobs", default=1)
+parser.add_argument("-W", "--watch", action="store_true",
+                    help="Convert again each time an input file or the options file changes,\n"
+                         "only redoing the conversion steps affected by the change.",
+                    dest="watch")
+parser.add_argument("-O", "--options-file", type=str,
+                    help="File containing additional options, read again on each conversion\n"
+                         "in watch mode.",
+                    dest="options_file", default=None)
+
+# interval at which files are checked for changes in watch mode, in seconds.
+WATCH_INTERVAL = 0.2
 
 
 def bpm_to_beat_us(bpm: float) -> float:
@@ -164,47 +281,130 @@ def parse_note_spec(spec: str) -> int:
     return note
 
 
-def write_c_header(file: TextIO, data: bytes, arr_name: str):
-    """Write C header file containing data array with a name."""
-    file.write('#include "defs.h"\n\n')
-    file.write(f"static _FLASH uint8_t {arr_name}[] = {{\n")
-    for i, b in enumerate(data):
-        if i % 12 == 0:
-            file.write("    ")
-        file.write(f"0x{b:02x},")
-        if i % 12 == 11:
-            file.write("\n")
+def get_frame_time(tempo_changes: TempoChanges, frame: float) -> float:
+    """Get time in seconds at the start of a frame."""
+    time = 0.0
+    for i, (start, tempo) in enumerate(tempo_changes):
+        time_per_frame = tempo / (BuzzerNote.TIMEFRAME_RESOLUTION * 1e6)
+        if i + 1 < len(tempo_changes) and frame > tempo_changes[i + 1][0]:
+            time += (tempo_changes[i + 1][0] - start) * time_per_frame
         else:
-            file.write(" ")
-    if len(data) % 12 != 0:
-        file.write("\n")
-    file.write("};")
+            return time + (frame - start) * time_per_frame
+    return time
+
+
+def get_time_frame(tempo_changes: TempoChanges, time: float) -> float:
+    """Get frame at a time in seconds, not rounded."""
+    start_time = 0.0
+    for i, (start, tempo) in enumerate(tempo_changes):
+        time_per_frame = tempo / (BuzzerNote.TIMEFRAME_RESOLUTION * 1e6)
+        if i + 1 < len(tempo_changes):
+            end_time = start_time + (tempo_changes[i + 1][0] - start) * time_per_frame
+            if time > end_time:
+                start_time = end_time
+                continue
+        return start + (time - start_time) / time_per_frame
+    return 0
+
+
+def parse_time_range(spec: str) -> slice:
+    """Parse time range in seconds, in '<start>:<end>' format (both optional)."""
+    parts = spec.split(":")
+    if len(parts) != 2:
+        raise ValueError("invalid time range")
+    try:
+        start = float(parts[0]) if parts[0] else 0
+        end = float(parts[1]) if parts[1] else None
+        return slice(start, end)
+    except ValueError:
+        raise ValueError("invalid time range")
+
+
+def is_stdout(file: Optional[str]) -> bool:
+    """Whether an output file is the standard output."""
+    return file == "-" or file == "&1"
+
+
+def parse_output_file(file: str) -> str:
+    """Validate output file, which can be a path, - for stdout or &N for file descriptor N."""
+    if file.startswith("&"):
+        try:
+            if int(file[1:]) < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"invalid output file descriptor '{file}'")
+    return file
+
+
+def get_asm_header_file(file: str) -> str:
+    """Get the path of the C header written alongside an assembler output file."""
+    return str(Path(file).with_suffix(".h"))
+
+
+def open_output_file(file: str, binary: bool) -> ContextManager[IO]:
+    """Open output file for writing binary or text data. The standard output and file
+    descriptors are left open when done."""
+    if file == "-":
+        return contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+    elif file.startswith("&"):
+        return os.fdopen(int(file[1:]), "wb" if binary else "w", closefd=False)
+    return open(file, "wb" if binary else "w")
 
 
 class OutputFormat(Enum):
     BINARY = 0
     HEX_HEADER = 1
+    MULTI_HEADER = 2
+    ASM_INCLUDE = 3
+    INTEL_HEX = 4
+
+
+OUTPUT_FORMATS = {
+    "binary": OutputFormat.BINARY,
+    "header": OutputFormat.HEX_HEADER,
+    "multi_header": OutputFormat.MULTI_HEADER,
+    "asm": OutputFormat.ASM_INCLUDE,
+    "hex": OutputFormat.INTEL_HEX,
+}
+
+# output formats in which data is placed in named arrays.
+ARRAY_OUTPUT_FORMATS = [OutputFormat.HEX_HEADER, OutputFormat.MULTI_HEADER,
+                        OutputFormat.ASM_INCLUDE]
 
 
 @dataclass
 class Config:
     input_file: str
+    bank_input_files: List[str]
     output_file: str
     logger: Logger
     strategy_name: str
     tempo: int
     tempo_overriden: bool
+    variable_tempo: bool
+    # maximum timing error in seconds for tempo search, None if not searching.
+    tempo_search: Optional[float]
     octave_adjust: int
+    auto_octave: bool
     merge_midi_tracks: bool
     time_range: Optional[slice]
-    channels_spec: List[ChannelSpec]
+    # ticks per beat, None for automatic resolution.
+    resolution: Optional[int]
+    resolution_tolerance: float
+    channels_spec: CompiledChannelSpecs
     output_format: OutputFormat
     output_header_name: Optional[str]
+    output_hex_address: int
+    optimal_encoding: bool
+    backref_encoding: bool
     output_wav_file: Optional[str]
     output_wav_width: int
+    output_wav_band_limited: bool
+    output_wav_time_range: Optional[slice]
+    jobs: int
 
 
-def parse_channels_spec(spec: str) -> List[ChannelSpec]:
+def parse_channels_spec(spec: str) -> CompiledChannelSpecs:
     if spec in PREDEFINED_CHANNEL_SPECS:
         spec = PREDEFINED_CHANNEL_SPECS[spec]
 
@@ -222,27 +422,33 @@ def parse_channels_spec(spec: str) -> List[ChannelSpec]:
                 raise ValueError(f"invalid channel specification: '{channel_spec}'")
             min_note = parse_note_spec(parts[0])
             max_note = parse_note_spec(parts[1])
-            try:
-                timer_period = round(float(parts[2]))
-                if timer_period <= 0:
-                    raise ValueError
-            except ValueError:
-                raise ValueError(f"invalid channel specification: bad timer period")
+            timer_period = 0
+            if len(parts) == 3:
+                try:
+                    timer_period = round(float(parts[2]))
+                    if timer_period <= 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("invalid channel specification: bad timer period")
             specs.append(ChannelSpec(range(min_note, max_note + 1), timer_period))
 
-    return specs
+    return CompiledChannelSpecs(specs)
 
 
-def create_config(args: argparse.Namespace) -> Config:
-    """Validate input arguments and create typed configuration object."""
-    input_path = Path(args.input_file)
-    if not input_path.exists() or not input_path.is_file():
-        raise ValueError("input file doesn't exist")
+def create_config(args: argparse.Namespace, log_json_file: Optional[IO] = None) -> Config:
+    """Validate input arguments and create typed configuration object. The JSON log file
+    is opened by the caller (see open_log_json_file), so that it's kept between conversions."""
+    input_files = [args.input_file] + args.bank_input_files
+    for input_file in input_files:
+        if input_file == "-":
+            continue
+        input_path = Path(input_file)
+        if not input_path.exists() or not input_path.is_file():
+            raise ValueError(f"input file '{input_file}' doesn't exist")
+    if input_files.count("-") > 1:
+        raise ValueError("only one input file can be read from stdin")
 
-    # logging
-    log_level = next((e for e in LogLevel if e.name.lower() == args.log_level))
-    log_file = sys.stderr if args.output_file == "-" else sys.stdout
-    logger = Logger(log_file, log_level)
+    output_file = parse_output_file(args.output_file)
 
     # tempo
     tempo_us = 0
@@ -255,23 +461,49 @@ def create_config(args: argparse.Namespace) -> Config:
             raise ValueError(f"tempo override out of bounds "
                              f"(between {tempo_min} and {tempo_max} BPM)")
         tempo_us = bpm_to_beat_us(tempo_bpm)
+        if args.variable_tempo:
+            raise ValueError("tempo override can't be used with variable tempo")
+    tempo_search = None
+    if args.tempo_search is not None:
+        if tempo_overriden or args.variable_tempo:
+            raise ValueError("tempo search can't be used with tempo override or variable tempo")
+        if args.tempo_search < 0:
+            raise ValueError("tempo search maximum error can't be negative")
+        tempo_search = args.tempo_search * 1e-3
+
+    if args.auto_octave and args.octave_adjust:
+        raise ValueError("octave adjustment can't be used with automatic octave")
 
     # time range
     time_range: Optional[slice] = None
     if args.time_range:
-        parts = args.time_range.split(":")
-        if len(parts) != 2:
-            raise ValueError("invalid time range")
-        try:
-            start = float(parts[0]) if parts[0] else 0
-            end = float(parts[1]) if parts[1] else None
-            time_range = slice(start, end)
-        except ValueError:
-            raise ValueError("invalid time range")
+        time_range = parse_time_range(args.time_range)
+    wav_time_range: Optional[slice] = None
+    if args.wav_time_range:
+        wav_time_range = parse_time_range(args.wav_time_range)
 
     channels_spec = parse_channels_spec(args.channels)
 
-    output_format = OutputFormat.HEX_HEADER if args.header_name else OutputFormat.BINARY
+    resolution = None if args.resolution == "auto" else int(args.resolution)
+    if not (0 <= args.resolution_tolerance <= 100):
+        raise ValueError("resolution tolerance must be between 0 and 100%")
+
+    if args.output_format:
+        output_format = OUTPUT_FORMATS[args.output_format]
+    else:
+        output_format = OutputFormat.HEX_HEADER if args.header_name else OutputFormat.BINARY
+    if output_format in ARRAY_OUTPUT_FORMATS and not args.header_name:
+        raise ValueError(f"array name is required for {args.output_format} output format")
+    if output_format not in ARRAY_OUTPUT_FORMATS and args.header_name:
+        raise ValueError(f"array name can't be used with {args.output_format} output format")
+    if output_format == OutputFormat.ASM_INCLUDE:
+        if output_file == "-" or output_file.startswith("&"):
+            raise ValueError("asm output format needs an output file, to write its C header")
+        if get_asm_header_file(output_file) == output_file:
+            raise ValueError("asm output file can't have a .h extension, "
+                             "it's used for its C header")
+    if args.hex_address < 0:
+        raise ValueError("Intel HEX base address can't be negative")
 
     # WAV file specification
     wav_file = args.wav_file
@@ -286,63 +518,210 @@ def create_config(args: argparse.Namespace) -> Config:
                 raise ValueError("invalid WAV file sample width")
         elif len(parts) != 1:
             raise ValueError("invalid WAV file sample width specification")
+        if wav_width == 1 and args.wav_band_limited:
+            raise ValueError("band-limited synthesis can't be used with PWM WAV output")
+        wav_file = parse_output_file(wav_file)
+        if is_stdout(wav_file) and is_stdout(output_file) or wav_file == output_file:
+            raise ValueError("music data and WAV samples can't both be output to the same file")
 
-    return Config(args.input_file, args.output_file, logger, args.track_strategy, tempo_us,
-                  tempo_overriden, args.octave_adjust, args.merge_midi_tracks, time_range,
-                  channels_spec, output_format, args.header_name, wav_file, wav_width)
+    # logging
+    log_level = next((e for e in LogLevel if e.name.lower() == args.log_level))
+    log_file = sys.stderr if is_stdout(output_file) or is_stdout(wav_file) else sys.stdout
+    logger = Logger(log_file, log_level, log_json_file)
+
+    if args.jobs < 1:
+        raise ValueError("number of jobs must be at least 1")
+    if args.watch and any(file and (file == "-" or file.startswith("&"))
+                          for file in input_files + [output_file, wav_file]):
+        raise ValueError("standard streams and file descriptors aren't supported in watch mode")
+
+    return Config(args.input_file, args.bank_input_files, output_file, logger,
+                  args.track_strategy, tempo_us, tempo_overriden, args.variable_tempo,
+                  tempo_search, args.octave_adjust, args.auto_octave,
+                  args.merge_midi_tracks, time_range, resolution,
+                  args.resolution_tolerance / 100, channels_spec, output_format,
+                  args.header_name, args.hex_address, args.optimal_encoding,
+                  args.backref_encoding, wav_file, wav_width, args.wav_band_limited,
+                  wav_time_range, args.jobs)
+
+
+class StageCache:
+    """Result of each conversion stage with the inputs it was computed from, so that a stage
+    is only computed again if its inputs changed (used in watch mode)."""
+    _entries: Dict[str, Tuple[Any, Any]]
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, stage: str, key: Any, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Get stage result if key is unchanged or compute it, also returning whether it
+        was reused."""
+        entry = self._entries.get(stage)
+        if entry is not None and entry[0] == key:
+            return entry[1], True
+        # remove previous result first, so that it can be freed during computation.
+        self._entries.pop(stage, None)
+        value = compute()
+        self._entries[stage] = (key, value)
+        return value, False
+
+    def remove(self, stage: str) -> None:
+        self._entries.pop(stage, None)
 
 
 class MidiConverter:
     """Class used to interpret configuration and output data and WAV file for buzzer music."""
     config: Config
     logger: Logger
+    cache: StageCache
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, cache: Optional[StageCache] = None):
         self.config = config
         self.logger = config.logger
+        self.cache = cache if cache is not None else StageCache()
 
     def convert(self) -> None:
+        try:
+            self._convert()
+        finally:
+            self.logger.summary()
+
+    def _convert(self) -> None:
         config = self.config
-        midi = MidiFile(config.input_file, clip=True)
+        buzzer_music = self._convert_midi_file(config.input_file, 0)
+
+        if config.bank_input_files:
+            # convert all other files and put all songs in a music bank
+            songs = [buzzer_music]
+            for i, input_file in enumerate(config.bank_input_files):
+                songs.append(self._convert_midi_file(input_file, i + 1))
+            bank = BuzzerMusicBank(songs)
+            self._write_output_file(bank, self._get_bank_defines(), songs)
+        else:
+            out_size = self._write_output_file(buzzer_music)
+            self.logger.info("total data size is %d bytes", out_size)
+
+        # write output WAV
+        if config.bank_input_files and config.output_wav_file:
+            self.logger.info("WAV file is only created for first song in music bank")
+        self._create_wav_file(buzzer_music)
+
+        self.logger.info("done")
 
+    def _convert_midi_file(self, input_file: str, index: int) -> BuzzerMusic:
+        """Create buzzer music from a MIDI file, with an index in music bank."""
+        config = self.config
+        song = ""
+        if config.bank_input_files:
+            self.logger.info("converting '%s'", input_file)
+            song = f" of song {index}"
+        # each stage is only done again if the inputs it depends on changed.
+        # stdin is only read once, the watch mode isn't supported with it.
+        file_key: Tuple = (input_file,)
+        if input_file != "-":
+            stat = os.stat(input_file)
+            file_key = (input_file, stat.st_mtime_ns, stat.st_size)
+        midi_data = self._cached(f"MIDI events{song}", file_key,
+                                 lambda: self.parse_midi_file(input_file))
+        frames_key = (file_key, config.tempo, config.tempo_overriden, config.variable_tempo,
+                      config.tempo_search, config.octave_adjust, config.time_range,
+                      tuple(config.channels_spec) if config.auto_octave else None)
+        tempo_changes, frames_notes = self._cached(f"frames{song}", frames_key,
+                                                   lambda: self.get_frames_notes(midi_data))
+        music_key = (frames_key, tuple(config.channels_spec), config.strategy_name,
+                     config.merge_midi_tracks, config.resolution, config.resolution_tolerance)
+        return self._cached(f"tracks{song}", music_key,
+                            lambda: self.create_music(tempo_changes, frames_notes))
+
+    def _cached(self, stage: str, key: Any, compute: Callable[[], Any]) -> Any:
+        """Get result of a conversion stage from cache if key is unchanged, or compute it."""
+        value, reused = self.cache.get(stage, key, compute)
+        if reused:
+            self.logger.info("%s unchanged, reusing previous result", stage, category="reused stage")
+        return value
+
+    def parse_midi_file(self, input_file: str) -> MidiData:
+        """Read MIDI file and build its event map and tempo map.
+        The result doesn't depend on configuration."""
+        if input_file == "-":
+            # stdin can't be seeked, read it into memory once.
+            midi = MidiFile(file=io.BytesIO(sys.stdin.buffer.read()), clip=True)
+        else:
+            midi = MidiFile(input_file, clip=True)
         track_count = len(midi.tracks)
         event_map = self._build_event_map(midi)
-        self.logger.info(f"event map built, {len(event_map)} events in {track_count} tracks")
-
-        # get tempo info
+        self.logger.info("event map built, %d events in %d tracks", len(event_map), track_count)
         tempo_map = self._get_tempo_map(event_map)
-        tempo = self._get_overall_tempo(event_map, tempo_map)
+        return MidiData(midi.ticks_per_beat, track_count, event_map, tempo_map)
+
+    def get_frames_notes(self, midi_data: MidiData) -> Tuple[TempoChanges, FramesNotes]:
+        """Get tempo changes and notes played in each frame from parsed MIDI file.
+        The result only depends on the tempo, octave adjustment and time range, and on the
+        channels spec with automatic octave."""
+        event_map = midi_data.event_map
+        ticks_per_beat = midi_data.ticks_per_beat
 
         # create note frames for entire duration
         midi_duration = max(event_map.keys())
-        midi_duration_sec = midi_duration / midi.ticks_per_beat * tempo / 1e6
-        frames = self._get_all_frames(tempo_map, tempo, midi_duration, midi.ticks_per_beat)
-        self.logger.info(f"frames time computed, got {len(frames)} frames")
+        if self.config.variable_tempo:
+            # frames are 1/16th of a beat at the tempo in effect.
+            tempo_changes = self._get_tempo_changes(midi_data.tempo_map, ticks_per_beat)
+            frames_count = math.ceil(midi_duration * BuzzerNote.TIMEFRAME_RESOLUTION /
+                                     ticks_per_beat)
+            frames = [round(i * ticks_per_beat / BuzzerNote.TIMEFRAME_RESOLUTION)
+                      for i in range(frames_count)]
+        else:
+            if self.config.tempo_search is not None:
+                tempo = self._search_tempo(midi_data)
+            else:
+                tempo = self._get_overall_tempo(event_map, midi_data.tempo_map)
+            tempo_changes = [(0, tempo)]
+            frames = self._get_all_frames(midi_data.tempo_map, tempo, midi_duration,
+                                          ticks_per_beat)
+        midi_duration_sec = get_frame_time(
+            tempo_changes, midi_duration / ticks_per_beat * BuzzerNote.TIMEFRAME_RESOLUTION)
+        self.logger.info("frames time computed, got %d frames", len(frames))
 
         # get notes played in each frame, for each MIDI track
-        frames_notes = self._get_frame_notes(event_map, frames, track_count)
-        frames_notes = self._apply_time_range(frames_notes, tempo, midi_duration_sec)
+        if self.config.auto_octave:
+            octaves = self._fit_octaves(midi_data)
+        else:
+            octaves = [self.config.octave_adjust] * midi_data.track_count
+        frames_notes = self._get_frame_notes(event_map, frames, octaves)
+        return self._apply_time_range(frames_notes, tempo_changes, midi_duration_sec)
+
+    def create_music(self, tempo_changes: TempoChanges, frames_notes: FramesNotes) -> BuzzerMusic:
+        """Create buzzer music from frames notes."""
+        config = self.config
 
         # do some validation before applying track assignment strategy
         channels_count = len(config.channels_spec)
-        self._check_max_notes_at_once(frames_notes, channels_count, tempo)
-        self._verify_note_range(frames_notes, tempo)
+        self._check_max_notes_at_once(frames_notes, channels_count, tempo_changes)
+        self._verify_note_range(frames_notes, tempo_changes)
 
         # create buzzer music from frames notes
-        # buzzer music will use average tempo since multiple tempos aren't supported
-        self.logger.info(f"using '{config.strategy_name}' strategy")
-        buzzer_music = self._create_buzzer_music(tempo, frames_notes)
+        self.logger.info("using '%s' strategy", config.strategy_name)
+        buzzer_music = self._create_buzzer_music(tempo_changes, frames_notes)
+        buzzer_music = self._apply_resolution(buzzer_music, tempo_changes,
+                                              len(frames_notes[0]))
         channels_nums = (str(t.channel) for t in buzzer_music.tracks)
-        self.logger.info(f"buzzer music uses channels {', '.join(channels_nums)}")
-
-        # write output data
-        out_size = self._write_output_file(buzzer_music)
-        self.logger.info(f"total data size is {out_size} bytes")
-
-        # write output WAV
-        self._create_wav_file(buzzer_music)
+        self.logger.info("buzzer music uses channels %s", ", ".join(channels_nums))
+        return buzzer_music
 
-        self.logger.info("done")
+    def _get_bank_defines(self) -> Dict[str, int]:
+        """Get song index defines for music bank, named after input files."""
+        config = self.config
+        prefix = (config.output_header_name or "").upper()
+        defines = {f"{prefix}_SONG_COUNT": len(config.bank_input_files) + 1}
+        for i, input_file in enumerate([config.input_file] + config.bank_input_files):
+            stem = "stdin" if input_file == "-" else Path(input_file).stem
+            name = "".join(c if c.isalnum() else "_" for c in stem).upper()
+            name = f"{prefix}_{name}"
+            if name in defines:
+                name = f"{name}_{i}"
+            defines[name] = i
+            self.logger.info("song '%s' has index %d", input_file, i)
+        return defines
 
     def _abort(self, message: Optional[str] = None) -> NoReturn:
         if message:
@@ -369,8 +748,8 @@ class MidiConverter:
         """Get overall tempo for buzzer music in us/beat."""
         if self.config.tempo_overriden:
             tempo = self.config.tempo
-            self.logger.info(f"tempo map built, using tempo override of "
-                             f"{beat_us_to_bpm(tempo):.0f} BPM")
+            self.logger.info("tempo map built, using tempo override of %.0f BPM",
+                             beat_us_to_bpm(tempo))
         else:
             # average tempo doesn't work great, short pauses between notes are missed
             # using highest tempo (in BPM) works better but data size increaes.
@@ -378,8 +757,37 @@ class MidiConverter:
             # midi_duration = max(event_map.keys())
             # tempo = self._get_average_tempo(tempo_map, midi_duration)
             if len(tempo_map) > 2:
-                self.logger.warn("file has variable tempo, highest tempo will be used.")
-            self.logger.info(f"tempo map built, highest tempo is {beat_us_to_bpm(tempo):.0f} BPM")
+                self.logger.warn("file has variable tempo, highest tempo will be used "
+                                 "(consider using variable tempo).")
+            self.logger.info("tempo map built, highest tempo is %.0f BPM", beat_us_to_bpm(tempo))
+        return tempo
+
+    def _search_tempo(self, midi_data: MidiData) -> float:
+        """Get tempo in us/beat giving the smallest estimated data size within the maximum
+        timing error, by scoring all encodable tempos."""
+        max_error = self.config.tempo_search
+        starts, ends, tracks = get_note_spans(midi_data.event_map, midi_data.track_count)
+        starts, ends = (get_midi_seconds(midi_data.tempo_map, midi_data.ticks_per_beat, times)
+                        for times in (starts, ends))
+        midi_tempo = min(midi_data.tempo_map.values())
+        tempos = get_candidate_tempos(midi_tempo)
+        scores = score_tempos(starts, ends, tracks, tempos)
+        best = find_tempo(scores, max_error)
+        if best is None:
+            self._abort(f"no tempo found with a timing error of at most {max_error * 1e3:g} ms, "
+                        f"smallest is {scores.max_error.min() * 1e3:.1f} ms")
+
+        # compare with the highest tempo used otherwise.
+        highest = BuzzerMusic.encode_beat_us_tempo(midi_tempo)
+        highest = min(max(highest, 0), len(tempos) - 1)
+        tempo = float(tempos[best])
+        self.logger.info("tempo search done, %d of %d tempos within %g ms, using %.0f BPM "
+                         "(max error %.1f ms, mean error %.1f ms, %d notes dropped)",
+                         scores.within(max_error).sum(), len(tempos), max_error * 1e3,
+                         beat_us_to_bpm(tempo), scores.max_error[best] * 1e3,
+                         scores.mean_error[best] * 1e3, scores.dropped_notes[best])
+        self.logger.info("estimated size is %d bytes, instead of %d bytes at highest tempo",
+                         scores.size[best], scores.size[highest])
         return tempo
 
     def _get_tempo_map(self, event_map: MidiEventMap) -> MidiTempoMap:
@@ -391,6 +799,22 @@ class MidiConverter:
                 tempo_map[time] = tempo_event.tempo
         return tempo_map
 
+    def _get_tempo_changes(self, tempo_map: MidiTempoMap, ticks_per_beat: int) -> TempoChanges:
+        """Get tempo changes from tempo map for frames of 1/16th of a beat. Changes are moved
+        to the nearest frame, the last one is used if several changes fall on the same frame."""
+        tempo_changes: TempoChanges = []
+        for time, tempo in sorted(tempo_map.items()):
+            frame = round(time * BuzzerNote.TIMEFRAME_RESOLUTION / ticks_per_beat)
+            if tempo_changes and tempo_changes[-1][0] == frame:
+                tempo_changes[-1] = (frame, tempo)
+            elif not tempo_changes or tempo_changes[-1][1] != tempo:
+                tempo_changes.append((frame, tempo))
+        tempos = [tempo for _, tempo in tempo_changes]
+        self.logger.info("tempo map built, %d tempo changes, from %.0f to %.0f BPM",
+                         len(tempo_changes) - 1, beat_us_to_bpm(max(tempos)),
+                         beat_us_to_bpm(min(tempos)))
+        return tempo_changes
+
     def _get_average_tempo(self, tempo_map: MidiTempoMap, midi_duration: int) -> float:
         """Get weighted average of tempo in map, by tempo duration."""
         avg_tempo = 0
@@ -423,46 +847,41 @@ class MidiConverter:
         return frames
 
     def _get_frame_notes(self, event_map: MidiEventMap, frames: List[int],
-                         track_count: int) -> FramesNotes:
-        """Get all notes being played on each frame and in between frames, for each MIDI track.
-        detect when notes go on and off during same frame to prevent omitting notes."""
+                         octaves: List[int]) -> FramesNotes:
+        """Get all notes being played on each frame and in between frames, for each MIDI track,
+        with the octave adjustment of each track.
+        detect when notes go on and off during same frame, these notes are omitted."""
+        track_count = len(octaves)
         timelines: FramesNotes = [[] for _ in range(track_count)]
         notes_on: List[List[int]] = [[] for _ in range(track_count)]
-        new_notes_on = set()
+        changes = iter_note_changes(event_map, track_count)
+        change = next(changes, None)
         for i, frame in enumerate(frames):
-            events = list(event_map.get(frame, []))
+            # also apply all changes in between this frame and the next,
+            # in order to not miss any events
+            end = frame + 1
             if i != len(frames) - 1:
-                # also get all events in between this frame and the next,
-                # in order to not miss any events
-                for j in range(frame + 1, frames[i + 1]):
-                    events += event_map.get(j, [])
+                end = max(end, frames[i + 1])
 
             # update list of notes on per track
-            for track_num, event in events:
-                notes_on_track = notes_on[track_num]
-                new_notes_on.clear()
-                if event.type == "note_on" or event.type == "note_off":
-                    note = event.note + self.config.octave_adjust * 12
-                    if event.type == "note_on" and note not in notes_on_track:
-                        # start playing note
-                        # if note_on event and note is already being played, interpret as note_off (?).
-                        notes_on_track.append(note)
-                        new_notes_on.add(note)
-                    else:
-                        if note in new_notes_on:
-                            # note went on during this frame, and off again! that means note is
-                            # shorter than 1/16th of a quarter note in overall tempo.
-                            # lengthen note to last the whole frame instead of not registering it
-                            self.logger.warn(f"note {note} at frame {frame} goes on and off "
-                                             f"during same frame. Increasing note duration "
-                                             f"(consider overriding tempo).")
-                        else:
-                            if note not in notes_on_track:
-                                # self.logger.info(f"note {event.note} already off "
-                                #                  f"at MIDI time {frame}")
-                                pass
-                            else:
-                                notes_on_track.remove(note)
+            new_notes_on = set()
+            while change is not None and change[0] < end:
+                _, track_num, note, on = change
+                note += octaves[track_num] * 12
+                if on:
+                    notes_on[track_num].append(note)
+                    new_notes_on.add((track_num, note))
+                else:
+                    if (track_num, note) in new_notes_on:
+                        # note went on during this frame, and off again! that means note is
+                        # shorter than 1/16th of a quarter note in overall tempo.
+                        # formatted only if logged, repeated warnings are summarized.
+                        self.logger.warn("note %d at frame %d goes on and off during "
+                                         "same frame and is omitted (consider "
+                                         "overriding tempo).", note, i,
+                                         category="short note")
+                    notes_on[track_num].remove(note)
+                change = next(changes, None)
 
             # save notes for frame
             for j, timeline in enumerate(timelines):
@@ -470,8 +889,24 @@ class MidiConverter:
 
         return timelines
 
-    def _apply_time_range(self, frames_notes: FramesNotes,
-                          tempo: float, midi_duration_sec: float) -> FramesNotes:
+    def _fit_octaves(self, midi_data: MidiData) -> List[int]:
+        """Get octave adjustment of each MIDI track from note histograms so that all notes
+        can be played, closest to the original pitch."""
+        histograms, max_notes = get_note_histograms(midi_data.event_map, midi_data.track_count)
+        octaves = fit_octaves(histograms, max_notes, self.config.channels_spec)
+        if octaves is None:
+            self._abort(f"can't convert, no octave adjustment of at most {MAX_OCTAVE_ADJUST} "
+                        f"octaves makes all notes playable")
+        global_octave, track_octaves = split_octaves(histograms, octaves)
+        self.logger.info("octave adjustment is %+d for whole file", global_octave)
+        for i, octave in enumerate(track_octaves):
+            if octave:
+                self.logger.info("octave adjustment is %+d more for MIDI track %d", octave, i,
+                                 category="track octave")
+        return octaves
+
+    def _apply_time_range(self, frames_notes: FramesNotes, tempo_changes: TempoChanges,
+                          midi_duration_sec: float) -> Tuple[TempoChanges, FramesNotes]:
         if self.config.time_range:
             nframes = len(frames_notes[0])
             start = self.config.time_range.start
@@ -489,22 +924,27 @@ class MidiConverter:
             elif end < 0:
                 end += midi_duration_sec
 
-            time_per_frame = tempo / (BuzzerNote.TIMEFRAME_RESOLUTION * 1e6)
-            frame_first = round(start / time_per_frame)
-            frame_last = round(end / time_per_frame) + 1
+            frame_first = round(get_time_frame(tempo_changes, start))
+            frame_last = round(get_time_frame(tempo_changes, end)) + 1
             if frame_last < frame_first:
                 self._abort(f"invalid time slice with end time before start time")
             if frame_first > nframes:
                 self._abort(f"invalid time slice starting after file end")
             if frame_last > nframes:
                 frame_last = nframes
-            self.logger.info(f"time slice from {start:.1f} s to {end:.1f} s, "
-                             f"keeping {frame_last - frame_first} frames")
-            return [notes[frame_first:frame_last] for notes in frames_notes]
-        return frames_notes
+            self.logger.info("time slice from %.1f s to %.1f s, keeping %d frames",
+                             start, end, frame_last - frame_first)
+            # tempo in effect at the first frame is used from the start.
+            tempo = next(tempo for frame, tempo in reversed(tempo_changes)
+                         if frame <= frame_first)
+            tempo_changes = [(0, tempo)] + [(frame - frame_first, tempo)
+                                            for frame, tempo in tempo_changes
+                                            if frame > frame_first]
+            return tempo_changes, [notes[frame_first:frame_last] for notes in frames_notes]
+        return tempo_changes, frames_notes
 
     def _check_max_notes_at_once(self, frames_notes: FramesNotes,
-                                 channels_count: int, tempo: float) -> None:
+                                 channels_count: int, tempo_changes: TempoChanges) -> None:
         """Check if maximum number of notes played at once in all tracks combined is
         less or equal to the number of channels."""
         nframes = len(frames_notes[0])
@@ -513,57 +953,57 @@ class MidiConverter:
         if max_notes > channels_count:
             # more notes played at once than channels available.
             # give some info on time of occurence in file.
-            time = (notes_per_frame.index(max_notes) /
-                    (BuzzerNote.TIMEFRAME_RESOLUTION * 1e6) * tempo)
+            time = get_frame_time(tempo_changes, notes_per_frame.index(max_notes))
             self._abort(f"can't convert, up to {max_notes} notes played at once "
                         f"(at around {time:.1f} s, only {channels_count} channels available)")
         else:
-            self.logger.info(f"file has at most {max_notes} notes played at once")
+            self.logger.info("file has at most %d notes played at once", max_notes)
 
-    def _verify_note_range(self, frames_notes: FramesNotes, tempo: float) -> None:
+    def _verify_note_range(self, frames_notes: FramesNotes,
+                           tempo_changes: TempoChanges) -> None:
         """Check that no note in file exceeds the largest timer range and
         give some information on notes and timing if bad notes found."""
-        bad_notes = 0
+        found_bad_note = False
         last_bad_note = -1
+        playable = self.config.channels_spec.playable
         for track_notes in frames_notes:
             for i, frame_notes in enumerate(track_notes):
                 for j, note in enumerate(frame_notes):
-                    track_found = False
-                    for spec in self.config.channels_spec:
-                        if BuzzerNote.from_midi(note) in spec.note_range:
-                            track_found = True
-                            break
+                    # note may be out of MIDI range after octave adjustment.
+                    track_found = 0 <= note < len(playable) and playable[note]
                     if not track_found and note != last_bad_note:
                         # bad note, give some info on it
-                        # given time is approximate since based on overall tempo.
-                        time = i / (BuzzerNote.TIMEFRAME_RESOLUTION * 1e6) * tempo
-                        self.logger.error(f"can't convert, found note {format_midi_note(note)} "
-                                          f"exceeding timer range (at around {time:.1f} s)")
-                        bad_notes += 1
+                        # given time is approximate since based on encoded tempo.
+                        time = get_frame_time(tempo_changes, i)
+                        self.logger.error("can't convert, found note %s exceeding timer range "
+                                          "(at around %.1f s)", format_midi_note(note), time,
+                                          category="note out of range")
+                        found_bad_note = True
                         last_bad_note = note
-                        if bad_notes >= 8:
-                            self._abort("(yet more notes exceeding range found)")
-        if bad_notes > 0:
+        if found_bad_note:
             self._abort()
 
     def _get_encoded_tempo(self, tempo: float) -> int:
         """Encode tempo from us/beat to byte used by buzzer music format."""
         if tempo < BuzzerMusic.TEMPO_MAX:
-            self.logger.warn(f"tempo value is too high to be encoded ({beat_us_to_bpm(tempo)}), "
-                             f"consider overriding it")
+            self.logger.warn("tempo value is too high to be encoded (%s), consider overriding it",
+                             beat_us_to_bpm(tempo), category="unencodable tempo")
             return 0
         elif tempo > BuzzerMusic.TEMPO_MIN:
-            self.logger.warn(f"tempo value is too low to be encoded ({bpm_to_beat_us(tempo)}), "
-                             f"consider overriding it")
+            self.logger.warn("tempo value is too low to be encoded (%s), consider overriding it",
+                             beat_us_to_bpm(tempo), category="unencodable tempo")
             return 255
         else:
             return BuzzerMusic.encode_beat_us_tempo(tempo)
 
-    def _create_buzzer_music(self, tempo: float, frames_notes: FramesNotes) -> BuzzerMusic:
+    def _create_buzzer_music(self, tempo_changes: TempoChanges,
+                             frames_notes: FramesNotes) -> BuzzerMusic:
         """Create buzzer music from frames notes using specified strategy."""
         # create empty buzzer music with set tempo
-        encoded_tempo = self._get_encoded_tempo(tempo)
-        music = BuzzerMusic(encoded_tempo)
+        music = BuzzerMusic(0)
+        self._set_music_tempo(music, tempo_changes, len(frames_notes[0]))
+        if music.tempo_changes:
+            self.logger.info("buzzer music has %d tempo changes", len(music.tempo_changes))
 
         # use specified strategy to create buzzer tracks from frames notes
         track_strategy = TRACK_STRATEGIES[self.config.strategy_name]
@@ -578,67 +1018,329 @@ class MidiConverter:
         music.tracks = tracks
         return music
 
-    def _write_output_file(self, music: BuzzerMusic) -> int:
-        """Output data file from buzzer music."""
+    def _set_music_tempo(self, music: BuzzerMusic, tempo_changes: TempoChanges,
+                         frames_count: int, factor: int = 1) -> None:
+        """Set encoded tempo and tempo changes of buzzer music, for ticks lasting a number of
+        frames. Changes to the same encoded tempo and changes after the last frame are dropped."""
+        music.tempo = self._get_encoded_tempo(tempo_changes[0][1] * factor)
+        music.tempo_changes = []
+        for frame, tempo in tempo_changes[1:]:
+            encoded_tempo = self._get_encoded_tempo(tempo * factor)
+            last_tempo = music.tempo_changes[-1][1] if music.tempo_changes else music.tempo
+            if frame < frames_count and encoded_tempo != last_tempo:
+                music.tempo_changes.append((frame // factor, encoded_tempo))
+
+    def _apply_resolution(self, music: BuzzerMusic, tempo_changes: TempoChanges,
+                          frames_count: int) -> BuzzerMusic:
+        """Convert buzzer music to the configured time resolution, each tick lasting a number
+        of frames, with the tempo scaled accordingly."""
         config = self.config
+        # note boundaries of all tracks, and tempo changes, in frames.
+        boundaries = set()
+        for track in music.tracks:
+            frame = 0
+            for duration in track.durations:
+                frame += duration + 1
+                boundaries.add(frame)
+        tempo_changes = [(frame, tempo) for frame, tempo in tempo_changes if frame < frames_count]
+        max_tempo = max(tempo for _, tempo in tempo_changes)
+
+        def get_off_tick(factor: int) -> int:
+            return sum(1 for frame in boundaries if frame % factor != 0)
+
+        def is_encodable(factor: int) -> bool:
+            # tempo scaled for ticks lasting a number of frames must be encodable,
+            # otherwise it would be clamped and the music played at the wrong speed.
+            return max_tempo * factor <= BuzzerMusic.TEMPO_MIN
+
+        def is_on_ticks(factor: int) -> bool:
+            # tempo changes must fall on ticks, and tempo must be encodable.
+            return (all(frame % factor == 0 for frame, _ in tempo_changes) and
+                    is_encodable(factor) and
+                    get_off_tick(factor) <= config.resolution_tolerance * len(boundaries))
+
+        if config.resolution is None:
+            resolution = next((r for r in RESOLUTIONS[::-1]
+                               if is_on_ticks(RESOLUTIONS[0] // r)), RESOLUTIONS[0])
+        else:
+            resolution = config.resolution
+        factor = RESOLUTIONS[0] // resolution
+        if factor == 1:
+            if config.resolution is None:
+                self.logger.info("note boundaries need 1/16 beat resolution")
+            return music
+        if any(frame % factor != 0 for frame, _ in tempo_changes):
+            self._abort(f"can't use 1/{resolution} beat resolution, "
+                        f"tempo changes don't fall on ticks")
+        if not is_encodable(factor):
+            self._abort(f"can't use 1/{resolution} beat resolution, tempo is too low to be "
+                        f"encoded ({beat_us_to_bpm(max_tempo):g} BPM, at least "
+                        f"{math.ceil(beat_us_to_bpm(BuzzerMusic.TEMPO_MIN / factor))} BPM "
+                        f"is needed)")
+        off_tick = get_off_tick(factor)
+        if off_tick:
+            self.logger.warn("%d note boundaries moved to the nearest tick for 1/%d beat resolution",
+                             off_tick, resolution)
+
+        scaled = BuzzerMusic(0)
+        self._set_music_tempo(scaled, tempo_changes, frames_count, factor)
+        for track in music.tracks:
+            # notes shorter than a tick after moving boundaries are removed.
+            scaled_track = BuzzerTrack(track.channel, track.spec)
+            start = 0
+            for note, duration in track:
+                end = start + duration + 1
+                scaled_track.add_run(note, round(end / factor) - round(start / factor))
+                start = end
+            scaled_track.finalize()
+            scaled.tracks.append(scaled_track)
 
-        # encode buzzer music
         try:
-            data = music.encode()
+            size = len(music.encode())
+            scaled_size = len(scaled.encode())
         except RuntimeError as e:
             self._abort(str(e))
+        ticks = max((sum(t.durations) + len(t.durations) for t in scaled.tracks), default=0)
+        self.logger.info("using 1/%d beat resolution, %d ticks instead of %d, data size is "
+                         "%d bytes instead of %d (%d bytes saved)", resolution, ticks,
+                         ticks * factor, scaled_size, size, size - scaled_size)
+        return scaled
+
+    def _encode_music(self, music: Union[BuzzerMusic, BuzzerMusicBank],
+                      stage: str = "encoded data") -> bytes:
+        """Encode buzzer music or music bank using configured options."""
+        optimal = self.config.optimal_encoding
+        backref = self.config.backref_encoding
+        return self._cached(stage, (music, optimal, backref),
+                            lambda: music.encode(optimal, backref))
+
+    def _encode_bank(self, bank: BuzzerMusicBank) -> Tuple[bytes, List[int]]:
+        """Encode music bank using configured options, and get the size of each song if
+        encoded alone."""
+        optimal = self.config.optimal_encoding
+        backref = self.config.backref_encoding
+        return self._cached("encoded data", (bank, optimal, backref),
+                            lambda: bank.encode_with_song_sizes(optimal, backref))
+
+    def _write_output_file(self, music: Union[BuzzerMusic, BuzzerMusicBank],
+                           defines: Optional[Dict[str, int]] = None,
+                           songs: Optional[List[BuzzerMusic]] = None) -> int:
+        """Output data file from buzzer music or music bank, with the songs of the bank
+        if any. Returns the size of data written. Size saved by the bank is logged."""
+        config = self.config
 
-        # write data to file / stdout
+        # encode buzzer music
+        song_sizes: Optional[List[int]] = None
         try:
-            mode = "w" if config.output_format == OutputFormat.HEX_HEADER else "wb"
-            if config.output_file == '-':
-                fd = os.fdopen(sys.stdout.fileno(), mode)
+            if isinstance(music, BuzzerMusicBank):
+                data, song_sizes = self._encode_bank(music)
             else:
-                fd = open(config.output_file, mode)
-
-            # output to file
-            if config.output_format == OutputFormat.HEX_HEADER:
-                write_c_header(fd, data, config.output_header_name)
-            else:
-                fd.write(data)
+                data = self._encode_music(music)
+            if config.optimal_encoding:
+                greedy_size = len(self._cached(
+                    "greedy encoded data", (music, config.backref_encoding),
+                    lambda: music.encode(False, config.backref_encoding)))
+                saved = greedy_size - len(data)
+                self.logger.info("optimal encoding saved %d bytes over greedy encoding (%.1f%%)",
+                                 saved, saved / greedy_size * 100)
+
+            # songs of a music bank are output separately in a multi-array format, with a
+            # table of the song arrays instead of the music bank.
+            arrays = [(config.output_header_name, data)]
+            table_name = None
+            if songs and config.output_format in (OutputFormat.MULTI_HEADER,
+                                                 OutputFormat.ASM_INCLUDE):
+                names = list(defines.keys())[1:]
+                arrays = [(name.lower(), self._encode_music(song, f"encoded song {i}"))
+                          for i, (name, song) in enumerate(zip(names, songs))]
+                table_name = f"{config.output_header_name}_song_table"
+                prefix = config.output_header_name.upper()
+                defines = {f"{prefix}_SONG_TABLE_SIZE": len(songs),
+                           **{name: defines[name] for name in names}}
+        except RuntimeError as e:
+            self._abort(str(e))
 
-            fd.flush()
-            if config.output_file != "-":
-                fd.close()
-                self.logger.info(f"buzzer music data output to {config.output_file}")
-            else:
+        # write data to file / stdout
+        try:
+            binary = config.output_format == OutputFormat.BINARY
+            with open_output_file(config.output_file, binary) as file:
+                if binary:
+                    file.write(data)
+                elif config.output_format == OutputFormat.HEX_HEADER:
+                    write_c_header(file, data, config.output_header_name, defines)
+                elif config.output_format == OutputFormat.MULTI_HEADER:
+                    write_multi_c_header(file, arrays, defines, table_name)
+                elif config.output_format == OutputFormat.ASM_INCLUDE:
+                    write_asm_include(file, arrays, defines, table_name)
+                else:
+                    write_intel_hex(file, data, config.output_hex_address)
+                file.flush()
+            if is_stdout(config.output_file):
                 self.logger.info("buzzer music data output to stdout")
-        except IOError as e:
+            else:
+                self.logger.info("buzzer music data output to %s", config.output_file)
+            if config.output_format == OutputFormat.ASM_INCLUDE:
+                header_file = get_asm_header_file(config.output_file)
+                with open_output_file(header_file, False) as file:
+                    write_asm_header(file, arrays, defines, table_name)
+                self.logger.info("buzzer music data declarations output to %s", header_file)
+        except (IOError, ValueError) as e:
             self._abort(f"could not write output file: {e}")
 
-        return len(data)
+        out_size = sum(len(array_data) for _, array_data in arrays)
+        if table_name:
+            self.logger.info("%d songs output as separate arrays, total data size is %d bytes",
+                             len(arrays), out_size)
+        elif song_sizes is not None:
+            self.logger.info("music bank has %d songs, total data size is %d bytes (%d bytes saved "
+                             "by sharing tracks)", len(song_sizes), out_size,
+                             sum(song_sizes) - out_size)
+        return out_size
 
     def _create_wav_file(self, music: BuzzerMusic) -> None:
         """Output WAV file from buzzer music."""
         config = self.config
         if config.output_wav_file:
+            start_time = 0
+            end_time = None
+            if config.output_wav_time_range:
+                start_time = config.output_wav_time_range.start
+                end_time = config.output_wav_time_range.stop
+            # the seek index is kept with the stages, so that tracks are only indexed again
+            # if they changed since the last conversion.
+            seek_index, _ = self.cache.get("WAV seek index", None, SeekIndex)
+            band_limited = config.output_wav_band_limited
+            samples = f"{config.output_wav_width}-bit samples"
+            if band_limited:
+                samples += ", band-limited"
             try:
-                create_wav_file(music, config.output_wav_file, config.output_wav_width,
-                                config.output_file != "-" and config.logger.level == LogLevel.INFO)
-                self.logger.info(f"WAV file output to {config.output_wav_file} "
-                                 f"({config.output_wav_width}-bit samples)")
+                if config.output_wav_file == "-":
+                    frame_rate = get_wav_frame_rate(music, config.output_wav_width)
+                    self.logger.info("writing raw WAV samples to stdout (%d Hz, %s)",
+                                     frame_rate, samples)
+                    sys.stdout.flush()
+                    write_raw_samples(music, sys.stdout.buffer, config.output_wav_width,
+                                      config.jobs, start_time, end_time, band_limited, seek_index)
+                elif config.output_wav_file.startswith("&"):
+                    # the WAV file is streamed, its header is written first with the number
+                    # of samples known in advance.
+                    with open_output_file(config.output_wav_file, True) as file:
+                        create_wav_file(music, file, config.output_wav_width, False,
+                                        config.jobs, start_time, end_time, band_limited,
+                                        seek_index)
+                    self.logger.info("WAV file output to file descriptor %s (%s)",
+                                     config.output_wav_file[1:], samples)
+                else:
+                    if not os.path.exists(config.output_wav_file):
+                        # file was removed since last written, write it again.
+                        self.cache.remove("WAV file")
+                    wav_key = (music, config.output_wav_file, config.output_wav_width,
+                               band_limited, config.output_wav_time_range)
+                    self._cached("WAV file", wav_key, lambda: create_wav_file(
+                        music, config.output_wav_file, config.output_wav_width,
+                        not is_stdout(config.output_file) and
+                        config.logger.level == LogLevel.INFO,
+                        config.jobs, start_time, end_time, band_limited, seek_index))
+                    self.logger.info("WAV file output to %s (%s)", config.output_wav_file, samples)
             except RuntimeError as e:
                 self._abort(f"failed to create WAV file: {e}")
+            except IOError as e:
+                self._abort(f"could not write WAV file: {e}")
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    """Parse arguments, with additional arguments from options file if any."""
+    args = parser.parse_args(argv)
+    if args.options_file:
+        try:
+            with open(args.options_file, "r") as file:
+                options = shlex.split(file.read(), comments=True)
+        except IOError as e:
+            raise ValueError(f"could not read options file: {e}")
+        args = parser.parse_args(argv + options)
+    return args
+
+
+def get_file_state(file: str) -> Optional[Tuple[int, int]]:
+    """Get modification time and size of a file, None if missing."""
+    try:
+        stat = os.stat(file)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+def open_log_json_file(args: argparse.Namespace) -> Optional[IO]:
+    """Open the JSON log file given in arguments, if any."""
+    if not args.log_json_file:
+        return None
+    try:
+        return open(args.log_json_file, "w")
+    except IOError as e:
+        raise ValueError(f"could not open JSON log file: {e}")
+
+
+def watch(argv: List[str], log_json_file: Optional[IO] = None) -> None:
+    """Convert again each time watched files change, reusing unchanged conversion stages.
+    Messages of all conversions are written to the same JSON log file."""
+    cache = StageCache()
+    args = parser.parse_args(argv)
+    files = [args.input_file] + args.bank_input_files + [args.options_file]
+    last_state = None
+    while True:
+        state = [get_file_state(file) for file in files if file]
+        if state != last_state:
+            last_state = state
+            start = time.perf_counter()
+            try:
+                args = parse_args(argv)
+                files = [args.input_file] + args.bank_input_files + [args.options_file]
+                # watched files may have changed with the options file.
+                last_state = [get_file_state(file) for file in files if file]
+                config = create_config(args, log_json_file)
+                MidiConverter(config, cache).convert()
+                config.logger.info("converted in %.2f s, watching for changes",
+                                   time.perf_counter() - start)
+            except (RuntimeError, SystemExit):
+                # error already printed, by converter or for invalid options in options file.
+                pass
+            except Exception as e:
+                # e.g. a MIDI file read while being written, keep watching.
+                print(f"Error: {str(e) or type(e).__name__}", file=sys.stderr)
+        time.sleep(WATCH_INTERVAL)
 
 
 def main() -> None:
-    args = parser.parse_args()
+    argv = sys.argv[1:]
     try:
-        config = create_config(args)
+        args = parse_args(argv)
+        log_json_file = open_log_json_file(args)
     except ValueError as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
-    converter = MidiConverter(config)
     try:
-        converter.convert()
-    except RuntimeError:
-        sys.exit(1)
+        try:
+            config = create_config(args, log_json_file)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+
+        if args.watch:
+            try:
+                watch(argv, log_json_file)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        converter = MidiConverter(config)
+        try:
+            converter.convert()
+        except RuntimeError:
+            sys.exit(1)
+    finally:
+        if log_json_file:
+            log_json_file.close()
 
 
 if __name__ == '__main__':
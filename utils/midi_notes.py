@@ -0,0 +1,39 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from typing import Dict, List, Tuple, Iterator
+
+# MIDI events of all tracks by MIDI time, as (track number, event).
+MidiEventMap = Dict[int, List[Tuple[int, any]]]
+
+
+def iter_note_changes(event_map: MidiEventMap,
+                      track_count: int) -> Iterator[Tuple[int, int, int, bool]]:
+    """
+    Iterate over notes going on and off in MIDI time order, as (time, track number, note, on).
+    A note_on event for a note already on is interpreted as a note_off event, and note_off
+    events for notes not on are ignored, so that changes always alternate for a note.
+    """
+    notes_on: List[set] = [set() for _ in range(track_count)]
+    for time in sorted(event_map.keys()):
+        for track_num, event in event_map[time]:
+            if event.type != "note_on" and event.type != "note_off":
+                continue
+            notes_on_track = notes_on[track_num]
+            if event.type == "note_on" and event.note not in notes_on_track:
+                notes_on_track.add(event.note)
+                yield time, track_num, event.note, True
+            elif event.note in notes_on_track:
+                notes_on_track.remove(event.note)
+                yield time, track_num, event.note, False
@@ -11,11 +11,19 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
+from array import array
+import math
 from collections import Counter
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Iterator, Tuple, Optional, Dict, Any, Union, Sequence
+
+import numpy as np
 
 FramesNotes = List[List[List[int]]]
+# encoded music data, decoding doesn't copy it.
+ByteData = Union[bytes, bytearray, memoryview]
+# encoded notes, as [note byte, duration] (duration is -1 for notes without a duration).
+EncodedOps = List[List[int]]
 
 
 def get_note_freq(note: int) -> float:
@@ -40,6 +48,8 @@ class BuzzerNote:
     MAX_DURATION = 0x3fff
     MAX_DURATION_REPEAT = 0x40
     MAX_NOTE = 0x53
+    # MIDI note for note value 0 (C2)
+    MIDI_OFFSET = 36
 
     IMMEDIATE_PAUSE_OFFSET = 0x55
     SHORT_PAUSE_OFFSET = 0xaa
@@ -49,12 +59,17 @@ class BuzzerNote:
 
     def encode_duration(self) -> bytes:
         """Encode the duration of a note in one or two bytes."""
+        return BuzzerNote.encode_duration_value(self.duration)
+
+    @staticmethod
+    def encode_duration_value(duration: int) -> bytes:
+        """Encode a note duration value in one or two bytes."""
         b = bytearray()
-        if self.duration < 128:
-            b.append(self.duration)
-        elif self.duration <= BuzzerNote.MAX_DURATION:
-            b.append((self.duration >> 8) | 0xc0)
-            b.append(self.duration & 0xff)
+        if duration < 128:
+            b.append(duration)
+        elif duration <= BuzzerNote.MAX_DURATION:
+            b.append((duration >> 8) | 0xc0)
+            b.append(duration & 0xff)
         else:
             raise ValueError("cannot encode duration")
         return b
@@ -62,47 +77,331 @@ class BuzzerNote:
     @staticmethod
     def from_midi(midi_note: int):
         # C2=36 in MIDI, C2=0 in buzzer music
-        return midi_note - 36
+        return midi_note - BuzzerNote.MIDI_OFFSET
 
     def __repr__(self) -> str:
         note_str = "OFF" if self.note == BuzzerNote.NONE else self.note
         return f"BuzzerNote(note={note_str}, duration={self.duration})"
 
 
+class CompiledChannelSpecs(Sequence[ChannelSpec]):
+    """
+    Channels specification with lookup tables built once for all notes, for each channel.
+    Tables are indexed by channel then by note value (0 to NONE), entries are zero for
+    notes not playable by a channel and for NONE.
+    """
+    # number of MIDI notes in playable channels bitmask table.
+    MIDI_NOTES = 128
+
+    specs: List[ChannelSpec]
+    # sample rate for which the phase steps and note periods are computed.
+    sample_rate: int
+    # timer count for each note, as computed for the timer tables in firmware.
+    timer_counts: np.ndarray
+    # actual frequency in Hz of each note, given the timer count.
+    freqs: np.ndarray
+    # square wave cycle increment per sample for each note.
+    phase_steps: np.ndarray
+    # number of samples between level changes for each note.
+    note_periods: np.ndarray
+    # bitmask of the channels that can play each MIDI note.
+    playable: List[int]
+
+    def __init__(self, specs: List[ChannelSpec], sample_rate: int = 44100):
+        self.specs = specs
+        self.sample_rate = sample_rate
+        shape = (len(specs), BuzzerNote.NONE + 1)
+        self.timer_counts = np.zeros(shape, dtype=np.int64)
+        self.freqs = np.zeros(shape)
+        self.phase_steps = np.zeros(shape)
+        self.note_periods = np.zeros(shape, dtype=np.int64)
+        self.playable = [0] * CompiledChannelSpecs.MIDI_NOTES
+        for i, spec in enumerate(specs):
+            for note in spec.note_range:
+                self.playable[note + BuzzerNote.MIDI_OFFSET] |= 1 << i
+                if spec.timer_period == 0:
+                    continue
+                # timer count is an integer, rounding results in some error.
+                # / 2 since timer interrupt is called twice per note period.
+                timer_count = round(spec.timer_period / get_note_freq(note) / 2)
+                level_freq = spec.timer_period / timer_count
+                self.timer_counts[i, note] = timer_count - 1
+                self.freqs[i, note] = level_freq / 2
+                self.phase_steps[i, note] = level_freq / 2 / sample_rate
+                # level changes on the first sample where phase reaches sample_rate / level_freq.
+                self.note_periods[i, note] = max(1, math.ceil(sample_rate / level_freq))
+
+    def __getitem__(self, index):
+        return self.specs[index]
+
+    def __len__(self) -> int:
+        return len(self.specs)
+
+
 @dataclass
 class BuzzerTrack:
     # channel number
     channel: int
     # track note range
     spec: ChannelSpec
-    # track notes
-    notes: List[BuzzerNote]
+    # track notes and their durations, stored as parallel arrays (3 bytes per note).
+    # notes[i] is the note as encoded in buzzer music, durations[i] is its duration (see BuzzerNote).
+    notes: array
+    durations: array
 
     TRACK_NOTES_END = 0xff
+    # channel, track length, duration array offset and immediate pause duration.
+    HEADER_SIZE = 6
+
+    # maximum duration of a pause encoded in a single note byte
+    MAX_SHORT_PAUSE = 0xfe - BuzzerNote.SHORT_PAUSE_OFFSET
+
+    # back-reference note byte, followed by the note and duration distances and the length.
+    # only used if flag is set on channel number.
+    BACKREF = 0xfe
+    BACKREF_FLAG = 0x80
+    BACKREF_SIZE = 6
+    BACKREF_MAX_LENGTH = 0xff
+    # minimum number of notes in a back-reference, and number of previous positions
+    # tried when looking for a back-reference.
+    BACKREF_MIN_LENGTH = 4
+    BACKREF_MAX_TRIES = 64
 
     def __init__(self, number: int, spec: ChannelSpec):
         self.channel = number
         self.spec = spec
-        self.notes = []
+        self.notes = array("B")
+        self.durations = array("H")
+
+    def __len__(self) -> int:
+        return len(self.notes)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        """iterate over (note, duration) pairs without creating note objects."""
+        return zip(self.notes, self.durations)
 
     def add_note(self, note: int) -> None:
         """append note at the end of track, merge with previous note if identical"""
         if note != BuzzerNote.NONE and note not in self.spec.note_range:
             raise ValueError("Note out of range for track")
-        if len(self.notes) > 0 and self.notes[-1].note == note and \
-                self.notes[-1].duration < BuzzerNote.MAX_DURATION:
-            self.notes[-1].duration += 1
+        notes = self.notes
+        if notes and notes[-1] == note and self.durations[-1] < BuzzerNote.MAX_DURATION:
+            self.durations[-1] += 1
         else:
             # different note, or previous note exceeded max duration.
-            self.notes.append(BuzzerNote(note, 0))
+            notes.append(note)
+            self.durations.append(0)
+
+    def add_run(self, note: int, length: int) -> None:
+        """append note for a number of frames at the end of track,
+        merge with previous note if identical"""
+        if note != BuzzerNote.NONE and note not in self.spec.note_range:
+            raise ValueError("Note out of range for track")
+        if length <= 0:
+            return
+        if self.notes and self.notes[-1] == note:
+            # extend previous note up to max duration
+            extend = min(length, BuzzerNote.MAX_DURATION - self.durations[-1])
+            self.durations[-1] += extend
+            length -= extend
+        while length > 0:
+            run = min(length, BuzzerNote.MAX_DURATION + 1)
+            self.notes.append(note)
+            self.durations.append(run - 1)
+            length -= run
 
     def finalize(self) -> None:
         """do final modifications on track notes"""
         # remove last 'none' notes if any
-        while len(self.notes) > 0 and self.notes[-1].note == BuzzerNote.NONE:
-            del self.notes[-1]
+        while self.notes and self.notes[-1] == BuzzerNote.NONE:
+            self.notes.pop()
+            self.durations.pop()
+
+    def encode(self, optimal: bool = False, backref: bool = False) -> bytes:
+        """Encode track data. If optimal is set, the encoding choices giving the smallest
+        track size are searched for instead of using greedy choices (much slower).
+        If backref is set, repeated sequences of notes are encoded as back-references."""
+        if optimal and backref:
+            # back-references are found after the encoding choices are made, so the optimal
+            # choices can give a larger track than greedy choices once they are applied.
+            b = self._encode(True, True)
+            greedy = self._encode(False, True)
+            return greedy if len(greedy) < len(b) else b
+        return self._encode(optimal, backref)
+
+    def _encode(self, optimal: bool, backref: bool) -> bytes:
+        # single byte pause with the longest duration is used for back-references
+        max_short_pause = BuzzerTrack.MAX_SHORT_PAUSE - (1 if backref else 0)
+        if optimal:
+            immediate_pause, ops = self._get_optimal_ops(max_short_pause)
+        else:
+            immediate_pause, ops = self._get_greedy_ops(max_short_pause)
+        b = self._encode_ops(immediate_pause, ops, backref)
+        if backref and any(note == BuzzerNote.NONE and duration >= BuzzerTrack.MAX_SHORT_PAUSE
+                           for note, duration in self):
+            # the longest single byte pause may be needed by long pauses, use the encoding
+            # without back-references if they don't save more than it costs.
+            plain = self.encode(optimal, False)
+            if not b[0] & BuzzerTrack.BACKREF_FLAG or len(plain) <= len(b):
+                return plain
+        if backref and b[0] & BuzzerTrack.BACKREF_FLAG:
+            # verify that back-references are decoded correctly
+            decoded = BuzzerTrack(self.channel, self.spec)
+            for note, duration in decode_track_notes(b):
+                decoded.add_run(note, duration + 1)
+            if decoded.notes != self.notes or decoded.durations != self.durations:
+                raise RuntimeError("track encoded with back-references doesn't decode correctly")
+        return b
 
-    def encode(self) -> bytes:
+    def _get_greedy_ops(self, max_short_pause: int = MAX_SHORT_PAUSE) -> Tuple[int, EncodedOps]:
+        """Get immediate pause and encoded notes by making greedy choices for each note."""
+        # find most common pause duration shorter than 256 for track and store it
+        # it will be used for notes using the immediate pause encoding.
+        immediate_pause = -1
+        if self.notes:
+            pause_durations = (duration for note, duration in self
+                               if note == BuzzerNote.NONE and duration <= 0xff)
+            most_common_pauses = Counter(pause_durations).most_common()
+            if most_common_pauses:
+                immediate_pause = most_common_pauses[0][0]
+
+        ops: EncodedOps = []
+        for note, duration in self:
+            if note == BuzzerNote.NONE:
+                if duration == immediate_pause and ops and ops[-1][0] <= BuzzerNote.NONE:
+                    # note in range [0x55, 0xa9] indicate that note is followed by a pause.
+                    # previous note byte must have a duration for this to be possible.
+                    ops[-1][0] += BuzzerNote.IMMEDIATE_PAUSE_OFFSET
+                    continue
+                elif duration <= max_short_pause:
+                    # note in range [0xaa, 0xfe] indicate a pause of duration (note - 170).
+                    ops.append([duration + BuzzerNote.SHORT_PAUSE_OFFSET, -1])
+                    continue
+                elif 128 < duration <= 129 + immediate_pause and immediate_pause <= 128:
+                    # [0xa9, 0xa9]
+                    # will almost never happen but if pause is in a narrow duration range
+                    # it can be encoded on 2 bytes instead of 3 by combining with immediate pause
+                    ops.append([BuzzerNote.NONE + BuzzerNote.IMMEDIATE_PAUSE_OFFSET,
+                                duration - immediate_pause - 1])
+                    continue
+            # [0x00, 0x54]: normal note or pause
+            ops.append([note, duration])
+        return immediate_pause, ops
+
+    def _get_optimal_ops(self, max_short_pause: int = MAX_SHORT_PAUSE) -> Tuple[int, EncodedOps]:
+        """Get immediate pause and encoded notes giving the smallest track size."""
+        if not self.notes:
+            return self._get_greedy_ops(max_short_pause)
+        # every immediate pause value is tried, since even a value not used by any pause
+        # can help by splitting long pauses. values longer than all pauses are all equivalent.
+        max_pause = max((duration for note, duration in self if note == BuzzerNote.NONE),
+                        default=-1)
+        immediate_pause = min(range(min(max_pause + 1, 0xff) + 1),
+                              key=lambda p: self._solve_optimal_ops(p, max_short_pause))
+        ops: EncodedOps = []
+        self._solve_optimal_ops(immediate_pause, max_short_pause, ops)
+        return immediate_pause, ops
+
+    def _solve_optimal_ops(self, immediate_pause: int, max_short_pause: int,
+                           ops: Optional[EncodedOps] = None) -> int:
+        """
+        Find the encoding of track notes giving the smallest size for an immediate pause value,
+        by dynamic programming over the notes and the last encoded duration.
+        Returns the size of the encoded notes and durations. If ops is not None, it is filled
+        with the encoded notes.
+        """
+        build = ops is not None
+        attach_length = immediate_pause + 1
+        short_length = max_short_pause + 1
+
+        # duration of the next note (not pause) after each note, -1 if none.
+        next_durations = [-1] * len(self.notes)
+        next_duration = -1
+        for i in range(len(self.notes) - 1, -1, -1):
+            next_durations[i] = next_duration
+            if self.notes[i] != BuzzerNote.NONE:
+                next_duration = self.durations[i]
+
+        # states are indexed by (last encoded duration, whether last note byte can be followed
+        # by the immediate pause), and hold (size, duration repeat count, backtrack node).
+        # for the same index, a state with a smaller size, or the same size and more room left
+        # in the current duration repeat, is always at least as good as another.
+        # backtrack nodes are (parent node, encoded notes), where an encoded note of None
+        # indicates that the immediate pause follows the previous note byte.
+        states: Dict[Tuple[int, bool], Tuple[int, int, Any]] = {(-1, False): (0, 0, None)}
+        new_states: Dict[Tuple[int, bool], Tuple[int, int, Any]] = {}
+
+        def add_state(key: Tuple[int, bool], size: int, repeat: int, node: Any) -> None:
+            state = new_states.get(key)
+            if state is None or size < state[0] or size == state[0] and \
+                    (repeat or BuzzerNote.MAX_DURATION_REPEAT) < \
+                    (state[1] or BuzzerNote.MAX_DURATION_REPEAT):
+                new_states[key] = (size, repeat, node)
+
+        def split_pause(length: int) -> List[Tuple[int, int]]:
+            # split pause in single byte pauses
+            encoded = []
+            while length > 0:
+                part = min(length, short_length)
+                encoded.append((part - 1 + BuzzerNote.SHORT_PAUSE_OFFSET, -1))
+                length -= part
+            return encoded
+
+        for i, (note, duration) in enumerate(self):
+            new_states.clear()
+            for (last_duration, can_attach), (size, repeat, node) in states.items():
+                if note != BuzzerNote.NONE:
+                    size += 1 + _get_duration_size(duration, last_duration, repeat)
+                    repeat = _get_duration_repeat(duration, last_duration, repeat)
+                    add_state((duration, True), size, repeat,
+                              (node, [(note, duration)]) if build else None)
+                    continue
+
+                # pause is split in an optional immediate pause following previous note byte,
+                # single byte pauses, then an optional pause with duration itself optionally
+                # followed by the immediate pause.
+                length = duration + 1
+                leadings = (0, attach_length) if can_attach and attach_length <= length else (0,)
+                for leading in leadings:
+                    encoded_leading = [None] if leading else []
+                    rest = length - leading
+                    add_state((last_duration, False), size - (-rest // short_length), repeat,
+                              (node, encoded_leading + split_pause(rest)) if build else None)
+                    for trailing in (0, attach_length):
+                        pause_rest = rest - trailing
+                        # pause duration is either the whole remaining duration, or a duration
+                        # chosen so that the pause or the next note can repeat the last duration.
+                        for pause_duration in {pause_rest - 1, last_duration, next_durations[i]}:
+                            if not (0 <= pause_duration < pause_rest):
+                                continue
+                            split_length = pause_rest - pause_duration - 1
+                            pause_size = 1 + _get_duration_size(
+                                pause_duration, last_duration, repeat) - \
+                                (-split_length // short_length)
+                            add_state((pause_duration, not trailing), size + pause_size,
+                                      _get_duration_repeat(pause_duration, last_duration, repeat),
+                                      (node, encoded_leading + split_pause(split_length) +
+                                       [(BuzzerNote.NONE, pause_duration)] +
+                                       ([None] if trailing else [])) if build else None)
+            states, new_states = new_states, states
+
+        size, _, node = min(states.values(), key=lambda s: s[0])
+        if build:
+            encoded_notes = []
+            while node is not None:
+                node, encoded = node
+                encoded_notes.append(encoded)
+            for encoded in reversed(encoded_notes):
+                for encoded_note in encoded:
+                    if encoded_note is None:
+                        ops[-1][0] += BuzzerNote.IMMEDIATE_PAUSE_OFFSET
+                    else:
+                        ops.append(list(encoded_note))
+        return size
+
+    def _encode_ops(self, immediate_pause: int, ops: EncodedOps, backref: bool = False) -> bytes:
+        """Encode track data from immediate pause and encoded notes,
+        optionally replacing repeated encoded notes with back-references."""
         b = bytearray()
         durations = bytearray()
         last_duration = -1
@@ -110,18 +409,16 @@ class BuzzerTrack:
         b.append(self.channel)
         b += b"\x00\x00"  # track length
         b += b"\x00\x00"  # duration array offset (to 1st byte of track)
+        b.append(max(immediate_pause, 0))
 
-        # find most common pause duration shorter than 256 for track and store it
-        # it will be used for notes using the immediate pause encoding.
-        immediate_pause = -1
-        b.append(0)
-        if self.notes:
-            pause_durations = (note.duration for note in self.notes
-                               if note.note == BuzzerNote.NONE and note.duration <= 0xff)
-            most_common_pauses = Counter(pause_durations).most_common()
-            if most_common_pauses:
-                immediate_pause = most_common_pauses[0][0]
-                b[-1] = immediate_pause
+        # for back-references, the position of each note byte encoded as is, and the position
+        # of its duration if encoded explicitly (-1 otherwise) are kept, as well as the number
+        # of duration bytes read for each note. positions are indexed by the encoded notes.
+        ops_keys = [tuple(op) for op in ops]
+        note_positions = [-1] * len(ops)
+        duration_positions = [-1] * len(ops)
+        duration_sizes = [0] * len(ops)
+        positions_by_key: Dict[Tuple, List[int]] = {}
 
         def end_duration_repeat() -> None:
             nonlocal duration_repeat
@@ -129,40 +426,56 @@ class BuzzerTrack:
                 durations.append(0x80 | (duration_repeat - 1))
                 duration_repeat = 0
 
-        for note in self.notes:
-            # append note byte
-            if note.note == BuzzerNote.NONE:
-                if note.duration == immediate_pause:
-                    # note in range [0x55, 0xa8] indicate that note is followed by a pause.
-                    b[-1] += BuzzerNote.IMMEDIATE_PAUSE_OFFSET
-                    continue
-                elif note.duration <= (0xff - BuzzerNote.SHORT_PAUSE_OFFSET):
-                    # note in range [0xaa, 0xfe] indicate a pause of duration (note - 170).
-                    b.append(note.duration + BuzzerNote.SHORT_PAUSE_OFFSET)
+        i = 0
+        while i < len(ops):
+            key = tuple(ops_keys[i:i + BuzzerTrack.BACKREF_MIN_LENGTH])
+            if backref:
+                source, length = self._find_backref(ops_keys, i, positions_by_key.get(key, []),
+                                                    note_positions, duration_positions,
+                                                    duration_sizes)
+                if length:
+                    # back-reference: note distance is from byte following back-reference byte,
+                    # duration distance is from current position in durations array.
+                    end_duration_repeat()
+                    b.append(BuzzerTrack.BACKREF)
+                    b += (len(b) - note_positions[source]).to_bytes(2, "little", signed=False)
+                    duration_position = next((duration_positions[j]
+                                              for j in range(source, source + length)
+                                              if ops[j][1] >= 0), len(durations))
+                    b += (len(durations) - duration_position).to_bytes(2, "little", signed=False)
+                    b.append(length)
+                    # after back-reference, last duration is the last one in referenced notes,
+                    # and duration repeat is reset.
+                    last_duration = next((ops[j][1] for j in range(i + length - 1, i - 1, -1)
+                                          if ops[j][1] >= 0), last_duration)
+                    b[0] |= BuzzerTrack.BACKREF_FLAG
+                    i += length
                     continue
-                elif 128 < note.duration <= 129 + immediate_pause and immediate_pause <= 128:
-                    # [0xaa, 0xaa]
-                    # will almost never happen but if pause is in a narrow duration range
-                    # it can be encoded on 2 bytes instead of 3 by combining with immediate pause
-                    b.append(BuzzerNote.NONE + BuzzerNote.IMMEDIATE_PAUSE_OFFSET)
-                    note = BuzzerNote(note.note, note.duration - immediate_pause - 1)
-                else:
-                    # [0x00, 0x54]: normal note
-                    b.append(BuzzerNote.NONE)
-            else:
-                # note in range [0, 84[ indicate only a note.
-                b.append(note.note)
+
+            # append note byte
+            note, duration = ops[i]
+            note_positions[i] = len(b)
+            positions_by_key.setdefault(key, []).append(i)
+            b.append(note)
+            i += 1
+            if duration < 0:
+                # single byte pause, no associated duration
+                continue
 
             # append duration
-            if note.duration == last_duration:
+            if duration == last_duration:
                 # same duration as last note, use repeated duration encoding
                 if duration_repeat == BuzzerNote.MAX_DURATION_REPEAT:
                     end_duration_repeat()
+                if duration_repeat == 0:
+                    duration_sizes[i - 1] = 1
                 duration_repeat += 1
             else:
                 end_duration_repeat()
-                durations += note.encode_duration()
-                last_duration = note.duration
+                duration_positions[i - 1] = len(durations)
+                durations += BuzzerNote.encode_duration_value(duration)
+                duration_sizes[i - 1] = len(durations) - duration_positions[i - 1]
+                last_duration = duration
 
         end_duration_repeat()
 
@@ -175,30 +488,421 @@ class BuzzerTrack:
         b[1:3] = len(b).to_bytes(2, "little", signed=False)
         return b
 
+    @staticmethod
+    def _find_backref(ops_keys: List[Tuple], pos: int, sources: List[int],
+                      note_positions: List[int], duration_positions: List[int],
+                      duration_sizes: List[int]) -> Tuple[int, int]:
+        """
+        Find the back-reference saving the most bytes for encoded notes at a position,
+        from previous positions starting with the same encoded notes (hash chain).
+        Returns the source position and the length of the back-reference (0 if none).
+        Referenced notes must have been encoded as is, and the first duration in them must
+        be explicitly encoded, so that they are decoded the same regardless of previous notes.
+        """
+        best_source = 0
+        best_length = 0
+        best_saved = 0
+        for source in reversed(sources[-BuzzerTrack.BACKREF_MAX_TRIES:]):
+            length = 0
+            size = 0
+            first_duration = True
+            while length < BuzzerTrack.BACKREF_MAX_LENGTH and pos + length < len(ops_keys) and \
+                    source + length < pos and note_positions[source + length] >= 0 and \
+                    ops_keys[source + length] == ops_keys[pos + length]:
+                if first_duration and ops_keys[source + length][1] >= 0:
+                    if duration_positions[source + length] < 0:
+                        break
+                    first_duration = False
+                size += 1 + duration_sizes[source + length]
+                length += 1
+            saved = size - BuzzerTrack.BACKREF_SIZE
+            if saved > best_saved:
+                best_source = source
+                best_length = length
+                best_saved = saved
+        return best_source, best_length
+
+
+def decode_track_notes(data: ByteData, pos: int = 0) -> Iterator[Tuple[int, int]]:
+    """
+    Decode track starting at a position in encoded data, yielding (note, duration) for each
+    note played, in the same way as src/music.c. Pauses encoded separately are yielded separately.
+    """
+    backref = bool(data[pos] & BuzzerTrack.BACKREF_FLAG)
+    note_pos = pos + BuzzerTrack.HEADER_SIZE
+    duration_pos = pos + int.from_bytes(data[pos + 3:pos + 5], "little")
+    immediate_pause = data[pos + 5]
+    duration_total = 0
+    duration_repeat = 0
+    backref_left = 0
+    backref_note_pos = 0
+    backref_duration_pos = 0
+    while True:
+        if backref_left:
+            backref_left -= 1
+            if backref_left == 0:
+                # end of back-reference, return after it.
+                note_pos = backref_note_pos
+                duration_pos = backref_duration_pos
+                duration_repeat = 0
+
+        note = data[note_pos]
+        note_pos += 1
+        if note == BuzzerTrack.BACKREF and backref:
+            # back-reference, replay notes from earlier in track data.
+            backref_left = data[note_pos + 4]
+            backref_note_pos = note_pos + 5
+            backref_duration_pos = duration_pos
+            duration_pos -= int.from_bytes(data[note_pos + 2:note_pos + 4], "little")
+            note_pos -= int.from_bytes(data[note_pos:note_pos + 2], "little")
+            note = data[note_pos]
+            note_pos += 1
+
+        if note == BuzzerTrack.TRACK_NOTES_END:
+            return
+        if note >= BuzzerNote.SHORT_PAUSE_OFFSET:
+            yield BuzzerNote.NONE, note - BuzzerNote.SHORT_PAUSE_OFFSET
+            continue
+
+        if duration_repeat:
+            duration_repeat -= 1
+        elif data[duration_pos] & 0x80:
+            if data[duration_pos] & 0x40:
+                duration_total = (data[duration_pos] & 0x3f) << 8 | data[duration_pos + 1]
+                duration_pos += 2
+            else:
+                duration_repeat = data[duration_pos] - 0x80
+                duration_pos += 1
+        else:
+            duration_total = data[duration_pos]
+            duration_pos += 1
+
+        if note >= BuzzerNote.IMMEDIATE_PAUSE_OFFSET:
+            yield note - BuzzerNote.IMMEDIATE_PAUSE_OFFSET, duration_total
+            yield BuzzerNote.NONE, immediate_pause
+        else:
+            yield note, duration_total
+
+
+def decode_tempo_changes(data: ByteData, pos: int) -> List[Tuple[int, int]]:
+    """Decode tempo changes at a position in encoded data, starting with their number,
+    as (tick, tempo) pairs."""
+    changes = []
+    tick = 0
+    for i in range(data[pos]):
+        change_pos = pos + 1 + i * BuzzerMusic.TEMPO_CHANGE_SIZE
+        tick += int.from_bytes(data[change_pos:change_pos + 2], "little")
+        changes.append((tick, data[change_pos + 2]))
+    return changes
+
+
+def _decode_track(channel: int, notes: Iterator[Tuple[int, int]],
+                  channels_spec: Optional[Sequence[ChannelSpec]]) -> BuzzerTrack:
+    """Create track from decoded notes. If no channels spec is given, all notes are accepted."""
+    if channels_spec is None:
+        spec = ChannelSpec(range(BuzzerNote.MAX_NOTE + 1))
+    elif channel < len(channels_spec):
+        spec = channels_spec[channel]
+    else:
+        raise ValueError(f"no channel spec for decoded track on channel {channel}")
+    track = BuzzerTrack(channel, spec)
+    for note, duration in notes:
+        track.add_run(note, duration + 1)
+    track.finalize()
+    return track
+
+
+def parse_c_header(text: str) -> bytes:
+    """Parse data array from C header written by midi_convert.py (or by xxd -i)."""
+    start = text.find("{")
+    end = text.find("}", start)
+    if start == -1 or end == -1:
+        raise ValueError("no data array found in C header")
+    try:
+        return bytes(int(value, 0) for value in text[start + 1:end].replace(",", " ").split())
+    except ValueError as e:
+        raise ValueError(f"invalid data array in C header: {e}") from e
+
+
+def load_music_data(filename: str) -> bytes:
+    """Load encoded data from binary file or from C header file (.h extension)."""
+    if filename.endswith(".h"):
+        with open(filename, "r") as file:
+            return parse_c_header(file.read())
+    with open(filename, "rb") as file:
+        return file.read()
+
+
+def _get_duration_size(duration: int, last_duration: int, repeat: int) -> int:
+    """Get number of bytes added to durations array to encode a duration, given the last
+    encoded duration and the number of times it was repeated."""
+    if duration == last_duration:
+        return 0 if 0 < repeat < BuzzerNote.MAX_DURATION_REPEAT else 1
+    return 1 if duration < 128 else 2
+
+
+def _get_duration_repeat(duration: int, last_duration: int, repeat: int) -> int:
+    """Get number of times the last duration is repeated after encoding a duration."""
+    if duration == last_duration:
+        return repeat + 1 if 0 < repeat < BuzzerNote.MAX_DURATION_REPEAT else 1
+    return 0
+
 
 @dataclass
 class BuzzerMusic:
     tempo: int
     tracks: List[BuzzerTrack] = field(default_factory=list)
+    # tempo changes after the start of music as (tick, tempo), in increasing tick order.
+    tempo_changes: List[Tuple[int, int]] = field(default_factory=list)
 
     MUSIC_END = 0xff
 
+    # byte following the tempo if music has tempo changes, then the number of changes
+    # and the ticks since the previous change and the new tempo for each change.
+    TEMPO_CHANGES = 0xfe
+    TEMPO_CHANGE_SIZE = 3
+    MAX_TEMPO_CHANGES = 0xff
+    MAX_TEMPO_CHANGE_TICKS = 0xffff
+
     # encodeable tempo bounds
     TEMPO_MIN = round(256 * 256 * BuzzerNote.TIMEFRAME_RESOLUTION)
     TEMPO_MAX = round(1 * 256 * BuzzerNote.TIMEFRAME_RESOLUTION)
 
-    def encode(self) -> bytes:
+    def encode(self, optimal: bool = False, backref: bool = False) -> bytes:
         if len(set(t.channel for t in self.tracks)) != len(self.tracks):
             raise RuntimeError("tracks must be unique")
 
         b = bytearray()
         b += self.tempo.to_bytes(1, "little", signed=False)
+        if self.tempo_changes:
+            b.append(BuzzerMusic.TEMPO_CHANGES)
+            b += self.encode_tempo_changes()
         for track in self.tracks:
             if len(track.notes) > 0:
-                b += track.encode()
+                b += track.encode(optimal, backref)
         b.append(BuzzerMusic.MUSIC_END)
         return b
 
+    def encode_tempo_changes(self) -> bytes:
+        """Encode tempo changes, starting with their number. Changes further apart than
+        the maximum number of ticks are split by repeating the current tempo."""
+        b = bytearray([0])
+        last_tick = 0
+        last_tempo = self.tempo
+        for tick, tempo in self.tempo_changes:
+            if tick <= last_tick:
+                raise RuntimeError("tempo changes must be in increasing tick order")
+            while tick - last_tick > BuzzerMusic.MAX_TEMPO_CHANGE_TICKS:
+                last_tick += BuzzerMusic.MAX_TEMPO_CHANGE_TICKS
+                b += BuzzerMusic.MAX_TEMPO_CHANGE_TICKS.to_bytes(2, "little", signed=False)
+                b.append(last_tempo)
+            b += (tick - last_tick).to_bytes(2, "little", signed=False)
+            b.append(tempo)
+            last_tick = tick
+            last_tempo = tempo
+        count = (len(b) - 1) // BuzzerMusic.TEMPO_CHANGE_SIZE
+        if count > BuzzerMusic.MAX_TEMPO_CHANGES:
+            raise RuntimeError(f"too many tempo changes to be encoded ({count})")
+        b[0] = count
+        return b
+
+    def get_tempos(self, ticks: int) -> np.ndarray:
+        """Get the tempo used for each tick from the start of music, up to a number of ticks."""
+        tempos = np.full(ticks, self.tempo, dtype=np.int64)
+        for tick, tempo in self.tempo_changes:
+            tempos[tick:] = tempo
+        return tempos
+
+    @staticmethod
+    def iter_tracks(data: ByteData) -> Iterator[Tuple[int, Iterator[Tuple[int, int]]]]:
+        """
+        Iterate over tracks in encoded music data in the same way as src/music.c, yielding the
+        channel number and a lazy iterator over the (note, duration) pairs for each track.
+        """
+        view = memoryview(data)
+        pos = 1
+        if view[pos] == BuzzerMusic.TEMPO_CHANGES:
+            pos += 2 + view[pos + 1] * BuzzerMusic.TEMPO_CHANGE_SIZE
+        last_channel = -1
+        while view[pos] != BuzzerMusic.MUSIC_END:
+            channel = view[pos] & ~BuzzerTrack.BACKREF_FLAG
+            length = int.from_bytes(view[pos + 1:pos + 3], "little")
+            if channel <= last_channel or length < BuzzerTrack.HEADER_SIZE:
+                raise ValueError("invalid track header in music data")
+            yield channel, decode_track_notes(view, pos)
+            last_channel = channel
+            pos += length
+
+    @staticmethod
+    def decode_tempo(data: ByteData) -> Tuple[int, List[Tuple[int, int]]]:
+        """Get tempo and tempo changes in encoded music data."""
+        if data[1] == BuzzerMusic.TEMPO_CHANGES:
+            return data[0], decode_tempo_changes(data, 2)
+        return data[0], []
+
+    @staticmethod
+    def decode(data: ByteData,
+               channels_spec: Optional[Sequence[ChannelSpec]] = None) -> "BuzzerMusic":
+        """Decode music data. Channels spec is used for the decoded tracks if given."""
+        try:
+            tempo, tempo_changes = BuzzerMusic.decode_tempo(data)
+            music = BuzzerMusic(tempo, tempo_changes=tempo_changes)
+            for channel, notes in BuzzerMusic.iter_tracks(data):
+                music.tracks.append(_decode_track(channel, notes, channels_spec))
+        except IndexError as e:
+            raise ValueError("music data is truncated") from e
+        return music
+
     @staticmethod
     def encode_beat_us_tempo(us: float) -> int:
         return round(us / (256 * BuzzerNote.TIMEFRAME_RESOLUTION)) - 1
+
+
+@dataclass
+class BuzzerMusicBank:
+    songs: List[BuzzerMusic] = field(default_factory=list)
+
+    SONG_TRACKS_END = 0xff
+    SONG_ENTRY_SIZE = 3
+    # tracks table entry pointing to the tempo changes of a song.
+    SONG_TEMPO_CHANGES = 0xfe
+
+    def encode(self, optimal: bool = False, backref: bool = False) -> bytes:
+        """
+        Encode all songs in a single music bank. Identical tracks are stored only once,
+        and so are identical duration arrays (or duration arrays contained in another).
+        """
+        return self.encode_with_song_sizes(optimal, backref)[0]
+
+    def encode_with_song_sizes(self, optimal: bool = False,
+                               backref: bool = False) -> Tuple[bytes, List[int]]:
+        """Encode music bank, and get the size each song would have if encoded alone,
+        computed from the same track encodings."""
+        if not (0 < len(self.songs) <= 0xff):
+            raise RuntimeError("music bank must have between 1 and 255 songs")
+
+        # encode tracks, without channel number so that they can be shared by any channel.
+        # each song refers to the tracks it uses by index.
+        tracks_data: List[bytes] = []
+        tracks_index: Dict[bytes, int] = {}
+        songs_tracks: List[List[Tuple[int, int]]] = []
+        song_sizes: List[int] = []
+        for music in self.songs:
+            if len(set(t.channel for t in music.tracks)) != len(music.tracks):
+                raise RuntimeError("tracks must be unique")
+            song_tracks = []
+            # tempo and music end bytes, and tempo changes block.
+            song_size = 2
+            if music.tempo_changes:
+                song_size += 1 + len(music.encode_tempo_changes())
+            for track in sorted(music.tracks, key=lambda t: t.channel):
+                if len(track.notes) > 0:
+                    data = bytearray(track.encode(optimal, backref))
+                    song_size += len(data)
+                    data[0] &= BuzzerTrack.BACKREF_FLAG
+                    data = bytes(data)
+                    if data not in tracks_index:
+                        tracks_index[data] = len(tracks_data)
+                        tracks_data.append(data)
+                    song_tracks.append((track.channel, tracks_index[data]))
+            songs_tracks.append(song_tracks)
+            song_sizes.append(song_size)
+
+        # place duration arrays after all tracks, longest first so that shorter ones
+        # can be found in them.
+        tracks_durations = [data[int.from_bytes(data[3:5], "little"):] for data in tracks_data]
+        durations = bytearray()
+        durations_pos = [0] * len(tracks_data)
+        for i in sorted(range(len(tracks_data)), key=lambda k: -len(tracks_durations[k])):
+            track_durations = tracks_durations[i]
+            pos = durations.find(track_durations)
+            if pos == -1:
+                pos = len(durations)
+                durations += track_durations
+            durations_pos[i] = pos
+
+        # index of songs, then tracks table for each song, then tempo changes.
+        songs_tempo_changes = [music.encode_tempo_changes() if music.tempo_changes else b""
+                               for music in self.songs]
+        b = bytearray()
+        b.append(len(self.songs))
+        tables_pos = len(self.songs) * BuzzerMusicBank.SONG_ENTRY_SIZE + 1
+        for music, song_tracks in zip(self.songs, songs_tracks):
+            b.append(music.tempo)
+            b += tables_pos.to_bytes(2, "little", signed=False)
+            tables_pos += len(song_tracks) * 3 + 1
+            if music.tempo_changes:
+                tables_pos += 3
+        tempo_changes_pos = tables_pos
+        tracks_pos = tables_pos + sum(len(changes) for changes in songs_tempo_changes)
+        track_positions = []
+        for data in tracks_data:
+            track_positions.append(tracks_pos)
+            tracks_pos += int.from_bytes(data[3:5], "little")
+        for song_tracks, tempo_changes in zip(songs_tracks, songs_tempo_changes):
+            if tempo_changes:
+                b.append(BuzzerMusicBank.SONG_TEMPO_CHANGES)
+                b += tempo_changes_pos.to_bytes(2, "little", signed=False)
+                tempo_changes_pos += len(tempo_changes)
+            for channel, i in song_tracks:
+                b.append(channel)
+                b += track_positions[i].to_bytes(2, "little", signed=False)
+            b.append(BuzzerMusicBank.SONG_TRACKS_END)
+        size = tracks_pos + len(durations)
+        if size > 0xffff:
+            raise RuntimeError(f"music bank is too big to be encoded ({size} bytes)")
+        for tempo_changes in songs_tempo_changes:
+            b += tempo_changes
+
+        # tracks notes, with track length and duration array offset updated.
+        for data, pos, track_durations_pos in zip(tracks_data, track_positions, durations_pos):
+            notes = bytearray(data[:int.from_bytes(data[3:5], "little")])
+            notes[1:3] = len(notes).to_bytes(2, "little", signed=False)
+            notes[3:5] = (tracks_pos + track_durations_pos - pos).to_bytes(
+                2, "little", signed=False)
+            b += notes
+        b += durations
+        return b, song_sizes
+
+    @staticmethod
+    def iter_tracks(data: ByteData, song: int) -> Iterator[Tuple[int, Iterator[Tuple[int, int]]]]:
+        """
+        Iterate over the tracks of a song in a music bank in the same way as src/music.c,
+        yielding the channel number and a lazy iterator over the (note, duration) pairs.
+        """
+        view = memoryview(data)
+        entry_pos = song * BuzzerMusicBank.SONG_ENTRY_SIZE + 1
+        table_pos = int.from_bytes(view[entry_pos + 1:entry_pos + 3], "little")
+        if view[table_pos] == BuzzerMusicBank.SONG_TEMPO_CHANGES:
+            table_pos += 3
+        while view[table_pos] != BuzzerMusicBank.SONG_TRACKS_END:
+            track_pos = int.from_bytes(view[table_pos + 1:table_pos + 3], "little")
+            yield view[table_pos], decode_track_notes(view, track_pos)
+            table_pos += 3
+
+    @staticmethod
+    def decode_tempo(data: ByteData, song: int) -> Tuple[int, List[Tuple[int, int]]]:
+        """Get tempo and tempo changes of a song in a music bank."""
+        entry_pos = song * BuzzerMusicBank.SONG_ENTRY_SIZE + 1
+        table_pos = int.from_bytes(data[entry_pos + 1:entry_pos + 3], "little")
+        if data[table_pos] == BuzzerMusicBank.SONG_TEMPO_CHANGES:
+            changes_pos = int.from_bytes(data[table_pos + 1:table_pos + 3], "little")
+            return data[entry_pos], decode_tempo_changes(data, changes_pos)
+        return data[entry_pos], []
+
+    @staticmethod
+    def decode(data: ByteData,
+               channels_spec: Optional[Sequence[ChannelSpec]] = None) -> "BuzzerMusicBank":
+        """Decode all songs in a music bank. Channels spec is used for the decoded tracks if given."""
+        view = memoryview(data)
+        bank = BuzzerMusicBank()
+        try:
+            for song in range(view[0]):
+                tempo, tempo_changes = BuzzerMusicBank.decode_tempo(view, song)
+                music = BuzzerMusic(tempo, tempo_changes=tempo_changes)
+                for channel, notes in BuzzerMusicBank.iter_tracks(view, song):
+                    music.tracks.append(_decode_track(channel, notes, channels_spec))
+                bank.songs.append(music)
+        except IndexError as e:
+            raise ValueError("music bank data is truncated") from e
+        return bank
@@ -0,0 +1,95 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+from typing import Dict, List, Tuple, Optional
+
+import numpy as np
+
+from midi_notes import MidiEventMap, iter_note_changes
+from music_data import CompiledChannelSpecs
+
+# fit the octave of each MIDI track to the channels note range, from histograms of the notes
+# played in each track, without converting the file for each adjustment. a track is shifted
+# by the smallest number of octaves for which all its notes are playable, preferably by as
+# many channels as the notes it plays at once, so that notes outside the range of narrow
+# channels (like 8-bit timers) don't all need the same wider channels.
+
+# largest octave adjustment tried for a track.
+MAX_OCTAVE_ADJUST = 4
+
+
+def get_note_histograms(event_map: MidiEventMap,
+                        track_count: int) -> Tuple[np.ndarray, List[int]]:
+    """Count the number of times each MIDI note starts being played in each MIDI track, and
+    get the maximum number of notes played at once in each track, after all events at a time."""
+    histograms = np.zeros((track_count, CompiledChannelSpecs.MIDI_NOTES), dtype=np.int64)
+    notes_on = [0] * track_count
+    max_notes = [0] * track_count
+    last_time = 0
+    for time, track_num, note, on in iter_note_changes(event_map, track_count):
+        if time != last_time:
+            max_notes = [max(m, n) for m, n in zip(max_notes, notes_on)]
+            last_time = time
+        if on:
+            histograms[track_num, note] += 1
+            notes_on[track_num] += 1
+        else:
+            notes_on[track_num] -= 1
+    max_notes = [max(m, n) for m, n in zip(max_notes, notes_on)]
+    return histograms, max_notes
+
+
+def get_shifted_channels(channels_spec: CompiledChannelSpecs) -> np.ndarray:
+    """Get the number of channels that can play each MIDI note, shifted by each octave
+    adjustment. Shape is (adjustments, notes), notes out of MIDI range have no channels."""
+    notes = CompiledChannelSpecs.MIDI_NOTES
+    channels = np.array([bin(mask).count("1") for mask in channels_spec.playable])
+    padded = np.zeros(notes + 24 * MAX_OCTAVE_ADJUST, dtype=np.int64)
+    padded[12 * MAX_OCTAVE_ADJUST:12 * MAX_OCTAVE_ADJUST + notes] = channels
+    return np.array([padded[12 * (MAX_OCTAVE_ADJUST + adjust):][:notes]
+                     for adjust in range(-MAX_OCTAVE_ADJUST, MAX_OCTAVE_ADJUST + 1)])
+
+
+def fit_octaves(histograms: np.ndarray, max_notes: List[int],
+                channels_spec: CompiledChannelSpecs) -> Optional[List[int]]:
+    """Get the octave adjustment of each MIDI track for which all its notes are playable, and
+    playable by at least as many channels as its notes played at once if possible, with the
+    smallest adjustment. Returns None if notes of a track can't all be played."""
+    adjusts = np.arange(-MAX_OCTAVE_ADJUST, MAX_OCTAVE_ADJUST + 1)
+    shifted = get_shifted_channels(channels_spec)
+    needed = np.minimum(max_notes, len(channels_spec))[:, np.newaxis, np.newaxis]
+    # notes of each track not playable, and not playable by enough channels, for each
+    # adjustment. shape is (tracks, adjustments).
+    unplayable = np.sum(histograms[:, np.newaxis, :] * (shifted == 0), axis=2)
+    narrow = np.sum(histograms[:, np.newaxis, :] * (shifted < needed), axis=2)
+    octaves = []
+    for track_unplayable, track_narrow in zip(unplayable, narrow):
+        # upward adjustment is used if tied.
+        best = np.lexsort((-adjusts, np.abs(adjusts), track_narrow, track_unplayable))[0]
+        if track_unplayable[best]:
+            return None
+        octaves.append(int(adjusts[best]))
+    return octaves
+
+
+def split_octaves(histograms: np.ndarray, octaves: List[int]) -> Tuple[int, List[int]]:
+    """Split octave adjustments of tracks into the adjustment of most notes, used for the
+    whole file, and the adjustment of each track relative to it."""
+    counts = np.sum(histograms, axis=1)
+    weights: Dict[int, int] = {}
+    for octave, count in zip(octaves, counts):
+        weights[octave] = weights.get(octave, 0) + int(count)
+    global_octave = max(weights.keys(), key=lambda o: (weights[o], -abs(o)))
+    return global_octave, [octave - global_octave for octave in octaves]
@@ -0,0 +1,150 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+from typing import Dict, List, Optional, TextIO, Tuple
+
+# writers for encoded music data in text formats. output is built in bulk from precomputed
+# tables and written at once, instead of writing each byte separately.
+
+# C and assembler notation of each byte value, and Intel HEX notation.
+C_HEX_BYTES = [f"0x{b:02x}" for b in range(256)]
+HEX_BYTES = [f"{b:02X}" for b in range(256)]
+
+# number of bytes per line in C header and assembler output.
+BYTES_PER_LINE = 12
+
+# number of data bytes per Intel HEX record.
+HEX_RECORD_SIZE = 16
+HEX_RECORD_DATA = 0x00
+HEX_RECORD_EOF = 0x01
+HEX_RECORD_EXTENDED_ADDRESS = 0x04
+
+
+def _get_defines(defines: Optional[Dict[str, int]]) -> List[str]:
+    if not defines:
+        return []
+    return [f"#define {name} {value}\n" for name, value in defines.items()] + ["\n"]
+
+
+def _get_c_array(data: bytes, arr_name: str) -> List[str]:
+    parts = [f"static _FLASH uint8_t {arr_name}[] = {{\n"]
+    for i in range(0, len(data), BYTES_PER_LINE):
+        line = data[i:i + BYTES_PER_LINE]
+        parts.append("    ")
+        parts.append(", ".join([C_HEX_BYTES[b] for b in line]))
+        # last byte of a line is followed by a space if line isn't complete.
+        parts.append(",\n" if len(line) == BYTES_PER_LINE else ", \n")
+    parts.append("};")
+    return parts
+
+
+def write_c_header(file: TextIO, data: bytes, arr_name: str,
+                   defines: Optional[Dict[str, int]] = None):
+    """Write C header file containing data array with a name, and optional defines."""
+    write_multi_c_header(file, [(arr_name, data)], defines)
+
+
+def write_multi_c_header(file: TextIO, arrays: List[Tuple[str, bytes]],
+                         defines: Optional[Dict[str, int]] = None,
+                         table_name: Optional[str] = None):
+    """Write C header file containing data arrays by name, and optional defines.
+    If a table name is given, a table of pointers to the arrays is added."""
+    parts = ['#include "defs.h"\n\n']
+    parts += _get_defines(defines)
+    for i, (arr_name, data) in enumerate(arrays):
+        if i > 0:
+            parts.append("\n\n")
+        parts += _get_c_array(data, arr_name)
+    if table_name:
+        parts.append(f"\n\nstatic _FLASH uint8_t* const {table_name}[] = {{\n")
+        parts += [f"    {arr_name},\n" for arr_name, _ in arrays]
+        parts.append("};")
+    file.write("".join(parts))
+
+
+def write_asm_include(file: TextIO, arrays: List[Tuple[str, bytes]],
+                      defines: Optional[Dict[str, int]] = None,
+                      table_name: Optional[str] = None):
+    """Write assembler source file placing data arrays by name in flash, with optional
+    defines. The file must be preprocessed (.S extension). Arrays are placed in the section
+    read by _FLASH pointers for the target: program memory on ATmega328P, and memory mapped
+    read-only data on ATmega3208. If a table name is given, a table of the arrays addresses
+    is added in read-only data. Declarations for C are written separately with `write_asm_header`."""
+    parts = _get_defines(defines)
+    parts.append("#if defined(__AVR_ATmega328P__)\n"
+                 '    .section .progmem.data,"a",@progbits\n'
+                 "#else\n"
+                 '    .section .rodata,"a",@progbits\n'
+                 "#endif\n")
+    for arr_name, data in arrays:
+        parts.append(f"\n    .global {arr_name}\n    .type {arr_name}, @object\n{arr_name}:\n")
+        for i in range(0, len(data), BYTES_PER_LINE):
+            parts.append("    .byte ")
+            parts.append(", ".join([C_HEX_BYTES[b] for b in data[i:i + BYTES_PER_LINE]]))
+            parts.append("\n")
+        parts.append(f"    .size {arr_name}, . - {arr_name}\n")
+    if table_name:
+        # the table itself isn't _FLASH qualified, it's read as regular const data. on
+        # ATmega328P, .rodata is copied to RAM at startup like .data.
+        parts.append('\n    .section .rodata,"a",@progbits\n'
+                     "#if defined(__AVR_ATmega328P__)\n"
+                     "    .global __do_copy_data\n"
+                     "#endif\n")
+        parts.append(f"\n    .global {table_name}\n    .type {table_name}, @object\n"
+                     f"{table_name}:\n")
+        parts += [f"    .word {arr_name}\n" for arr_name, _ in arrays]
+        parts.append(f"    .size {table_name}, . - {table_name}\n")
+    file.write("".join(parts))
+
+
+def write_asm_header(file: TextIO, arrays: List[Tuple[str, bytes]],
+                     defines: Optional[Dict[str, int]] = None,
+                     table_name: Optional[str] = None):
+    """Write C header file declaring the data arrays and table of an assembler source file
+    written with `write_asm_include`, with the same optional defines."""
+    parts = ['#include "defs.h"\n\n']
+    parts += _get_defines(defines)
+    parts += [f"extern _FLASH uint8_t {arr_name}[{len(data)}];\n" for arr_name, data in arrays]
+    if table_name:
+        parts.append(f"extern _FLASH uint8_t* const {table_name}[{len(arrays)}];\n")
+    file.write("".join(parts))
+
+
+def _get_hex_record(record_type: int, address: int, data: bytes) -> str:
+    record = bytes((len(data), address >> 8, address & 0xff, record_type)) + data
+    checksum = -sum(record) & 0xff
+    return f":{''.join([HEX_BYTES[b] for b in record])}{HEX_BYTES[checksum]}\n"
+
+
+def write_intel_hex(file: TextIO, data: bytes, base_address: int = 0):
+    """Write data in Intel HEX format starting at a base address. Extended linear address
+    records are used for addresses above 64 kB."""
+    if not (0 <= base_address and base_address + len(data) <= 1 << 32):
+        raise ValueError("data doesn't fit in Intel HEX address space")
+    parts = []
+    upper_address = 0
+    i = 0
+    while i < len(data):
+        address = base_address + i
+        if address >> 16 != upper_address:
+            upper_address = address >> 16
+            parts.append(_get_hex_record(HEX_RECORD_EXTENDED_ADDRESS, 0,
+                                         upper_address.to_bytes(2, "big")))
+        # records don't cross 64 kB boundaries.
+        size = min(HEX_RECORD_SIZE, len(data) - i, 0x10000 - (address & 0xffff))
+        parts.append(_get_hex_record(HEX_RECORD_DATA, address & 0xffff, data[i:i + size]))
+        i += size
+    parts.append(_get_hex_record(HEX_RECORD_EOF, 0, b""))
+    file.write("".join(parts))
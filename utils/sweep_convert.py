@@ -0,0 +1,246 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Tuple
+
+from logger import Logger, LogLevel
+from midi_convert import MidiConverter, Config, MidiData, TempoChanges, TRACK_STRATEGIES, \
+    create_config, parser as convert_parser
+from music_data import FramesNotes
+
+# convert a MIDI file with every combination of a set of conversion options and rank the results.
+# the MIDI file is parsed once, and notes in each frame are computed once for each tempo and
+# octave adjustment, since other options don't affect them. tracks are then created and encoded
+# for each combination in parallel.
+
+parser = argparse.ArgumentParser(description="Convert MIDI file with many combinations of options",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("input_file", type=str, help="Input MIDI file")
+parser.add_argument("-s", "--strategies", type=str,
+                    help="Comma-separated track strategies to try (default is all strategies)",
+                    dest="strategies", default=",".join(TRACK_STRATEGIES.keys()))
+parser.add_argument("-c", "--channels", type=str, action="append",
+                    help="Channel specification to try, can be repeated (default is atmega3208)",
+                    dest="channels", metavar="SPEC", default=[])
+parser.add_argument("-o", "--octaves", type=str,
+                    help="Comma-separated octave adjustments to try (default is 0).\n"
+                         "Use '--octaves=-1,0' if the list starts with a negative value.",
+                    dest="octaves", default="0")
+parser.add_argument("-t", "--tempos", type=str,
+                    help="Comma-separated tempo overrides in BPM to try, 'none' for no override\n"
+                         "(default is no override)",
+                    dest="tempos", default="none")
+parser.add_argument("-m", "--merge", type=str,
+                    help="Comma-separated merge MIDI tracks options to try, 0 or 1 (default is 0)",
+                    dest="merge", default="0")
+parser.add_argument("-r", "--range", type=str,
+                    help="Time range to use from MIDI file, in seconds (see midi_convert.py)",
+                    dest="time_range", default=None)
+parser.add_argument("-z", "--optimize-size", action="store_true",
+                    help="Search for the smallest encoding of tracks", dest="optimal_encoding")
+parser.add_argument("-b", "--backref", action="store_true",
+                    help="Encode repeated sequences of notes as back-references",
+                    dest="backref_encoding")
+parser.add_argument("-k", "--rank", type=str, choices=["size", "channels"],
+                    help="Rank results by size then channels used, or by channels used then size\n"
+                         "(default is size). Failed conversions are always ranked last.",
+                    dest="rank", default="size")
+parser.add_argument("-n", "--count", type=int,
+                    help="Number of results to show (default is all)",
+                    dest="count", default=None)
+parser.add_argument("-j", "--jobs", type=int,
+                    help="Number of processes used for conversions (default is 1).",
+                    dest="jobs", default=1)
+
+
+@dataclass
+class SweepParams:
+    strategy: str
+    channels: str
+    octave_adjust: int
+    # tempo override in BPM, None for no override.
+    tempo: Optional[int]
+    merge_midi_tracks: bool
+
+    @property
+    def frames_key(self) -> Tuple[int, Optional[int]]:
+        # parameters which affect the notes in each frame.
+        return self.octave_adjust, self.tempo
+
+
+@dataclass
+class SweepResult:
+    params: SweepParams
+    # encoded data size and number of channels used, None if conversion failed.
+    size: Optional[int]
+    channels_used: Optional[int]
+    error: str = ""
+
+
+def create_sweep_config(args: argparse.Namespace, params: SweepParams) -> Config:
+    """Create converter configuration for a combination of options, with errors kept in a
+    string buffer. Raises ValueError if options are invalid."""
+    argv = [args.input_file, "-", "-s", params.strategy, "-c", params.channels,
+            "-o", str(params.octave_adjust)]
+    if params.tempo is not None:
+        argv += ["-t", str(params.tempo)]
+    if params.merge_midi_tracks:
+        argv.append("-m")
+    if args.time_range:
+        argv += ["-r", args.time_range]
+    if args.optimal_encoding:
+        argv.append("-z")
+    if args.backref_encoding:
+        argv.append("-b")
+    config = create_config(convert_parser.parse_args(argv))
+    config.logger = Logger(io.StringIO(), LogLevel.ERROR)
+    return config
+
+
+def get_error(config: Config, default: str) -> str:
+    # get first error logged by converter.
+    lines = config.logger.file.getvalue().splitlines()
+    return lines[0].replace("ERROR: ", "") if lines else default
+
+
+# frames notes for each frames key in pool worker processes.
+_worker_args: Optional[argparse.Namespace] = None
+_worker_frames: Dict[Tuple[int, Optional[int]], Tuple[TempoChanges, FramesNotes]] = {}
+
+
+def _init_worker(args: argparse.Namespace,
+                 frames: Dict[Tuple[int, Optional[int]], Tuple[TempoChanges, FramesNotes]]) -> None:
+    global _worker_args, _worker_frames
+    _worker_args = args
+    _worker_frames = frames
+
+
+def _convert(params: SweepParams) -> SweepResult:
+    # create tracks and encode music for a combination, from cached frames notes.
+    try:
+        config = create_sweep_config(_worker_args, params)
+    except ValueError as e:
+        return SweepResult(params, None, None, str(e))
+    tempo_changes, frames_notes = _worker_frames[params.frames_key]
+    try:
+        music = MidiConverter(config).create_music(tempo_changes, frames_notes)
+        size = len(music.encode(config.optimal_encoding, config.backref_encoding))
+    except RuntimeError as e:
+        return SweepResult(params, None, None, get_error(config, str(e)))
+    return SweepResult(params, size, len(music.tracks))
+
+
+def get_sweep_params(args: argparse.Namespace) -> List[SweepParams]:
+    """Get all combinations of options to convert with. Raises ValueError if invalid."""
+    strategies = args.strategies.split(",")
+    for strategy in strategies:
+        if strategy not in TRACK_STRATEGIES:
+            raise ValueError(f"unknown track strategy '{strategy}'")
+    try:
+        octaves = [int(o) for o in args.octaves.split(",")]
+        tempos = [None if t == "none" else int(t) for t in args.tempos.split(",")]
+        merges = [bool(int(m)) for m in args.merge.split(",")]
+    except ValueError:
+        raise ValueError("invalid list of options")
+    return [SweepParams(strategy, channels, octave, tempo, merge)
+            for octave in octaves for tempo in tempos
+            for channels in args.channels or ["atmega3208"]
+            for strategy in strategies for merge in merges]
+
+
+def get_frames(args: argparse.Namespace, params_list: List[SweepParams],
+               results: List[SweepResult]) -> Dict[Tuple[int, Optional[int]],
+                                                    Tuple[TempoChanges, FramesNotes]]:
+    """Parse MIDI file once and get frames notes for each tempo and octave adjustment.
+    Combinations for which frames notes can't be obtained are added to failed results."""
+    frames = {}
+    errors = {}
+    midi_data: Optional[MidiData] = None
+    for params in params_list:
+        key = params.frames_key
+        if key in frames or key in errors:
+            continue
+        try:
+            config = create_sweep_config(args, params)
+        except ValueError as e:
+            errors[key] = str(e)
+            continue
+        converter = MidiConverter(config)
+        try:
+            if midi_data is None:
+                midi_data = converter.parse_midi_file(args.input_file)
+            frames[key] = converter.get_frames_notes(midi_data)
+        except RuntimeError as e:
+            errors[key] = get_error(config, str(e))
+    results += [SweepResult(params, None, None, errors[params.frames_key])
+                for params in params_list if params.frames_key in errors]
+    return frames
+
+
+def print_results(results: List[SweepResult]) -> None:
+    print(f"{'Rank':<6}{'Size':<8}{'Channels':<10}{'Strategy':<16}{'Octave':<8}{'Tempo':<7}"
+          f"{'Merge':<7}Channels spec")
+    for i, result in enumerate(results):
+        params = result.params
+        tempo = "-" if params.tempo is None else str(params.tempo)
+        line = f"{i + 1:<6}"
+        if result.size is None:
+            line += f"{'-':<8}{'-':<10}"
+        else:
+            line += f"{result.size:<8}{result.channels_used:<10}"
+        line += f"{params.strategy:<16}{params.octave_adjust:<+8}{tempo:<7}" \
+                f"{'yes' if params.merge_midi_tracks else 'no':<7}{params.channels}"
+        if result.size is None:
+            line += f" (failed: {result.error})"
+        print(line)
+
+
+def main() -> None:
+    args = parser.parse_args()
+    try:
+        if not os.path.isfile(args.input_file):
+            raise ValueError(f"input file '{args.input_file}' doesn't exist")
+        if args.jobs < 1:
+            raise ValueError("number of jobs must be at least 1")
+        params_list = get_sweep_params(args)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    results: List[SweepResult] = []
+    frames = get_frames(args, params_list, results)
+    params_list = [params for params in params_list if params.frames_key in frames]
+    if args.jobs > 1 and len(params_list) > 1:
+        with multiprocessing.Pool(args.jobs, _init_worker, (args, frames)) as pool:
+            results += pool.map(_convert, params_list)
+    else:
+        _init_worker(args, frames)
+        results += [_convert(params) for params in params_list]
+
+    if args.rank == "size":
+        results.sort(key=lambda r: (r.size is None, r.size or 0, r.channels_used or 0))
+    else:
+        results.sort(key=lambda r: (r.size is None, r.channels_used or 0, r.size or 0))
+    print_results(results[:args.count])
+    sys.exit(0 if results and results[0].size is not None else 1)
+
+
+if __name__ == '__main__':
+    main()
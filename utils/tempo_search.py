@@ -0,0 +1,156 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Optional
+
+import numpy as np
+
+from midi_notes import MidiEventMap, iter_note_changes
+from music_data import BuzzerNote, BuzzerTrack, BuzzerMusic
+
+# score all encoded tempos (0-255) for a MIDI file at once, from the real time of its note
+# events, without converting the file for each tempo. each encoded tempo is scored with the
+# reference tempo used to compute frames, which is the closest to a simple ratio of the MIDI
+# file tempo if one encodes to it, so that notes on a beat subdivision stay on ticks.
+
+# denominators of the ratios of MIDI file tempo tried for each encoded tempo.
+TEMPO_RATIO_DENOMINATORS = [1, 2, 3, 4]
+
+# tolerance on timing errors in seconds, for notes falling on ticks up to rounding errors.
+ERROR_TOLERANCE = 1e-6
+
+# maximum number of (tempo, note) pairs scored at once, to limit memory use.
+CHUNK_SIZE = 1 << 22
+
+
+@dataclass
+class TempoScores:
+    """Score of each candidate reference tempo."""
+    # largest and average deviation of note boundaries from their time in MIDI file, in seconds.
+    # a note going on and off during the same tick is dropped, its deviation is its duration.
+    max_error: np.ndarray
+    mean_error: np.ndarray
+    # number of notes dropped for going on and off during the same tick.
+    dropped_notes: np.ndarray
+    # estimated encoded size of all tracks in bytes.
+    size: np.ndarray
+
+    def within(self, max_error: float) -> np.ndarray:
+        """Get mask of tempos for which note boundaries deviate by at most max_error seconds."""
+        return self.max_error <= max_error + ERROR_TOLERANCE
+
+
+def get_midi_seconds(tempo_map: Dict[int, int], ticks_per_beat: int,
+                     times: np.ndarray) -> np.ndarray:
+    """Convert MIDI times to seconds using tempo map (tempo in us/beat by MIDI time)."""
+    changes = sorted(tempo_map.items())
+    change_times = np.array([time for time, _ in changes], dtype=np.float64)
+    tempos = np.array([tempo for _, tempo in changes], dtype=np.float64) / (ticks_per_beat * 1e6)
+    change_seconds = np.concatenate(([0], np.cumsum(np.diff(change_times) * tempos[:-1])))
+    i = np.searchsorted(change_times, times, side="right") - 1
+    return change_seconds[i] + (times - change_times[i]) * tempos[i]
+
+
+def get_note_spans(event_map: MidiEventMap, track_count: int,
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Get start and end MIDI times of all notes, and their MIDI track, sorted by track and
+    start time. Notes are paired like when getting frames notes."""
+    notes_on: List[Dict[int, int]] = [{} for _ in range(track_count)]
+    spans: List[Tuple[int, int, int]] = []
+    for time, track_num, note, on in iter_note_changes(event_map, track_count):
+        if on:
+            notes_on[track_num][note] = time
+        else:
+            spans.append((track_num, notes_on[track_num].pop(note), time))
+    spans.sort()
+    spans_arr = np.array(spans, dtype=np.int64).reshape(-1, 3)
+    return spans_arr[:, 1], spans_arr[:, 2], spans_arr[:, 0]
+
+
+def get_duration_size(ticks: np.ndarray) -> np.ndarray:
+    """Get number of bytes used to encode durations in ticks (one or two bytes, or more notes
+    if too long)."""
+    return np.where(ticks <= 128, 1, 3 * np.ceil(ticks / (BuzzerNote.MAX_DURATION + 1)) - 1)
+
+
+def score_tempos(starts: np.ndarray, ends: np.ndarray, tracks: np.ndarray,
+                 tempos: np.ndarray) -> TempoScores:
+    """Score candidate reference tempos in us/beat for notes starting and ending at times in
+    seconds, sorted by track and start time. All tempos are scored at once with numpy."""
+    count = len(tempos)
+    scores = TempoScores(np.zeros(count), np.zeros(count), np.zeros(count, dtype=np.int64),
+                         np.zeros(count, dtype=np.int64))
+    if len(starts) == 0:
+        return scores
+
+    # positive gaps between consecutive notes of a MIDI track are encoded as pauses.
+    same_track = tracks[1:] == tracks[:-1]
+    chunk = max(1, CHUNK_SIZE // len(starts))
+    for i in range(0, count, chunk):
+        # events between the start of tick n and the start of tick n+1 are placed on tick n.
+        ticks = tempos[i:i + chunk, np.newaxis] * 1e-6 / BuzzerNote.TIMEFRAME_RESOLUTION
+        start_ticks = np.floor(starts / ticks)
+        end_ticks = np.floor(ends / ticks)
+        dropped = start_ticks == end_ticks
+        errors = np.concatenate((starts - start_ticks * ticks, ends - end_ticks * ticks), axis=1)
+        errors[:, len(starts):][dropped] = (ends - starts + np.zeros_like(ticks))[dropped]
+        scores.max_error[i:i + chunk] = np.max(errors, axis=1)
+        scores.mean_error[i:i + chunk] = np.mean(errors, axis=1)
+        scores.dropped_notes[i:i + chunk] = np.sum(dropped, axis=1)
+
+        # a note byte and its duration, then a single byte for short pauses, or a pause
+        # byte and its duration. a duration equal to the previous one in the track is encoded
+        # in a single byte for the whole run. immediate pauses aren't accounted for.
+        durations = end_ticks - start_ticks
+        repeated = np.zeros_like(dropped)
+        repeated[:, 1:] = same_track & (durations[:, 1:] == durations[:, :-1])
+        run_ends = repeated & ~np.concatenate((repeated[:, 1:], np.zeros_like(ticks, dtype=bool)),
+                                              axis=1)
+        note_sizes = np.where(dropped, 0,
+                              1 + np.where(repeated, run_ends, get_duration_size(durations)))
+        gaps = np.where(same_track, start_ticks[:, 1:] - end_ticks[:, :-1], 0)
+        pause_sizes = np.where(gaps <= 0, 0, np.where(gaps <= BuzzerTrack.MAX_SHORT_PAUSE + 1,
+                                                      1, 1 + get_duration_size(gaps)))
+        scores.size[i:i + chunk] = np.sum(note_sizes, axis=1) + np.sum(pause_sizes, axis=1)
+    return scores
+
+
+def find_tempo(scores: TempoScores, max_error: float) -> Optional[int]:
+    """Find index of the tempo with the smallest estimated size for which note boundaries
+    deviate by at most max_error seconds, with the smallest average error if tied, then the
+    slowest tempo (music loop runs less often). Returns None if no tempo is within the error
+    budget. Tempos must be sorted in increasing order."""
+    candidates = np.flatnonzero(scores.within(max_error))
+    if len(candidates) == 0:
+        return None
+    best = np.lexsort((-candidates, scores.mean_error[candidates],
+                       scores.size[candidates]))[0]
+    return int(candidates[best])
+
+
+def get_candidate_tempos(midi_tempo: float) -> np.ndarray:
+    """Get reference tempo in us/beat for each encoded tempo, from MIDI file tempo."""
+    unit = 256 * BuzzerNote.TIMEFRAME_RESOLUTION
+    count = BuzzerMusic.encode_beat_us_tempo(BuzzerMusic.TEMPO_MIN) + 1
+    tempos = (np.arange(count) + 1.0) * unit
+    # simplest ratios are set last to take precedence.
+    for denominator in reversed(TEMPO_RATIO_DENOMINATORS):
+        ratio_tempos = (midi_tempo / denominator *
+                        np.arange(1, BuzzerMusic.TEMPO_MIN * denominator // midi_tempo + 2))
+        encoded = np.round(ratio_tempos / unit).astype(np.int64) - 1
+        valid = (encoded >= 0) & (encoded < count)
+        tempos[encoded[valid]] = ratio_tempos[valid]
+    return tempos
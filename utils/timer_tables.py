@@ -0,0 +1,199 @@
+#  Copyright 2021 Nicolas Maltais
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import sys
+from dataclasses import dataclass
+from typing import List, TextIO
+
+import numpy as np
+
+from music_data import get_note_freq
+from midi_convert import parse_note_spec, NOTE_NAMES
+
+# from a CPU frequency and the prescalers available for each timer, find the prescaler and the
+# range of notes for each timer minimizing the worst-case note error and the interrupt rate,
+# then output the timer count tables for the firmware and the matching channels specification.
+
+parser = argparse.ArgumentParser(description="Generate timer count tables for channel timers",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument("-f", "--cpu-freq", type=float, required=True,
+                    help="CPU frequency in Hz", dest="cpu_freq")
+parser.add_argument("-t", "--timer", type=str, action="append", required=True,
+                    help="Timer specification, in the '<bits>:<prescalers>[:<channels>]' format,\n"
+                         "e.g. '8:1,8,64,256,1024:2' for a 8-bit timer shared by 2 channels.\n"
+                         "Can be specified multiple times, once for each timer in order.",
+                    dest="timers", metavar="SPEC")
+parser.add_argument("-r", "--range", type=str,
+                    help="Range of notes to play with each timer, 'C2,C8' by default",
+                    dest="note_range", default="C2,C8")
+parser.add_argument("-i", "--isr-weight", type=float,
+                    help="Cost of the interrupt rate, in cents of error for each kHz\n"
+                         "(default is 1)",
+                    dest="isr_weight", default=1)
+parser.add_argument("-m", "--missing-weight", type=float,
+                    help="Cost of each note in range not playable by a timer, in cents of error\n"
+                         "(default is 5)",
+                    dest="missing_weight", default=5)
+parser.add_argument("-n", "--name", type=str,
+                    help="Name of the channels specification (default is 'custom')",
+                    dest="name", default="custom")
+parser.add_argument("-o", "--output", type=str,
+                    help="Output file for C tables (default is standard output)",
+                    dest="output_file", default=None)
+
+
+@dataclass
+class TimerSpec:
+    bits: int
+    prescalers: List[int]
+    channels: int = 1
+
+
+@dataclass
+class TimerChoice:
+    prescaler: int
+    timer_period: float
+    note_range: range
+    # timer count for each note in range
+    counts: np.ndarray
+    # worst-case note error in cents
+    max_error: float
+    # maximum interrupt rate in Hz, for all channels using the timer
+    max_isr_rate: float
+
+
+def parse_timer_spec(spec: str) -> TimerSpec:
+    parts = spec.split(":")
+    try:
+        if not (2 <= len(parts) <= 3):
+            raise ValueError
+        timer = TimerSpec(int(parts[0]), [int(p) for p in parts[1].split(",")],
+                          int(parts[2]) if len(parts) == 3 else 1)
+    except ValueError:
+        raise ValueError(f"invalid timer specification '{spec}'")
+    if timer.bits not in (8, 16) or timer.channels < 1 or any(p <= 0 for p in timer.prescalers):
+        raise ValueError(f"invalid timer specification '{spec}'")
+    return timer
+
+
+def format_note(note: int) -> str:
+    return f"{NOTE_NAMES[note % 12]}{note // 12 + 2}"
+
+
+def format_timer_period(period: float) -> str:
+    """Format timer period in the shortest way for a channels specification."""
+    period = round(period)
+    if period % 1000000 == 0:
+        return f"{period // 1000000}e6"
+    elif period % 1000 == 0 and period >= 100000:
+        return f"{period // 1000}e3"
+    return str(period)
+
+
+def choose_timer(timer: TimerSpec, cpu_freq: float, note_range: range,
+                 isr_weight: float, missing_weight: float) -> TimerChoice:
+    """
+    Choose the prescaler and the range of notes for a timer, among all prescalers and all
+    ranges contained in a range of notes, minimizing the total cost.
+    """
+    notes = np.arange(note_range.start, note_range.stop)
+    freqs = get_note_freq(notes)
+    periods = cpu_freq / np.array(timer.prescalers, dtype=np.float64)
+
+    # timer count and error for each prescaler and note, shape (prescalers, notes).
+    counts = np.round(periods[:, None] / freqs / 2) - 1
+    fits = (counts >= 1) & (counts < 1 << timer.bits)
+    errors = np.abs(1200 * np.log2(periods[:, None] / (counts + 1) / 2 / freqs))
+
+    # worst-case error and number of notes that don't fit for every range, by taking the
+    # cumulative maximum and sum over the last note of range, for each first note of range.
+    # shape is (prescalers, first note, last note).
+    in_range = notes[None, :] >= notes[:, None]
+    max_errors = np.maximum.accumulate(np.where(in_range, errors[:, None, :], 0), axis=2)
+    unfit = np.cumsum(np.where(in_range, ~fits[:, None, :], False), axis=2)
+    isr_rates = 2 * freqs * timer.channels
+    missing = len(notes) - (notes[None, :] - notes[:, None] + 1)
+    costs = max_errors + isr_weight * isr_rates / 1000 + missing_weight * missing
+    costs = np.where(in_range & (unfit == 0), costs, np.inf)
+
+    p, first, last = np.unravel_index(np.argmin(costs), costs.shape)
+    if np.isinf(costs[p, first, last]):
+        raise ValueError("no prescaler can play notes in range")
+    return TimerChoice(timer.prescalers[p], periods[p], range(notes[first], notes[last] + 1),
+                       counts[p, first:last + 1].astype(np.int64), max_errors[p, first, last],
+                       isr_rates[last])
+
+
+def write_tables(file: TextIO, timers: List[TimerSpec], choices: List[TimerChoice],
+                 cpu_freq: float, spec_entry: str) -> None:
+    file.write(f"// Generated by utils/timer_tables.py for a {cpu_freq / 1e6:g} MHz clock.\n"
+               f"// Timer counts are calculated using the following formula:\n"
+               f"//   [count] = round([f_cpu] / [prescaler] / [note frequency] / 2) - 1\n")
+    for i, (timer, choice) in enumerate(zip(timers, choices)):
+        first = choice.note_range.start
+        last = choice.note_range.stop - 1
+        file.write(f"\n// Timer {i}: prescaler {choice.prescaler}, notes {format_note(first)} "
+                   f"to {format_note(last)} ({first} to {last}), "
+                   f"maximum error {choice.max_error:.1f} cents.\n")
+        file.write(f"_FLASH uint{timer.bits}_t TIMER{i}_NOTES[] = {{\n")
+        for pos in range(0, len(choice.counts), 12):
+            file.write(f"    {', '.join(str(c) for c in choice.counts[pos:pos + 12])},\n")
+        file.write(f"}};\n#define TIMER{i}_OFFSET ({-first})\n")
+    file.write(f"\n// Channels specification for utils/midi_convert.py:\n//   {spec_entry}\n")
+
+
+def main() -> None:
+    args = parser.parse_args()
+    try:
+        range_parts = args.note_range.split(",")
+        if len(range_parts) != 2:
+            raise ValueError("invalid note range")
+        note_range = range(parse_note_spec(range_parts[0]), parse_note_spec(range_parts[1]) + 1)
+        if not note_range:
+            raise ValueError("invalid note range")
+        timers = [parse_timer_spec(spec) for spec in args.timers]
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    choices = []
+    channel_specs = []
+    last_spec = ""
+    for i, timer in enumerate(timers):
+        try:
+            choice = choose_timer(timer, args.cpu_freq, note_range,
+                                  args.isr_weight, args.missing_weight)
+        except ValueError as e:
+            print(f"Error: timer {i}: {e}", file=sys.stderr)
+            sys.exit(1)
+        choices.append(choice)
+        channel_spec = f"{choice.note_range.start},{choice.note_range.stop - 1}," \
+                       f"{format_timer_period(choice.timer_period)}"
+        # '-' is used for channels identical to the previous one.
+        channel_specs.append(channel_spec if channel_spec != last_spec else "-")
+        channel_specs += ["-"] * (timer.channels - 1)
+        last_spec = channel_spec
+    spec_entry = f"\"{args.name}\": \"{';'.join(channel_specs)}\","
+
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            write_tables(file, timers, choices, args.cpu_freq, spec_entry)
+        print(spec_entry)
+    else:
+        write_tables(sys.stdout, timers, choices, args.cpu_freq, spec_entry)
+
+
+if __name__ == '__main__':
+    main()
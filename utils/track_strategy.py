@@ -18,7 +18,7 @@ from abc import ABC
 from typing import List, Optional, Tuple
 
 from logger import Logger
-from music_data import BuzzerMusic, BuzzerTrack, BuzzerNote, FramesNotes, ChannelSpec
+from music_data import BuzzerMusic, BuzzerTrack, BuzzerNote, FramesNotes, CompiledChannelSpecs
 
 
 class TrackStrategyFailError(Exception):
@@ -33,7 +33,7 @@ class TrackStrategy(ABC):
     def __init__(self):
         self.merge_midi_tracks = False
 
-    def create_tracks(self, logger: Logger, channels_spec: List[ChannelSpec],
+    def create_tracks(self, logger: Logger, channels_spec: CompiledChannelSpecs,
                       frames_notes: FramesNotes) -> List[BuzzerTrack]:
         """
         Create a list of buzzer tracks by placing the notes in each frame.
@@ -46,7 +46,7 @@ class TrackStrategy(ABC):
 
         def filter_tracks(track: BuzzerTrack):
             midi_asg = midi_track_assignment[track.channel]
-            return (bnote in track.spec.note_range and
+            return (playable >> track.channel & 1 and
                     (self.merge_midi_tracks or midi_asg is None or midi_track == midi_asg))
 
         for i in range(len(frames_notes[0])):
@@ -56,6 +56,9 @@ class TrackStrategy(ABC):
             for midi_track, midi_track_notes in enumerate(frames_notes):
                 for note in midi_track_notes[i]:
                     bnote = BuzzerNote.from_midi(note)
+                    # bitmask of tracks on which note can be played.
+                    playable = channels_spec.playable[note] \
+                        if 0 <= note < CompiledChannelSpecs.MIDI_NOTES else 0
 
                     # filter available tracks to keep only tracks which have had no note
                     # assigned yet to them or tracks which have had notes from this MIDI track.
@@ -115,9 +118,9 @@ class ClosestTrackStrategy(TrackStrategy):
         closest_count = 0
         min_note_dist = 0
         for i, track in enumerate(tracks):
-            curr_note = track.notes[-1].note
+            curr_note = track.notes[-1]
             if curr_note == BuzzerNote.NONE and len(track.notes) > 1:
-                curr_note = track.notes[-2].note
+                curr_note = track.notes[-2]
             note_dist = math.inf if curr_note == BuzzerNote.NONE else abs(bnote - curr_note)
             if closest_track is None or note_dist < min_note_dist or \
                     (note_dist == min_note_dist and len(track.notes) > closest_count):
@@ -137,7 +140,7 @@ class ClosestAverageTrackStrategy(TrackStrategy):
     _tracks_sum: List[int]
     _tracks_count: List[int]
 
-    def create_tracks(self, logger: Logger, channels_spec: List[ChannelSpec],
+    def create_tracks(self, logger: Logger, channels_spec: CompiledChannelSpecs,
                       frames_notes: FramesNotes) -> List[BuzzerTrack]:
         self._tracks_sum = [0] * len(channels_spec)
         self._tracks_count = [0] * len(channels_spec)
@@ -202,7 +205,7 @@ class AutoTrackStrategy(TrackStrategy):
     default strategy of trying strategies in order
     """
 
-    def create_tracks(self, logger: Logger, channels_spec: List[ChannelSpec],
+    def create_tracks(self, logger: Logger, channels_spec: CompiledChannelSpecs,
                       frames_notes: FramesNotes) -> List[BuzzerTrack]:
         # try strategies in order
         for s in auto_strategies:
@@ -223,7 +226,7 @@ class OptimizeSizeTrackStrategy(TrackStrategy):
     try all strategies and use the one that gives the smallest data size.
     """
 
-    def create_tracks(self, logger: Logger, channels_spec: List[ChannelSpec],
+    def create_tracks(self, logger: Logger, channels_spec: CompiledChannelSpecs,
                       frames_notes: FramesNotes) -> List[BuzzerTrack]:
         best_tracks: Optional[List[BuzzerTrack]] = None
         best_track_strategy: Optional[str] = None
@@ -257,7 +260,7 @@ class OptimizeChannelsTrackStrategy(TrackStrategy):
     if same number of channels, compare size
     """
 
-    def create_tracks(self, logger: Logger, channels_spec: List[ChannelSpec],
+    def create_tracks(self, logger: Logger, channels_spec: CompiledChannelSpecs,
                       frames_notes: FramesNotes) -> Optional[List[BuzzerTrack]]:
         best_tracks: Optional[List[BuzzerTrack]] = None
         best_track_strategy: Optional[str] = None
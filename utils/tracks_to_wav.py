@@ -12,14 +12,16 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import copy
+import bisect
+import multiprocessing
 import wave
+from collections import deque
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Iterator, BinaryIO, Tuple, Union
 
 import numpy as np
 
-from music_data import BuzzerMusic, BuzzerNote, BuzzerTrack, get_note_freq
+from music_data import BuzzerMusic, BuzzerNote, BuzzerTrack, CompiledChannelSpecs
 
 # sample rate for WAV file if sample width >= 2
 SAMPLE_RATE = 44100
@@ -30,105 +32,514 @@ PWM_SAMPLE_RATE = 524288
 # the PWM resolution is log2(PWM_PERIOD) = 3 bits
 PWM_PERIOD = 16
 
+# packed samples for a PWM period at each level, the first <level> samples are high.
+PWM_PATTERNS = np.packbits(np.arange(PWM_PERIOD) < np.arange(PWM_PERIOD + 1)[:, np.newaxis], axis=1)
+
 # maximum value in a WAV file sample.
 SAMPLE_MAX = 255
 
+# sample width for signed 16-bit samples, other widths use unsigned 8-bit samples.
+WIDE_SAMPLE_WIDTH = 16
+# maximum value in a signed 16-bit sample.
+WIDE_SAMPLE_MAX = 32767
+# fraction of maximum amplitude used by band-limited synthesis, leaving room for
+# polyBLEP overshoot.
+BAND_LIMITED_AMPLITUDE = 0.9
+
+# maximum number of frames generated at once when creating WAV file.
+CHUNK_SIZE = 1 << 20
+
 
 @dataclass
 class TrackState:
-    current_note: Optional[BuzzerNote]
+    # index of next note in track.
     current_idx: int
+    # quantum at which next note starts, None if track is done.
+    next_start: Optional[int]
+    # number of samples since last level change, and current level (0 or 1).
     phase: int
     level: int
-    done: bool
-    note_max_phase: int
+    # number of samples between level changes for note currently played, 0 if not playing.
+    note_period: int
+    # band-limited synthesis: position in square wave cycle (0 to 1), and cycle increment
+    # per sample (0 if not playing).
+    cycle_phase: float
+    phase_step: float
     track: BuzzerTrack
+    # note period and phase step for each note on the track channel (0 for no note).
+    note_periods: List[int]
+    phase_steps: List[float]
 
-    def __init__(self, track: BuzzerTrack):
+    def __init__(self, track: BuzzerTrack, note_periods: List[int], phase_steps: List[float]):
         self.track = track
-        self.current_note = None
+        self.note_periods = note_periods
+        self.phase_steps = phase_steps
         self.current_idx = 0
+        self.next_start = 0
         self.phase = 0
         self.level = 0
-        self.done = False
+        self.note_period = 0
+        self.cycle_phase = 0
+        self.phase_step = 0
+
+    def get_position(self) -> Tuple:
+        # get state without track, to be restored later.
+        return (self.current_idx, self.next_start, self.phase, self.level, self.note_period,
+                self.cycle_phase, self.phase_step)
+
+    def set_position(self, position: Tuple) -> None:
+        (self.current_idx, self.next_start, self.phase, self.level, self.note_period,
+         self.cycle_phase, self.phase_step) = position
+
+
+@dataclass
+class QuantaTiming:
+    # quantum at which each tempo segment starts (the first at 0), and its number of frames
+    # per quantum.
+    tempo_starts: List[int]
+    frames_per_quantum: List[int]
+
+    def iter_segments(self, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+        # split a range of quanta at tempo changes, yielding the range and frames per quantum
+        # of each part.
+        i = bisect.bisect_right(self.tempo_starts, start) - 1
+        while start < end:
+            segment_end = end
+            if i + 1 < len(self.tempo_starts):
+                segment_end = min(end, self.tempo_starts[i + 1])
+            yield start, segment_end, self.frames_per_quantum[i]
+            start = segment_end
+            i += 1
+
+    def get_frame(self, quantum: int) -> int:
+        # get the first frame of a quantum.
+        return sum((end - start) * frames_per_quantum
+                   for start, end, frames_per_quantum in self.iter_segments(0, quantum))
+
+    def get_quantum(self, frame: int) -> int:
+        # get the quantum containing a frame.
+        start_frame = 0
+        for i, (start, frames_per_quantum) in enumerate(zip(self.tempo_starts,
+                                                             self.frames_per_quantum)):
+            if i + 1 < len(self.tempo_starts):
+                end_frame = start_frame + (self.tempo_starts[i + 1] - start) * frames_per_quantum
+                if frame >= end_frame:
+                    start_frame = end_frame
+                    continue
+            return start + (frame - start_frame) // frames_per_quantum
+        return 0
+
 
+@dataclass
+class RenderParams:
+    sample_width: int
+    # whether square waves are band-limited, with polyBLEP at the exact note frequency
+    # instead of changing level on the nearest sample.
+    band_limited: bool
+    # output level for each number of tracks at high level, if not PWM or band-limited.
+    levels: Optional[np.ndarray]
+    timing: QuantaTiming
+    # lookup tables for the channel of each track.
+    channels: CompiledChannelSpecs
+
+    @property
+    def pwm(self) -> bool:
+        return self.sample_width == 1
+
+    def get_samples(self, start: int, end: int) -> int:
+        # number of samples for the tracks in a range of quanta, a PWM period is a single sample.
+        return sum((end - start) * (frames_per_quantum // PWM_PERIOD if self.pwm
+                                    else frames_per_quantum)
+                   for start, end, frames_per_quantum in self.timing.iter_segments(start, end))
 
-def _go_to_next_note(states: List[TrackState]) -> None:
-    # decrement note duration left and go to next note if needed.
-    for i, state in enumerate(states):
-        if state.done:
+
+def _go_to_next_note(states: List[TrackState], quantum: int) -> None:
+    # go to next note for tracks with a note starting at a quantum.
+    for state in states:
+        if state.next_start != quantum:
             continue
-        note = state.current_note
         track = state.track
-        if not note or note.duration == 0:
-            if state.current_idx == len(track.notes):
-                state.done = True
+        if state.current_idx == len(track.notes):
+            state.next_start = None
+            state.note_period = 0
+            state.phase_step = 0
+            continue
+        note = track.notes[state.current_idx]
+        state.next_start += track.durations[state.current_idx] + 1
+        state.current_idx += 1
+        state.level = 0
+        state.note_period = state.note_periods[note]
+        state.phase_step = state.phase_steps[note]
+
+
+def _create_states(tracks: List[BuzzerTrack], channels: CompiledChannelSpecs) -> List[TrackState]:
+    return [TrackState(track, channels.note_periods[i].tolist(), channels.phase_steps[i].tolist())
+            for i, track in enumerate(tracks)]
+
+
+@dataclass
+class TrackIndex:
+    # quantum at which each note starts (and the end of track once indexed completely), and
+    # the phases at the start of each note. phases are only kept between notes, level is reset.
+    starts: List[int]
+    phases: List[Tuple[int, float]]
+
+
+class SeekIndex:
+    """
+    Index of the notes of each track, used to start rendering at any time without rendering
+    the music before. Notes are only indexed up to the furthest time rendered so far.
+    The same index can be given to successive renders, the index of tracks that haven't
+    changed is then reused (e.g. when previewing a time range again in watch mode).
+    """
+    _tracks: List[BuzzerTrack]
+    _sample_width: int
+    _timing: Optional[QuantaTiming]
+    _indexes: List[TrackIndex]
+
+    def __init__(self):
+        self._tracks = []
+        self._sample_width = 0
+        self._timing = None
+        self._indexes = []
+
+    def get_track_indexes(self, tracks: List[BuzzerTrack], sample_width: int,
+                          timing: QuantaTiming) -> List[TrackIndex]:
+        # get the index of each track, reusing the index of tracks that haven't changed.
+        indexes = []
+        for i, track in enumerate(tracks):
+            if (sample_width == self._sample_width and timing == self._timing and
+                    i < len(self._tracks) and track == self._tracks[i]):
+                indexes.append(self._indexes[i])
             else:
-                note = copy.copy(track.notes[state.current_idx])
-                state.current_note = note
-                if note.note != BuzzerNote.NONE:
-                    # timer count is an integer, rounding results in some error
-                    # calculate note frequency as if it was produced by a timer.
-                    # / 2 since timer interrupt is called twice per note period.
-                    timer_count = round(track.spec.timer_period / get_note_freq(note.note) / 2)
-                    note_freq = track.spec.timer_period / timer_count
-                    state.note_max_phase = SAMPLE_RATE / note_freq
-                state.current_idx += 1
-                state.level = 0
+                indexes.append(TrackIndex([0], [(0, 0.0)]))
+        self._tracks = list(tracks)
+        self._sample_width = sample_width
+        self._timing = timing
+        self._indexes = indexes
+        return indexes
+
+
+def _extend_track_index(track_state: TrackState, index: TrackIndex, params: RenderParams,
+                        quantum: int) -> None:
+    # extend the index of a track until the note playing at a quantum is known.
+    track = track_state.track
+    state = TrackState(track, track_state.note_periods, track_state.phase_steps)
+    state.phase, state.cycle_phase = index.phases[-1]
+    while index.starts[-1] <= quantum and len(index.starts) <= len(track):
+        start = index.starts[-1]
+        i = len(index.starts) - 1
+        note, duration = track.notes[i], track.durations[i]
+        state.note_period = state.note_periods[note]
+        state.phase_step = state.phase_steps[note]
+        _advance_state(state, params.get_samples(start, start + duration + 1))
+        index.starts.append(start + duration + 1)
+        index.phases.append((state.phase, state.cycle_phase))
+
+
+def _seek_states(states: List[TrackState], params: RenderParams, indexes: List[TrackIndex],
+                 quantum: int) -> None:
+    # set tracks state at the start of a quantum, as if all previous quanta had been generated.
+    # the note played is found in the track index and the phase is computed from its start.
+    for state, index in zip(states, indexes):
+        track = state.track
+        _extend_track_index(state, index, params, quantum)
+        starts, phases = index.starts, index.phases
+        i = min(bisect.bisect_right(starts, quantum) - 1, len(track))
+        state.level = 0
+        state.phase, state.cycle_phase = phases[i]
+        state.note_period = 0
+        state.phase_step = 0
+        if starts[i] == quantum:
+            # note starts at quantum, or track ends at quantum
+            state.current_idx = i
+            state.next_start = quantum
+        elif i == len(track):
+            # track is done
+            state.current_idx = i
+            state.next_start = None
         else:
-            note.duration -= 1
-
-
-def _generate_frames_for_state(frames: np.ndarray, i: int, levels: np.ndarray,
-                               frames_count: int, states: List[TrackState]) -> None:
-    # generate frames for current 1/16th of a beat.
-    active_states = [state for state in states
-                     if not state.done and state.current_note.note != BuzzerNote.NONE]
-    for j in range(frames_count):
-        level = 0
-        for state in active_states:
-            state.phase += 1
-            if state.phase >= state.note_max_phase:
-                state.phase = 0
-                state.level = 1 - state.level
-            level += state.level
-
-        frames[i] = levels[level]
-        i += 1
-
-
-def _generate_frames_for_state_pwm(frames: np.ndarray, i: int,
-                                   frames_count: int, states: List[TrackState]) -> None:
-    # generate frames for current 1/16th of a beat, in PWM.
-    active_states = [state for state in states
-                     if not state.done and state.current_note.note != BuzzerNote.NONE]
+            state.current_idx = i + 1
+            state.next_start = starts[i + 1]
+            state.note_period = state.note_periods[track.notes[i]]
+            state.phase_step = state.phase_steps[track.notes[i]]
+            _advance_state(state, params.get_samples(starts[i], quantum))
+
+
+def _generate_levels(states: List[TrackState], count: int) -> np.ndarray:
+    # sum the levels of all tracks for the next samples, phase is kept between calls.
+    total = np.zeros(count, dtype=np.int64)
+    steps = np.arange(1, count + 1)
+    for state in states:
+        period = state.note_period
+        if period == 0:
+            continue
+        # level changes at sample <first>, then every <period> samples.
+        first = max(1, period - state.phase)
+        changes = (steps + (period - first)) // period
+        total += (changes + state.level) & 1
+        _advance_state(state, count)
+    return total
+
+
+def _generate_band_limited(states: List[TrackState], count: int) -> np.ndarray:
+    # sum band-limited square waves (-1 to 1) of all tracks for the next samples.
+    # the discontinuities of the naive square wave are smoothed with polyBLEP.
+    total = np.zeros(count)
+    steps = np.arange(1, count + 1)
+    for state in states:
+        step = state.phase_step
+        if step == 0:
+            continue
+        cycle_phase = (state.cycle_phase + steps * step) % 1.0
+        total += np.where(cycle_phase < 0.5, 1.0, -1.0)
+        total += _poly_blep(cycle_phase, step)
+        total -= _poly_blep((cycle_phase + 0.5) % 1.0, step)
+        _advance_state(state, count)
+    return total
+
+
+def _poly_blep(cycle_phase: np.ndarray, step: float) -> np.ndarray:
+    # correction for a rising step at the start of the cycle, applied on the samples
+    # immediately before and after it.
+    after = cycle_phase / step
+    before = (cycle_phase - 1) / step
+    return np.where(cycle_phase < step, 2 * after - after * after - 1,
+                    np.where(cycle_phase > 1 - step, before * before + 2 * before + 1, 0.0))
+
+
+def _advance_state(state: TrackState, count: int) -> None:
+    # update phase and level of a track after a number of samples without generating them.
+    state.cycle_phase = (state.cycle_phase + state.phase_step * count) % 1.0
+    period = state.note_period
+    if period == 0:
+        return
+    first = max(1, period - state.phase)
+    changes = (count + period - first) // period
+    if changes == 0:
+        state.phase += count
+    else:
+        state.phase = (count - first) % period
+        state.level ^= changes & 1
+
+
+def _generate_frames(levels: np.ndarray, frames_count: int,
+                     states: List[TrackState]) -> np.ndarray:
+    # generate frames for a segment where no note changes.
+    return levels[_generate_levels(states, frames_count)]
+
+
+def _generate_frames_band_limited(frames_count: int, sample_width: int,
+                                  states: List[TrackState]) -> np.ndarray:
+    # generate frames for a segment where no note changes, band-limited.
+    total = _generate_band_limited(states, frames_count) * (BAND_LIMITED_AMPLITUDE / len(states))
+    if sample_width == WIDE_SAMPLE_WIDTH:
+        return np.rint(total * WIDE_SAMPLE_MAX).astype("<i2")
+    # quantitize to unsigned samples with the levels allowed by sample width.
+    level_step = SAMPLE_MAX / ((1 << sample_width) - 1)
+    return (np.rint((total + 1) * (SAMPLE_MAX / 2 / level_step)) * level_step).astype(np.uint8)
+
+
+def _generate_frames_pwm(quantum_count: int, frames_per_quantum: int,
+                         states: List[TrackState]) -> np.ndarray:
+    # generate frames for a segment where no note changes, in PWM.
+    # a PWM period is a single sample for the tracks, remaining frames in quantum are unused.
+    periods_per_quantum = frames_per_quantum // PWM_PERIOD
     level_norm = PWM_PERIOD / len(states)
-    for j in range(frames_count // PWM_PERIOD):
-        level = 0
-        for state in active_states:
-            state.phase += 1
-            if state.phase >= state.note_max_phase:
-                state.phase = 0
-                state.level = 1 - state.level
-            level += state.level
-        level = round(level * level_norm)
-
-        frames[i:i + level] = SAMPLE_MAX
-        i += PWM_PERIOD
-
-
-def create_wav_file(music: BuzzerMusic, filename: str,
-                    sample_width: int, show_progress: bool = False) -> None:
-    tracks = music.tracks
+    total = _generate_levels(states, quantum_count * periods_per_quantum)
+    pwm_levels = np.rint(total * level_norm).astype(np.uint8)
+    bits = np.unpackbits(PWM_PATTERNS[pwm_levels].reshape(quantum_count, -1), axis=1)
+    frames = np.zeros((quantum_count, frames_per_quantum), dtype=np.uint8)
+    frames[:, :periods_per_quantum * PWM_PERIOD] = bits * SAMPLE_MAX
+    return frames.reshape(-1)
 
-    if not (0 < sample_width <= 8):
-        raise RuntimeError("sample width out of bounds")
 
+def _get_next_quantum(states: List[TrackState], quantum: int, end: int) -> int:
+    # go to next notes and get the quantum of the next note change, up to an end quantum.
+    _go_to_next_note(states, quantum)
+    next_quantum = min((state.next_start for state in states
+                        if state.next_start is not None), default=end)
+    return min(next_quantum, end)
+
+
+def _generate_quanta_frames(states: List[TrackState], params: RenderParams,
+                            start: int, end: int) -> Iterator[np.ndarray]:
+    # generate frames for a range of quanta, all quanta up to the next note change or
+    # tempo change are rendered at once.
+    for quantum, segment_end, frames_per_quantum in params.timing.iter_segments(start, end):
+        while quantum < segment_end:
+            next_quantum = _get_next_quantum(states, quantum, segment_end)
+            quantum_count = next_quantum - quantum
+            if params.pwm:
+                yield _generate_frames_pwm(quantum_count, frames_per_quantum, states)
+            elif params.band_limited:
+                yield _generate_frames_band_limited(quantum_count * frames_per_quantum,
+                                                    params.sample_width, states)
+            else:
+                yield _generate_frames(params.levels, quantum_count * frames_per_quantum, states)
+            quantum = next_quantum
+
+
+def _get_chunks_states(states: List[TrackState], params: RenderParams, chunk_quanta: int,
+                       start: int, end: int) -> Iterator[Tuple[int, int, List[Tuple]]]:
+    # split quanta range in chunks, yielding the range and tracks state at the start of each
+    # chunk. tracks state is advanced without generating frames, so that chunks can be
+    # rendered independently, with exact phase at chunk boundaries.
+    quantum = start
+    while quantum < end:
+        chunk_end = min(quantum + chunk_quanta, end)
+        yield quantum, chunk_end, [state.get_position() for state in states]
+        while quantum < chunk_end:
+            next_quantum = _get_next_quantum(states, quantum, chunk_end)
+            for state in states:
+                _advance_state(state, params.get_samples(quantum, next_quantum))
+            quantum = next_quantum
+
+
+# rendering parameters in pool worker processes.
+_worker_tracks: List[BuzzerTrack] = []
+_worker_params: Optional[RenderParams] = None
+
+
+def _init_worker(tracks: List[BuzzerTrack], params: RenderParams) -> None:
+    global _worker_tracks, _worker_params
+    _worker_tracks = tracks
+    _worker_params = params
+
+
+def _generate_chunk_frames(chunk: Tuple[int, int, List[Tuple]]) -> bytes:
+    # generate frames for a chunk of quanta in a worker process, from tracks state at its start.
+    start, end, positions = chunk
+    states = _create_states(_worker_tracks, _worker_params.channels)
+    for state, position in zip(states, positions):
+        state.set_position(position)
+    return b"".join(frames.tobytes() for frames in _generate_quanta_frames(
+        states, _worker_params, start, end))
+
+
+def _generate_all_frames(states: List[TrackState], params: RenderParams, start: int, end: int,
+                         show_progress: bool, jobs: int) -> Iterator[bytes]:
+    # generate frames for a range of quanta in chunks of about CHUNK_SIZE frames.
+    # if using more than one job and there's more than one chunk, chunks are rendered in
+    # parallel in a process pool.
+    chunk_quanta = max(1, CHUNK_SIZE // max(params.timing.frames_per_quantum))
+    if jobs > 1 and end - start > chunk_quanta:
+        chunks = _get_chunks_states(states, params, chunk_quanta, start, end)
+        tracks = [state.track for state in states]
+        with multiprocessing.Pool(jobs, _init_worker, (tracks, params)) as pool:
+            # limit number of chunks rendered ahead to keep memory use bounded.
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk[1], pool.apply_async(_generate_chunk_frames, (chunk,))))
+                if len(pending) >= 2 * jobs:
+                    chunk_end, result = pending.popleft()
+                    yield result.get()
+                    _print_progress(show_progress, chunk_end - start, end - start)
+            for chunk_end, result in pending:
+                yield result.get()
+                _print_progress(show_progress, chunk_end - start, end - start)
+    else:
+        for chunk_start in range(start, end, chunk_quanta):
+            chunk_end = min(chunk_start + chunk_quanta, end)
+            yield b"".join(frames.tobytes() for frames in _generate_quanta_frames(
+                states, params, chunk_start, chunk_end))
+            _print_progress(show_progress, chunk_end - start, end - start)
+    if show_progress:
+        print()
+
+
+def _print_progress(show_progress: bool, done: int, total: int) -> None:
+    if show_progress:
+        print(f"Generating WAV file {done / total * 100:.0f}%\r", end="")
+
+
+def _get_frames_per_quantum(music: BuzzerMusic, sample_width: int) -> int:
     beat_duration = music.tempo * 256e-6 * BuzzerNote.TIMEFRAME_RESOLUTION
     sample_rate = PWM_SAMPLE_RATE if sample_width == 1 else SAMPLE_RATE
+    return round(sample_rate / BuzzerNote.TIMEFRAME_RESOLUTION * beat_duration)
+
 
+def _get_timing(music: BuzzerMusic, sample_width: int) -> QuantaTiming:
+    # frames per quantum for each tempo segment, at the frame rate of the first tempo.
+    frame_rate = get_wav_frame_rate(music, sample_width)
+    timing = QuantaTiming([0], [_get_frames_per_quantum(music, sample_width)])
+    for tick, tempo in music.tempo_changes:
+        timing.tempo_starts.append(tick)
+        timing.frames_per_quantum.append(round(frame_rate * tempo * 256e-6))
+    return timing
+
+
+def get_wav_frame_rate(music: BuzzerMusic, sample_width: int) -> int:
+    """Get the actual sample rate of WAV file for buzzer music, in Hz."""
+    beat_duration = music.tempo * 256e-6 * BuzzerNote.TIMEFRAME_RESOLUTION
+    frames_per_quantum = _get_frames_per_quantum(music, sample_width)
+    return round(frames_per_quantum * BuzzerNote.TIMEFRAME_RESOLUTION / beat_duration)
+
+
+def get_wav_frame_count(music: BuzzerMusic, sample_width: int) -> int:
+    """Get the number of samples in WAV file for buzzer music."""
+    max_notes = max(sum(track.durations) + len(track.durations) for track in music.tracks)
+    return _get_timing(music, sample_width).get_frame(max_notes)
+
+
+def get_wav_sample_size(sample_width: int) -> int:
+    """Get the size in bytes of a sample in WAV file."""
+    return 2 if sample_width == WIDE_SAMPLE_WIDTH else 1
+
+
+def get_wav_frame_range(music: BuzzerMusic, sample_width: int, start_time: float = 0,
+                        end_time: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Get the range of samples in WAV file for a time range in seconds. Negative times are relative
+    to the end of music, no end time means the end of music.
+    """
+    frame_rate = get_wav_frame_rate(music, sample_width)
+    frame_count = get_wav_frame_count(music, sample_width)
+    if end_time is None:
+        end_time = frame_count / frame_rate
+    start_frame, end_frame = (round(time * frame_rate) + (frame_count if time < 0 else 0)
+                              for time in (start_time, end_time))
+    if not (0 <= start_frame <= end_frame <= frame_count):
+        raise RuntimeError("invalid time range for WAV file")
+    return start_frame, end_frame
+
+
+def generate_wav_chunks(music: BuzzerMusic, sample_width: int, chunk_size: int = CHUNK_SIZE,
+                        show_progress: bool = False, jobs: int = 1, start_time: float = 0,
+                        end_time: Optional[float] = None, band_limited: bool = False,
+                        seek_index: Optional[SeekIndex] = None) -> Iterator[bytes]:
+    """
+    Generate the samples of WAV file for buzzer music (mono, signed 16-bit for a 16-bit
+    sample width, otherwise unsigned 8-bit), in chunks of chunk_size samples (last chunk
+    may be shorter). Memory use doesn't depend on music length.
+    If jobs is greater than 1, samples are rendered in parallel by that many processes.
+    Only samples in time range are generated (see get_wav_frame_range), without rendering
+    the music before start time. If band-limited, square waves are generated without aliasing,
+    this can't be used with PWM. A seek index can be given to reuse it between renders.
+    """
+    if not (0 < sample_width <= 8 or sample_width == WIDE_SAMPLE_WIDTH):
+        raise RuntimeError("sample width out of bounds")
+    if band_limited and sample_width == 1:
+        raise RuntimeError("band-limited synthesis can't be used with PWM")
+    if chunk_size <= 0:
+        raise RuntimeError("chunk size must be positive")
+    frame_range = get_wav_frame_range(music, sample_width, start_time, end_time)
+    if seek_index is None:
+        seek_index = SeekIndex()
+    return _generate_wav_chunks(music, sample_width, band_limited, chunk_size, show_progress,
+                                jobs, frame_range, seek_index)
+
+
+def _generate_wav_chunks(music: BuzzerMusic, sample_width: int, band_limited: bool,
+                         chunk_size: int, show_progress: bool, jobs: int,
+                         frame_range: Tuple[int, int], seek_index: SeekIndex) -> Iterator[bytes]:
+    tracks = music.tracks
     levels = None
-    if sample_width != 1:
+    if sample_width == WIDE_SAMPLE_WIDTH and not band_limited:
+        # signed levels spread evenly according to number of tracks
+        levels = np.rint(np.linspace(-WIDE_SAMPLE_MAX, WIDE_SAMPLE_MAX,
+                                     len(tracks) + 1)).astype("<i2")
+    elif sample_width != 1 and not band_limited:
         # quantitize SAMPLE_MAX into levels according to number of tracks and sample width
         levels_count = len(tracks) + 1
         actual_levels_count = min(levels_count, 1 << sample_width)
@@ -137,27 +548,69 @@ def create_wav_file(music: BuzzerMusic, filename: str,
         for i in range(levels_count):
             levels[i] = round(((SAMPLE_MAX / (levels_count - 1)) * i) / level_step) * level_step
 
-    states = [TrackState(track) for track in tracks]
-    frames_per_quantum = round(sample_rate / BuzzerNote.TIMEFRAME_RESOLUTION * beat_duration)
-    frame_rate_actual = round(frames_per_quantum * BuzzerNote.TIMEFRAME_RESOLUTION / beat_duration)
-    max_notes = max((sum(((note.duration + 1) for note in track.notes)) for track in tracks))
-    frames = np.zeros(max_notes * frames_per_quantum, dtype=np.uint8)
-    i = 0
-    for k in range(max_notes):
-        _go_to_next_note(states)
-        if sample_width == 1:
-            _generate_frames_for_state_pwm(frames, i, frames_per_quantum, states)
-        else:
-            _generate_frames_for_state(frames, i, levels, frames_per_quantum, states)
-        i += frames_per_quantum
-        if show_progress:
-            print(f"Generating WAV file {(k + 1) / max_notes * 100:.0f}%\r", end="")
-    if show_progress:
-        print()
+    # start at the quantum containing the first sample.
+    timing = _get_timing(music, sample_width)
+    channels = CompiledChannelSpecs([track.spec for track in tracks], SAMPLE_RATE)
+    params = RenderParams(sample_width, band_limited, levels, timing, channels)
+    states = _create_states(tracks, channels)
+    start_frame, end_frame = frame_range
+    start = timing.get_quantum(start_frame)
+    end = timing.get_quantum(end_frame - 1) + 1 if end_frame > 0 else 0
+    if start > 0:
+        _seek_states(states, params, seek_index.get_track_indexes(tracks, sample_width, timing),
+                     start)
+
+    # sizes in bytes from now on
+    sample_size = get_wav_sample_size(sample_width)
+    skip = (start_frame - timing.get_frame(start)) * sample_size
+    frames_left = (end_frame - start_frame) * sample_size
+    chunk_size *= sample_size
+
+    # regroup rendered segments in chunks of fixed size.
+    buffer = bytearray()
+    for frames in _generate_all_frames(states, params, start, end, show_progress, jobs):
+        if skip:
+            skipped = min(skip, len(frames))
+            frames = frames[skipped:]
+            skip -= skipped
+        frames = frames[:frames_left]
+        buffer += frames
+        frames_left -= len(frames)
+        if len(buffer) >= chunk_size:
+            full_size = len(buffer) - len(buffer) % chunk_size
+            for i in range(0, full_size, chunk_size):
+                yield bytes(buffer[i:i + chunk_size])
+            del buffer[:full_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def create_wav_file(music: BuzzerMusic, file: Union[str, BinaryIO], sample_width: int,
+                    show_progress: bool = False, jobs: int = 1, start_time: float = 0,
+                    end_time: Optional[float] = None, band_limited: bool = False,
+                    seek_index: Optional[SeekIndex] = None) -> None:
+    # frames are written as they are generated. the number of frames is set before, so the
+    # file can be a stream that can't be seeked.
+    chunks = generate_wav_chunks(music, sample_width, show_progress=show_progress, jobs=jobs,
+                                 start_time=start_time, end_time=end_time,
+                                 band_limited=band_limited, seek_index=seek_index)
+    start_frame, end_frame = get_wav_frame_range(music, sample_width, start_time, end_time)
+    with wave.open(file, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(get_wav_sample_size(sample_width))
+        wav.setframerate(get_wav_frame_rate(music, sample_width))
+        wav.setnframes(end_frame - start_frame)
+        for chunk in chunks:
+            # header isn't patched after each chunk like with writeframes.
+            wav.writeframesraw(chunk)
+
 
-    wav: wave.Wave_write = wave.open(filename, "wb")
-    wav.setnchannels(1)
-    wav.setsampwidth(1)
-    wav.setframerate(frame_rate_actual)
-    wav.setnframes(len(frames))
-    wav.writeframes(frames)
+def write_raw_samples(music: BuzzerMusic, file: BinaryIO, sample_width: int, jobs: int = 1,
+                      start_time: float = 0, end_time: Optional[float] = None,
+                      band_limited: bool = False, seek_index: Optional[SeekIndex] = None) -> None:
+    """Write WAV file samples for buzzer music to a file as raw PCM data, as they are generated."""
+    for chunk in generate_wav_chunks(music, sample_width, jobs=jobs, start_time=start_time,
+                                     end_time=end_time, band_limited=band_limited,
+                                     seek_index=seek_index):
+        file.write(chunk)
+        file.flush()